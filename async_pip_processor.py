@@ -0,0 +1,197 @@
+import os
+import asyncio
+import logging
+import functools
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Optional, Set, Union
+
+from image_preprocessing import PreprocessedImage
+from openai_client import AsyncOpenAIClient
+from openai_service import extract_data_from_prescription_async
+from pip_processor import PIPError, PIPProcessor
+
+
+logger = logging.getLogger(__name__)
+
+
+def _read_bytes(path: str) -> bytes:
+    with open(path, "rb") as f:
+        return f.read()
+
+
+class AsyncPIPProcessor:
+    """
+    Versión asyncio de PIPProcessor para servicios async (p. ej. el webhook del chat).
+
+    La llamada a OpenAI usa aiohttp y no ocupa hilos. Cloud Storage y BigQuery
+    no tienen SDK asíncrono oficial, así que esas etapas corren con los clientes
+    de siempre en pools de hilos propios, sin bloquear el event loop. Cada etapa
+    tiene un semáforo: cuando una se satura, las imágenes esperan antes de
+    entrar en vez de acumularse dentro.
+    """
+
+    def __init__(
+        self,
+        processor: Optional[PIPProcessor] = None,
+        client: Optional[AsyncOpenAIClient] = None,
+        extract_concurrency: Optional[int] = None,
+        upload_concurrency: Optional[int] = None,
+        persist_concurrency: Optional[int] = None,
+    ):
+        """
+        :param processor: PIPProcessor con la configuración (caché, preprocesador,
+            uploader, patient_store, tracer); por defecto uno nuevo.
+        :param client: Cliente de OpenAI; por defecto el compartido del event loop.
+        :param extract_concurrency: Llamadas a OpenAI simultáneas (PIP_ASYNC_EXTRACT_CONCURRENCY, default 32).
+        :param upload_concurrency: Subidas simultáneas (PIP_ASYNC_UPLOAD_CONCURRENCY, default 16).
+        :param persist_concurrency: MERGE simultáneos (PIP_ASYNC_PERSIST_CONCURRENCY, default 4).
+        """
+        self.processor = processor or PIPProcessor()
+        self.client = client
+        extract_concurrency = extract_concurrency or int(os.getenv("PIP_ASYNC_EXTRACT_CONCURRENCY", "32"))
+        upload_concurrency = upload_concurrency or int(os.getenv("PIP_ASYNC_UPLOAD_CONCURRENCY", "16"))
+        persist_concurrency = persist_concurrency or int(os.getenv("PIP_ASYNC_PERSIST_CONCURRENCY", "4"))
+        self._extract_slots = asyncio.Semaphore(extract_concurrency)
+        self._upload_slots = asyncio.Semaphore(upload_concurrency)
+        self._persist_slots = asyncio.Semaphore(persist_concurrency)
+        self._upload_pool = ThreadPoolExecutor(upload_concurrency, thread_name_prefix="pip-async-upload")
+        self._persist_pool = ThreadPoolExecutor(persist_concurrency, thread_name_prefix="pip-async-persist")
+        self._sessions: Dict[str, Set[asyncio.Task]] = {}
+
+    async def _run(self, pool: ThreadPoolExecutor, func, *args):
+        # Like asyncio.to_thread (context included, so spans nest) but on our own pool
+        context = contextvars.copy_context()
+        return await asyncio.get_running_loop().run_in_executor(pool, functools.partial(context.run, func, *args))
+
+    async def extract_data(self, image_path: str, prompt: str, image: Optional[PreprocessedImage] = None) -> dict:
+        """
+        Llama al modelo sin bloquear el loop y valida la respuesta; el triaje
+        del procesador, si lo hay, corre en un hilo antes de la llamada.
+
+        :param image_path: Ruta local del archivo de imagen.
+        :param prompt: Prompt de extracción.
+        :param image: Imagen ya preprocesada; si no, se lee image_path.
+        :return: Diccionario `datos` extraído por el modelo.
+        :raises PIPError: Si la imagen es rechazada o la respuesta es inválida.
+        """
+        tracer = self.processor.tracer
+        async with self._extract_slots:
+            with tracer.span("extraccion") as stage:
+                if self.processor.triage is not None:
+                    try:
+                        await asyncio.to_thread(self.processor.triage_image, image_path, image)
+                    except PIPError:
+                        stage.outcome = "rechazada"
+                        raise
+
+                with tracer.span("openai") as call:
+                    if image is None:
+                        image_bytes, mime_type = await asyncio.to_thread(_read_bytes, image_path), None
+                    else:
+                        image_bytes, mime_type = image.data, image.mime_type
+                    response = await extract_data_from_prescription_async(image_bytes, prompt, mime_type, self.client)
+                    if response.startswith("Error en la API de OpenAI"):
+                        call.outcome = "error"
+
+                return self.processor.parse_response(response, stage)
+
+    async def process_image(self, image_path: str, session_id: str) -> Union[str, dict]:
+        """
+        Procesa la imagen, extrae datos con LLM y guarda en GCS + BigQuery.
+
+        Se puede cancelar con cancel_session(session_id) o cancelando la tarea;
+        la cancelación corta en el siguiente punto de espera, excepto un MERGE
+        que ya empezó, que termina en segundo plano.
+
+        :param image_path: Ruta local del archivo de imagen.
+        :param session_id: ID de sesión actual.
+        :return: Mensaje de error o datos extraídos.
+        :raises asyncio.CancelledError: Si la sesión se canceló.
+        """
+        task = asyncio.current_task()
+        self._sessions.setdefault(session_id, set()).add(task)
+        try:
+            with self.processor.tracer.span("imagen") as span:
+                try:
+                    result = await self._process_image(image_path, session_id)
+                except asyncio.CancelledError:
+                    span.outcome = "cancelada"
+                    logger.info(f"Procesamiento cancelado para la sesión {session_id}: {image_path}")
+                    raise
+                if isinstance(result, str):
+                    span.outcome = "error"
+            return result
+        finally:
+            tasks = self._sessions.get(session_id)
+            if tasks is not None:
+                tasks.discard(task)
+                if not tasks:
+                    del self._sessions[session_id]
+            self.processor.tracer.flush()
+
+    async def _process_image(self, image_path: str, session_id: str) -> Union[str, dict]:
+        processor = self.processor
+        try:
+            # Paso 1: Leer el prompt y buscar en caché
+            prompt = await asyncio.to_thread(processor.read_prompt, session_id)
+            key, cached = await asyncio.to_thread(processor.cache_lookup, image_path, prompt)
+            if cached is not None:
+                return cached
+
+            # Paso 2: Preprocesar la imagen y llamar al servicio OpenAI
+            image = await asyncio.to_thread(processor.prepare_image, image_path)
+            data = await self.extract_data(image_path, prompt, image)
+
+            # Paso 3: Subir imagen a Cloud Storage
+            async with self._upload_slots:
+                upload = await self._run(self._upload_pool, processor.upload_image_result, image_path, image)
+
+            # Paso 4: Preparar estructura y guardar en BigQuery
+            record = processor.build_patient_record(data, session_id, upload.uri, prompt)
+            async with self._persist_slots:
+                # A cancelled wait must not leave the caller unsure whether the MERGE ran:
+                # once started it always completes
+                await asyncio.shield(self._run(self._persist_pool, processor.save_patient, record))
+        except PIPError as e:
+            return e.message
+
+        await asyncio.to_thread(processor.cache_store, key, data)
+        return data
+
+    def cancel_session(self, session_id: str) -> int:
+        """
+        Cancela todas las imágenes en proceso de una sesión (p. ej. chat abandonado).
+
+        :param session_id: ID de la sesión.
+        :return: Número de tareas canceladas.
+        """
+        tasks = self._sessions.get(session_id, set())
+        cancelled = 0
+        for task in list(tasks):
+            if task.cancel():
+                cancelled += 1
+        if cancelled:
+            logger.info(f"Sesión {session_id}: {cancelled} imágenes canceladas")
+        return cancelled
+
+    def active_sessions(self) -> Dict[str, int]:
+        """
+        Imágenes en proceso por sesión.
+        """
+        return {session_id: len(tasks) for session_id, tasks in self._sessions.items()}
+
+    async def close(self) -> None:
+        """
+        Libera el cliente HTTP (si se pasó uno) y los pools de hilos.
+        """
+        if self.client is not None:
+            await self.client.close()
+        self._upload_pool.shutdown(wait=False)
+        self._persist_pool.shutdown(wait=False)
+
+    async def __aenter__(self) -> "AsyncPIPProcessor":
+        return self
+
+    async def __aexit__(self, *exc) -> None:
+        await self.close()
@@ -0,0 +1,479 @@
+import os
+import sys
+import json
+import time
+import logging
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from typing import Dict, List, Optional
+
+from openai_client import requests
+from openai_service import build_request, model_params, read_response
+from pip_processor import IMAGE_EXTENSIONS, PIPError, PIPProcessor
+from startup import load_env
+
+
+logger = logging.getLogger(__name__)
+
+BATCH_ENDPOINT = "/v1/chat/completions"
+# Batch API limits are 50,000 requests and 200 MB per input file
+MAX_REQUESTS_PER_FILE = 50000
+MAX_FILE_BYTES = 190 * 1024 * 1024
+TERMINAL_STATES = ("completed", "failed", "expired", "cancelled")
+STATE_FILE = "trabajo.json"
+
+
+class BatchError(Exception):
+    """
+    Error de la Batch API (archivo o lote rechazado).
+    """
+
+
+class BatchClient:
+    """
+    Cliente mínimo de los endpoints Files y Batches de OpenAI.
+    """
+
+    def __init__(self, api_key: Optional[str] = None, base_url: Optional[str] = None, timeout: float = 300):
+        """
+        :param api_key: API key (OPENAI_API_KEY).
+        :param base_url: URL base de la API (OPENAI_BASE_URL, default https://api.openai.com/v1).
+        :param timeout: Timeout de cada solicitud en segundos (las subidas pueden pesar cientos de MB).
+        """
+        load_env()
+        self.base_url = (base_url or os.getenv("OPENAI_BASE_URL", "https://api.openai.com/v1")).rstrip("/")
+        self.timeout = timeout
+        self.session = requests.Session()
+        self.session.headers["Authorization"] = f"Bearer {api_key or os.getenv('OPENAI_API_KEY')}"
+
+    def _check(self, response: "requests.Response", action: str) -> "requests.Response":
+        if response.status_code != 200:
+            raise BatchError(f"Error {action}: {response.status_code} {response.text[:300]}")
+        return response
+
+    def upload_file(self, path: str) -> str:
+        """
+        Sube un archivo JSONL con purpose=batch.
+
+        :param path: Ruta local del archivo.
+        :return: ID del archivo.
+        """
+        with open(path, "rb") as f:
+            response = self.session.post(
+                f"{self.base_url}/files",
+                data={"purpose": "batch"},
+                files={"file": (os.path.basename(path), f, "application/jsonl")},
+                timeout=self.timeout,
+            )
+        return self._check(response, "subiendo el archivo del lote").json()["id"]
+
+    def create_batch(self, file_id: str, metadata: Optional[Dict] = None) -> Dict:
+        """
+        Crea un lote de chat completions con ventana de 24 horas.
+
+        :param file_id: ID del archivo de entrada.
+        :param metadata: Metadatos del lote.
+        :return: Objeto batch.
+        """
+        response = self.session.post(
+            f"{self.base_url}/batches",
+            json={
+                "input_file_id": file_id,
+                "endpoint": BATCH_ENDPOINT,
+                "completion_window": "24h",
+                "metadata": metadata or {},
+            },
+            timeout=self.timeout,
+        )
+        return self._check(response, "creando el lote").json()
+
+    def get_batch(self, batch_id: str) -> Dict:
+        """
+        Consulta el estado de un lote.
+
+        :param batch_id: ID del lote.
+        :return: Objeto batch.
+        """
+        response = self.session.get(f"{self.base_url}/batches/{batch_id}", timeout=self.timeout)
+        return self._check(response, f"consultando el lote {batch_id}").json()
+
+    def download_file(self, file_id: str) -> str:
+        """
+        Descarga el contenido de un archivo (resultados o errores de un lote).
+
+        :param file_id: ID del archivo.
+        :return: Contenido JSONL.
+        """
+        response = self.session.get(f"{self.base_url}/files/{file_id}/content", timeout=self.timeout)
+        return self._check(response, f"descargando el archivo {file_id}").content.decode("utf-8")
+
+
+class BackfillJob:
+    """
+    Estado de un backfill guardado en `<trabajo>/trabajo.json`.
+
+    Cada lote es un archivo JSONL con su mapa custom_id -> imagen, y los IDs de
+    archivo y de lote a medida que avanza; así cualquier paso se puede repetir
+    o retomar después de una caída.
+    """
+
+    def __init__(self, work_dir: str):
+        """
+        :param work_dir: Carpeta del trabajo (se crea si no existe).
+        """
+        self.work_dir = work_dir
+        self.path = os.path.join(work_dir, STATE_FILE)
+        self.state: Dict = {"sesion": None, "modelo": None, "prompt": None, "lotes": []}
+        if os.path.exists(self.path):
+            with open(self.path, "r", encoding="utf-8") as f:
+                self.state = json.load(f)
+
+    @property
+    def batches(self) -> List[Dict]:
+        return self.state["lotes"]
+
+    def save(self) -> None:
+        """
+        Guarda el estado (escritura atómica).
+        """
+        os.makedirs(self.work_dir, exist_ok=True)
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(self.state, f, ensure_ascii=False, indent=2)
+        os.replace(tmp_path, self.path)
+
+
+def prepare(
+    image_paths: List[str],
+    work_dir: str,
+    session_id: str,
+    processor: PIPProcessor,
+    max_requests: int = MAX_REQUESTS_PER_FILE,
+    max_bytes: int = MAX_FILE_BYTES,
+) -> BackfillJob:
+    """
+    Paso 1: arma los archivos JSONL de chat completions.
+
+    Usa el mismo prompt, preprocesamiento y parámetros que la extracción en
+    línea. Las imágenes que ya están en la caché de extracción se omiten.
+
+    :param image_paths: Rutas locales de las imágenes.
+    :param work_dir: Carpeta del trabajo.
+    :param session_id: ID de sesión con el que se registrarán las prescripciones.
+    :param processor: Procesador con la configuración (prompt, caché, preprocesador).
+    :param max_requests: Solicitudes por archivo.
+    :param max_bytes: Tamaño máximo de cada archivo.
+    :return: Trabajo con los lotes preparados.
+    """
+    job = BackfillJob(work_dir)
+    if job.batches:
+        raise ValueError(f"El trabajo en {work_dir} ya tiene lotes preparados")
+    os.makedirs(work_dir, exist_ok=True)
+    prompt = processor.read_prompt(session_id)
+
+    current = None
+    output = None
+    skipped = 0
+    try:
+        for index, image_path in enumerate(image_paths):
+            _, cached = processor.cache_lookup(image_path, prompt)
+            if cached is not None:
+                skipped += 1
+                continue
+            image = processor.prepare_image(image_path)
+            if image is None:
+                with open(image_path, "rb") as f:
+                    body = build_request(prompt, f.read())
+            else:
+                body = build_request(prompt, image.data, image.mime_type)
+            custom_id = f"img-{index:06d}"
+            line = (json.dumps(
+                {"custom_id": custom_id, "method": "POST", "url": BATCH_ENDPOINT, "body": body}, ensure_ascii=False
+            ) + "\n").encode("utf-8")
+
+            if current is None or len(current["imagenes"]) >= max_requests or current["bytes"] + len(line) > max_bytes:
+                if output is not None:
+                    output.close()
+                current = {
+                    "archivo": f"lote_{len(job.batches):03d}.jsonl",
+                    "imagenes": {},
+                    "bytes": 0,
+                    "file_id": None,
+                    "batch_id": None,
+                    "estado": "preparado",
+                    "output_file_id": None,
+                    "error_file_id": None,
+                    "procesado": False,
+                    "pendientes": [],
+                }
+                job.batches.append(current)
+                output = open(os.path.join(work_dir, current["archivo"]), "wb")
+            output.write(line)
+            current["imagenes"][custom_id] = image_path
+            current["bytes"] += len(line)
+    finally:
+        if output is not None:
+            output.close()
+
+    job.state["sesion"] = session_id
+    job.state["modelo"] = model_params()["model"]
+    # Results are persisted (cache key and version_prompt) with the prompt they were requested with
+    job.state["prompt"] = prompt
+    job.save()
+    logger.info(f"{sum(len(b['imagenes']) for b in job.batches)} solicitudes en {len(job.batches)} archivos "
+                f"({skipped} imágenes ya estaban en caché)")
+    return job
+
+
+def submit(job: BackfillJob, client: BatchClient) -> None:
+    """
+    Paso 2a: sube los archivos y crea un lote por archivo (solo los pendientes).
+
+    :param job: Trabajo preparado.
+    :param client: Cliente de la Batch API.
+    """
+    for batch in job.batches:
+        if batch["batch_id"] is not None:
+            continue
+        if batch["file_id"] is None:
+            batch["file_id"] = client.upload_file(os.path.join(job.work_dir, batch["archivo"]))
+            job.save()
+        created = client.create_batch(batch["file_id"], {"archivo": batch["archivo"], "sesion": job.state["sesion"]})
+        batch["batch_id"] = created["id"]
+        batch["estado"] = created["status"]
+        job.save()
+        logger.info(f"Lote {batch['batch_id']} creado para {batch['archivo']}")
+
+
+def poll(job: BackfillJob, client: BatchClient, interval: float = 60, timeout: Optional[float] = None) -> Dict[str, int]:
+    """
+    Paso 2b: consulta los lotes hasta que todos terminen.
+
+    :param job: Trabajo con lotes enviados.
+    :param client: Cliente de la Batch API.
+    :param interval: Segundos entre consultas.
+    :param timeout: Máximo de segundos a esperar; None espera indefinidamente.
+    :return: Número de lotes por estado.
+    """
+    deadline = None if timeout is None else time.monotonic() + timeout
+    while True:
+        for batch in job.batches:
+            if batch["batch_id"] is None or batch["estado"] in TERMINAL_STATES:
+                continue
+            remote = client.get_batch(batch["batch_id"])
+            batch["estado"] = remote["status"]
+            batch["output_file_id"] = remote.get("output_file_id")
+            batch["error_file_id"] = remote.get("error_file_id")
+            batch["conteos"] = remote.get("request_counts")
+        job.save()
+
+        states: Dict[str, int] = {}
+        for batch in job.batches:
+            states[batch["estado"]] = states.get(batch["estado"], 0) + 1
+        pending = [b for b in job.batches if b["batch_id"] is not None and b["estado"] not in TERMINAL_STATES]
+        if not pending or (deadline is not None and time.monotonic() >= deadline):
+            return states
+        logger.info(f"Lotes: {states}")
+        time.sleep(interval)
+
+
+def collect(job: BackfillJob, client: BatchClient, batch: Dict) -> Dict[str, str]:
+    """
+    Paso 2c: descarga los resultados de un lote terminado y los mapea por custom_id.
+
+    Los archivos descargados se guardan junto al de entrada. Un lote vencido
+    (expired) también trae los resultados de las solicitudes que alcanzó a hacer.
+
+    :param job: Trabajo.
+    :param client: Cliente de la Batch API.
+    :param batch: Lote del trabajo.
+    :return: custom_id -> respuesta del modelo (o mensaje de error), como la
+        retorna extract_data_from_prescription.
+    """
+    responses: Dict[str, str] = {}
+    base = os.path.splitext(batch["archivo"])[0]
+    for key, suffix in (("output_file_id", "resultados"), ("error_file_id", "errores")):
+        if not batch.get(key):
+            continue
+        content = client.download_file(batch[key])
+        with open(os.path.join(job.work_dir, f"{base}.{suffix}.jsonl"), "w", encoding="utf-8") as f:
+            f.write(content)
+        for line in content.splitlines():
+            if not line.strip():
+                continue
+            row = json.loads(line)
+            response = row.get("response") or {}
+            if row.get("error"):
+                responses[row["custom_id"]] = f"Error en la API de OpenAI: {row['error'].get('message')}"
+            else:
+                responses[row["custom_id"]] = read_response(
+                    response.get("status_code", 0), response.get("body"), job.state["modelo"]
+                )
+    return responses
+
+
+def persist(
+    job: BackfillJob,
+    batch: Dict,
+    responses: Dict[str, str],
+    processor: PIPProcessor,
+    upload_workers: Optional[int] = None,
+    persist_batch_size: Optional[int] = None,
+) -> Dict:
+    """
+    Paso 3: valida cada respuesta y pasa las válidas por Cloud Storage y BigQuery en bloque.
+
+    El lote queda procesado solo si ninguna subida o bloque de persistencia
+    falló de forma reintentable; si no, esas solicitudes quedan en
+    `pendientes` y la siguiente ejecución reintenta solo esas.
+
+    :param job: Trabajo.
+    :param batch: Lote del trabajo.
+    :param responses: Resultado de collect.
+    :param processor: Procesador (validación, subida, persistencia y caché).
+    :param upload_workers: Subidas simultáneas (PIP_UPLOAD_WORKERS, default 4).
+    :param persist_batch_size: Registros por MERGE (PIP_PERSIST_BATCH_SIZE, default 50).
+    :return: Resumen con exitosas, fallidas por etapa, solicitudes sin resultado
+        y pendientes de reintento.
+    """
+    upload_workers = upload_workers or int(os.getenv("PIP_UPLOAD_WORKERS", "4"))
+    persist_batch_size = persist_batch_size or int(os.getenv("PIP_PERSIST_BATCH_SIZE", "50"))
+    failures: Dict[str, int] = {}
+    missing = []
+    extracted = []
+    # A previous run that failed to save some records only retries those
+    pending = batch.get("pendientes") or list(batch["imagenes"])
+    for custom_id in pending:
+        image_path = batch["imagenes"][custom_id]
+        if custom_id not in responses:
+            missing.append(image_path)
+            continue
+        try:
+            extracted.append((custom_id, image_path, processor.parse_response(responses[custom_id])))
+        except PIPError as e:
+            failures[e.stage] = failures.get(e.stage, 0) + 1
+
+    def upload(entry):
+        custom_id, image_path, data = entry
+        image = processor.prepare_image(image_path) if processor.upload_optimized else None
+        try:
+            return custom_id, image_path, data, processor.upload_image(image_path, image)
+        except PIPError as e:
+            return custom_id, image_path, data, e
+
+    retry = []
+    records = []
+    with ThreadPoolExecutor(upload_workers, thread_name_prefix="pip-backfill-upload") as pool:
+        for custom_id, image_path, data, uploaded in pool.map(upload, extracted):
+            if isinstance(uploaded, PIPError):
+                failures[uploaded.stage] = failures.get(uploaded.stage, 0) + 1
+                if uploaded.retryable:
+                    retry.append(custom_id)
+            else:
+                records.append((custom_id, image_path, data, processor.build_patient_record(
+                    data, job.state["sesion"], uploaded, job.state["prompt"]
+                )))
+
+    prompt = job.state["prompt"]
+    saved = 0
+    for start in range(0, len(records), persist_batch_size):
+        chunk = records[start:start + persist_batch_size]
+        try:
+            processor.save_patients([record for _, _, _, record in chunk])
+        except PIPError as e:
+            failures[e.stage] = failures.get(e.stage, 0) + len(chunk)
+            retry.extend(custom_id for custom_id, _, _, _ in chunk)
+            continue
+        saved += len(chunk)
+        for _, image_path, data, _ in chunk:
+            key, _ = processor.cache_lookup(image_path, prompt)
+            processor.cache_store(key, data)
+
+    # Transient upload or storage failures keep the batch open for the next run
+    batch["pendientes"] = retry
+    batch["procesado"] = not retry
+    job.save()
+    return {
+        "total": len(pending),
+        "exitosas": saved,
+        "fallidas": sum(failures.values()),
+        "fallas_por_etapa": failures,
+        "sin_resultado": missing,
+        "pendientes": len(retry),
+    }
+
+
+def process(job: BackfillJob, client: BatchClient, processor: PIPProcessor, **kwargs) -> List[Dict]:
+    """
+    Descarga y persiste los lotes terminados que aún no se procesaron o que
+    tienen solicitudes pendientes de un intento anterior.
+
+    :param job: Trabajo.
+    :param client: Cliente de la Batch API.
+    :param processor: Procesador.
+    :param kwargs: upload_workers y persist_batch_size de persist.
+    :return: Un resumen por lote procesado.
+    """
+    summaries = []
+    for batch in job.batches:
+        if batch["procesado"] or batch["estado"] not in TERMINAL_STATES:
+            continue
+        summary = persist(job, batch, collect(job, client, batch), processor, **kwargs)
+        summary["archivo"] = batch["archivo"]
+        summary["estado"] = batch["estado"]
+        logger.info(f"Lote {batch['archivo']} procesado: {summary['exitosas']}/{summary['total']} exitosas")
+        summaries.append(summary)
+    return summaries
+
+
+def list_images(directory: str) -> List[str]:
+    """
+    Imágenes de una carpeta (no recursivo), en orden.
+
+    :param directory: Carpeta.
+    :return: Rutas.
+    """
+    return sorted(
+        os.path.join(directory, name)
+        for name in os.listdir(directory)
+        if name.lower().endswith(IMAGE_EXTENSIONS)
+    )
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="Backfill de fórmulas con la Batch API de OpenAI.")
+    parser.add_argument("accion", choices=["preparar", "enviar", "esperar", "procesar", "ejecutar"],
+                        help="ejecutar = preparar + enviar + esperar + procesar.")
+    parser.add_argument("--trabajo", required=True, help="Carpeta donde se guardan los JSONL y el estado.")
+    parser.add_argument("--carpeta", help="Carpeta con las imágenes (preparar, ejecutar).")
+    parser.add_argument("--sesion", help="ID de sesión de las prescripciones (default backfill-<fecha>).")
+    parser.add_argument("--intervalo", type=float, default=60, help="Segundos entre consultas del estado.")
+    parser.add_argument("--timeout", type=float, help="Máximo de segundos esperando los lotes.")
+    parser.add_argument("--max-solicitudes", type=int, default=MAX_REQUESTS_PER_FILE)
+    parser.add_argument("--max-mb", type=float, default=MAX_FILE_BYTES / (1024 * 1024))
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO)
+    processor = PIPProcessor()
+    client = BatchClient()
+    job = BackfillJob(args.trabajo)
+
+    if args.accion in ("preparar", "ejecutar"):
+        if not args.carpeta:
+            parser.error("--carpeta es obligatorio para preparar")
+        session_id = args.sesion or f"backfill-{datetime.now(timezone.utc):%Y%m%d}"
+        job = prepare(list_images(args.carpeta), args.trabajo, session_id, processor,
+                      args.max_solicitudes, int(args.max_mb * 1024 * 1024))
+    if args.accion in ("enviar", "ejecutar"):
+        submit(job, client)
+    if args.accion in ("esperar", "ejecutar"):
+        print(json.dumps(poll(job, client, args.intervalo, args.timeout), ensure_ascii=False))
+    if args.accion in ("procesar", "ejecutar"):
+        for summary in process(job, client, processor):
+            print(json.dumps(summary, ensure_ascii=False))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,236 @@
+import os
+import sys
+import json
+import time
+import logging
+import argparse
+import resource
+import tempfile
+import threading
+from typing import Dict, List, Optional
+
+from offline_fakes import FakeOpenAIServer, FaultInjector, FilesystemBucket, SQLitePatientStore
+from cloud_storage_service import GCSUploader
+from openai_client import OpenAIClient, set_client, reset_client
+from pip_processor import PIPProcessor
+
+
+logger = logging.getLogger(__name__)
+
+STAGES = ("extraccion", "subida", "persistencia")
+
+
+def percentile(values: List[float], pct: float) -> float:
+    """
+    Percentil por rango más cercano.
+
+    :param values: Muestras.
+    :param pct: Percentil entre 0 y 100.
+    :return: Valor del percentil, o 0.0 si no hay muestras.
+    """
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    rank = max(0, min(len(ordered) - 1, int(round(pct / 100.0 * len(ordered) + 0.5)) - 1))
+    return ordered[rank]
+
+
+def peak_rss_mb() -> float:
+    """
+    Memoria residente máxima del proceso en MB.
+    """
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is reported in bytes on macOS and in kilobytes on Linux
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+
+def generate_images(directory: str, count: int, size_kb: int) -> List[str]:
+    """
+    Genera imágenes sintéticas con contenido distinto cada una.
+
+    :param directory: Carpeta de destino.
+    :param count: Número de imágenes.
+    :param size_kb: Tamaño aproximado de cada imagen.
+    :return: Rutas de las imágenes generadas.
+    """
+    paths = []
+    for i in range(count):
+        path = os.path.join(directory, f"formula_{i:05d}.jpg")
+        with open(path, "wb") as f:
+            # JPEG magic bytes so MIME detection behaves as with a real photo
+            f.write(b"\xff\xd8\xff\xe0" + os.urandom(size_kb * 1024))
+        paths.append(path)
+    return paths
+
+
+class StageTimer:
+    """
+    Mide la duración de cada llamada a los métodos de etapa de un PIPProcessor.
+    """
+
+    def __init__(self):
+        self.samples: Dict[str, List[float]] = {stage: [] for stage in STAGES}
+        self._lock = threading.Lock()
+
+    def wrap(self, processor: PIPProcessor) -> None:
+        """
+        Reemplaza en la instancia los métodos de cada etapa por versiones medidas.
+
+        :param processor: Procesador a instrumentar.
+        """
+        for stage, name in zip(STAGES, ("extract_data", "upload_image", "save_patients")):
+            setattr(processor, name, self._timed(stage, getattr(processor, name)))
+
+    def _timed(self, stage: str, func):
+        def timed(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                elapsed = time.perf_counter() - started
+                with self._lock:
+                    self.samples[stage].append(elapsed)
+        return timed
+
+    def summary(self) -> Dict:
+        """
+        Percentiles en milisegundos por etapa.
+        """
+        with self._lock:
+            return {
+                stage: {
+                    "n": len(values),
+                    "p50_ms": round(percentile(values, 50) * 1000, 2),
+                    "p95_ms": round(percentile(values, 95) * 1000, 2),
+                    "p99_ms": round(percentile(values, 99) * 1000, 2),
+                }
+                for stage, values in self.samples.items()
+            }
+
+
+def run_scenario(
+    image_paths: List[str],
+    workdir: str,
+    workers: int,
+    batch_size: int,
+    gcs_faults: FaultInjector,
+    bq_faults: FaultInjector,
+) -> Dict:
+    """
+    Ejecuta process_batch contra los dobles locales con una configuración.
+
+    :param image_paths: Imágenes a procesar.
+    :param workdir: Carpeta para el bucket y la tabla locales.
+    :param workers: Hilos de extracción y de subida.
+    :param batch_size: Registros por MERGE.
+    :param gcs_faults: Latencia y errores del bucket local.
+    :param bq_faults: Latencia y errores de la tabla local.
+    :return: Métricas del escenario.
+    """
+    scenario = f"w{workers}_b{batch_size}"
+    bucket = FilesystemBucket(os.path.join(workdir, scenario, "bucket"), gcs_faults)
+    store = SQLitePatientStore(os.path.join(workdir, scenario, "pacientes.sqlite3"), bq_faults)
+    uploader = GCSUploader("bucket-local", bucket=bucket)
+    processor = PIPProcessor(uploader=uploader, patient_store=store, speculative_upload=False)
+    # Every scenario must reach the fakes, never a result cached by a previous run
+    processor.cache = None
+
+    timer = StageTimer()
+    timer.wrap(processor)
+    batch = processor.process_batch(
+        image_paths,
+        f"benchmark-{scenario}",
+        extract_workers=workers,
+        upload_workers=workers,
+        persist_workers=2,
+        persist_batch_size=batch_size,
+    )
+    summary = batch["resumen"]
+    return {
+        "workers": workers,
+        "batch_size": batch_size,
+        "imagenes": summary["total"],
+        "exitosas": summary["exitosas"],
+        "fallas_por_etapa": summary["fallas_por_etapa"],
+        "segundos": summary["segundos"],
+        "imagenes_por_segundo": summary["imagenes_por_segundo"],
+        "etapas": timer.summary(),
+        "merges": store.jobs,
+        "pico_rss_mb": round(peak_rss_mb(), 1),
+    }
+
+
+def format_row(row: Dict) -> str:
+    stages = "  ".join(
+        f"{stage[:5]} p50/p95/p99={v['p50_ms']}/{v['p95_ms']}/{v['p99_ms']}ms"
+        for stage, v in row["etapas"].items()
+    )
+    return (
+        f"workers={row['workers']:<3} batch={row['batch_size']:<4} "
+        f"{row['imagenes_por_segundo']:>8.2f} img/s  ok={row['exitosas']}/{row['imagenes']}  "
+        f"merges={row['merges']:<4} rss={row['pico_rss_mb']}MB  {stages}"
+    )
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(
+        description="Benchmark de PIPProcessor contra dobles locales de OpenAI, GCS y BigQuery."
+    )
+    parser.add_argument("--images", type=int, default=200, help="Imágenes por escenario.")
+    parser.add_argument("--image-kb", type=int, default=200, help="Tamaño de cada imagen sintética.")
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 4, 16], help="Hilos de extracción/subida.")
+    parser.add_argument("--batch-sizes", type=int, nargs="+", default=[1, 50], help="Registros por MERGE.")
+    parser.add_argument("--openai-latency-ms", type=float, default=800)
+    parser.add_argument("--openai-jitter-ms", type=float, default=400)
+    parser.add_argument("--openai-error-rate", type=float, default=0.0)
+    parser.add_argument("--openai-429-rate", type=float, default=0.0)
+    parser.add_argument("--gcs-latency-ms", type=float, default=80)
+    parser.add_argument("--gcs-error-rate", type=float, default=0.0)
+    parser.add_argument("--bq-latency-ms", type=float, default=1500)
+    parser.add_argument("--bq-error-rate", type=float, default=0.0)
+    parser.add_argument("--seed", type=int, default=7)
+    parser.add_argument("--json", action="store_true", help="Imprimir los resultados como JSON.")
+    parser.add_argument("--output", help="Guardar los resultados en este archivo.")
+    args = parser.parse_args(argv)
+
+    logging.getLogger().setLevel(logging.WARNING)
+    os.environ.setdefault("PROMPT_PIP_PATH", os.path.join(os.path.dirname(os.path.abspath(__file__)), "prompt_PIP.txt"))
+
+    openai_faults = FaultInjector(
+        args.openai_latency_ms, args.openai_jitter_ms, args.openai_error_rate, args.openai_429_rate, args.seed
+    )
+    rows = []
+    with tempfile.TemporaryDirectory() as workdir, FakeOpenAIServer(openai_faults) as server:
+        image_paths = generate_images(workdir, args.images, args.image_kb)
+        for workers in args.workers:
+            for batch_size in args.batch_sizes:
+                # Fresh client per scenario so pooled connections and stats do not carry over
+                set_client(OpenAIClient(
+                    api_key="local",
+                    api_url=server.url,
+                    requests_per_minute=10 ** 6,
+                    tokens_per_minute=10 ** 9,
+                    pool_size=max(workers, 1),
+                    backoff_base=0.05,
+                    backoff_max=1.0,
+                ))
+                row = run_scenario(
+                    image_paths,
+                    workdir,
+                    workers,
+                    batch_size,
+                    FaultInjector(args.gcs_latency_ms, 0, args.gcs_error_rate, seed=args.seed),
+                    FaultInjector(args.bq_latency_ms, 0, args.bq_error_rate, seed=args.seed),
+                )
+                rows.append(row)
+                print(json.dumps(row, ensure_ascii=False) if args.json else format_row(row), flush=True)
+        reset_client()
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(rows, f, ensure_ascii=False, indent=2)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
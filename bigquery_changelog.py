@@ -0,0 +1,295 @@
+import os
+import sys
+import json
+import hashlib
+import logging
+import argparse
+from datetime import datetime, timezone
+from typing import Dict, List, Optional
+
+from bigquery_service import append_prescriptions, bigquery, get_client, table_ref
+from startup import load_env
+
+
+logger = logging.getLogger(__name__)
+
+# Patient fields written by PIPProcessor.build_patient_record (besides paciente_clave
+# and prescripciones) and their BigQuery type; repeated fields are ARRAY<type>.
+PATIENT_COLUMNS = {
+    "pais": ("STRING", "NULLABLE"),
+    "tipo_documento": ("STRING", "NULLABLE"),
+    "numero_documento": ("STRING", "NULLABLE"),
+    "nombre_paciente": ("STRING", "NULLABLE"),
+    "telefono_contacto": ("STRING", "REPEATED"),
+    "regimen": ("STRING", "NULLABLE"),
+    "ciudad": ("STRING", "NULLABLE"),
+    "direccion": ("STRING", "NULLABLE"),
+    "eps_cruda": ("STRING", "NULLABLE"),
+}
+
+COMPACTION_PROCESS = "pacientes"
+
+
+def _sibling_table(env_name: str, suffix: str) -> str:
+    load_env()
+    table_id = os.getenv(env_name) or f"{os.getenv('TABLE_ID')}_{suffix}"
+    return f"{os.getenv('PROJECT_ID')}.{os.getenv('DATASET_ID')}.{table_id}"
+
+
+def changelog_table_ref() -> str:
+    """
+    Retorna la tabla de cambios (CHANGELOG_TABLE_ID, default `<TABLE_ID>_cambios`).
+    """
+    return _sibling_table("CHANGELOG_TABLE_ID", "cambios")
+
+
+def watermark_table_ref() -> str:
+    """
+    Retorna la tabla de marcas de compactación (WATERMARK_TABLE_ID, default `<TABLE_ID>_compactacion`).
+    """
+    return _sibling_table("WATERMARK_TABLE_ID", "compactacion")
+
+
+def ensure_changelog_tables() -> None:
+    """
+    Crea (si no existen) la tabla de cambios, particionada por día y agrupada
+    por paciente_clave, y la tabla de marcas de compactación.
+    """
+    schema = [
+        bigquery.SchemaField("cambio_id", "STRING", mode="REQUIRED"),
+        bigquery.SchemaField("registrado_en", "TIMESTAMP", mode="REQUIRED"),
+        bigquery.SchemaField("paciente_clave", "STRING", mode="REQUIRED"),
+        bigquery.SchemaField("campos", "STRING", mode="REPEATED"),
+    ] + [bigquery.SchemaField(name, field_type, mode=mode) for name, (field_type, mode) in PATIENT_COLUMNS.items()]
+    changelog = bigquery.Table(changelog_table_ref(), schema=schema)
+    changelog.time_partitioning = bigquery.TimePartitioning(type_=bigquery.TimePartitioningType.DAY, field="registrado_en")
+    changelog.clustering_fields = ["paciente_clave"]
+    get_client().create_table(changelog, exists_ok=True)
+
+    watermark = bigquery.Table(watermark_table_ref(), schema=[
+        bigquery.SchemaField("proceso", "STRING", mode="REQUIRED"),
+        bigquery.SchemaField("marca", "TIMESTAMP", mode="REQUIRED"),
+        bigquery.SchemaField("actualizado", "TIMESTAMP", mode="REQUIRED"),
+    ])
+    get_client().create_table(watermark, exists_ok=True)
+
+
+def change_row(record: Dict, registered_at: str) -> Dict:
+    """
+    Convierte un registro de paciente en una fila de la tabla de cambios.
+
+    `campos` lista los campos que trae el registro, para que la compactación
+    solo sobrescriba esos (igual que el MERGE directo).
+
+    :param record: Registro armado por build_patient_record.
+    :param registered_at: Marca de tiempo ISO del cambio.
+    :return: Fila para insert_rows_json; su cambio_id es determinista.
+    """
+    if "paciente_clave" not in record:
+        raise ValueError("paciente_clave is missing from input and is required for MERGE.")
+    fields = {k: v for k, v in record.items() if k not in ("paciente_clave", "prescripciones")}
+    unknown = set(fields) - set(PATIENT_COLUMNS)
+    if unknown:
+        raise ValueError(f"Campos sin columna en la tabla de cambios: {', '.join(sorted(unknown))}")
+
+    canonical = json.dumps(fields, sort_keys=True, ensure_ascii=False, default=str)
+    change_id = hashlib.sha256(f"{record['paciente_clave']}\0{registered_at}\0{canonical}".encode("utf-8")).hexdigest()
+    return {
+        "cambio_id": change_id,
+        "registrado_en": registered_at,
+        "paciente_clave": record["paciente_clave"],
+        "campos": sorted(fields),
+        **{k: (list(v or []) if PATIENT_COLUMNS[k][1] == "REPEATED" else v) for k, v in fields.items()},
+    }
+
+
+def append_changes(records: List[Dict], batch_size: Optional[int] = None) -> int:
+    """
+    Agrega los registros a la tabla de cambios con inserciones en streaming (sin DML).
+
+    :param records: Registros de pacientes.
+    :param batch_size: Filas por solicitud (BQ_STREAM_BATCH_SIZE, default 500).
+    :return: Número de filas enviadas.
+    """
+    batch_size = batch_size or int(os.getenv("BQ_STREAM_BATCH_SIZE", "500"))
+    registered_at = datetime.now(timezone.utc).isoformat()
+    rows = [change_row(record, registered_at) for record in records]
+
+    table = changelog_table_ref()
+    for start in range(0, len(rows), batch_size):
+        chunk = rows[start:start + batch_size]
+        # Same cambio_id on a retried request, so BigQuery drops the duplicate insert
+        errors = get_client().insert_rows_json(table, chunk, row_ids=[row["cambio_id"] for row in chunk])
+        if errors:
+            raise Exception(f"Error inserting changes: {errors}")
+    return len(rows)
+
+
+class ChangelogPatientStore:
+    """
+    Almacén de pacientes para PIPProcessor en modo changelog (BQ_WRITE_MODE=changelog).
+
+    Los campos del paciente van a la tabla de cambios y las prescripciones a la
+    tabla normalizada, ambas solo con inserciones; compact() lleva los cambios
+    a la tabla de pacientes.
+    """
+
+    def insert_or_update_patient_data(self, paciente: Dict) -> None:
+        self.upsert_patients([paciente])
+
+    def upsert_patients(self, records: List[Dict], batch_size: Optional[int] = None) -> int:
+        append_changes(records, batch_size)
+        append_prescriptions(records, batch_size)
+        return len({record["paciente_clave"] for record in records})
+
+
+def compaction_script() -> str:
+    """
+    Script de compactación: un MERGE de la tabla de cambios sobre la de
+    pacientes y el avance de la marca, en una sola transacción.
+
+    Procesa los cambios con registrado_en en (marca - solapamiento, ahora - retraso].
+    El retraso deja fuera inserciones que todavía pueden llegar con una marca
+    anterior; el solapamiento vuelve a leer cambios ya aplicados, lo que no
+    altera el resultado porque cada campo toma el valor del cambio más
+    reciente de la ventana. Por eso se puede volver a correr sin riesgo.
+
+    :return: Script SQL con parámetros @proceso, @retraso y @solapamiento.
+    """
+    aggregates = ",\n            ".join(
+        f"ARRAY_AGG(IF('{name}' IN UNNEST(campos), STRUCT({name} AS v), NULL) IGNORE NULLS "
+        f"ORDER BY registrado_en DESC LIMIT 1)[SAFE_OFFSET(0)] AS {name}"
+        for name in PATIENT_COLUMNS
+    )
+    updates = ", ".join(
+        f"{name} = IF(source_table.{name} IS NULL, target_table.{name}, source_table.{name}.v)"
+        for name in PATIENT_COLUMNS
+    )
+    columns = ", ".join(["paciente_clave", *PATIENT_COLUMNS])
+    values = ", ".join(["source_table.paciente_clave", *(f"source_table.{name}.v" for name in PATIENT_COLUMNS)])
+
+    return f"""
+    DECLARE desde TIMESTAMP DEFAULT (
+        SELECT IFNULL(MAX(marca), TIMESTAMP '1970-01-01 00:00:00+00') FROM `{watermark_table_ref()}` WHERE proceso = @proceso
+    );
+    DECLARE hasta TIMESTAMP DEFAULT TIMESTAMP_SUB(CURRENT_TIMESTAMP(), INTERVAL @retraso SECOND);
+
+    BEGIN TRANSACTION;
+
+    MERGE `{table_ref()}` AS target_table
+    USING (
+        SELECT
+            paciente_clave,
+            {aggregates}
+        FROM (
+            SELECT * FROM `{changelog_table_ref()}`
+            WHERE registrado_en > TIMESTAMP_SUB(desde, INTERVAL @solapamiento SECOND) AND registrado_en <= hasta
+            QUALIFY ROW_NUMBER() OVER (PARTITION BY cambio_id) = 1
+        )
+        GROUP BY paciente_clave
+    ) AS source_table
+    ON target_table.paciente_clave = source_table.paciente_clave
+    WHEN MATCHED THEN
+        UPDATE SET {updates}
+    WHEN NOT MATCHED BY TARGET THEN
+        INSERT ({columns})
+        VALUES ({values});
+
+    MERGE `{watermark_table_ref()}` AS w
+    USING (SELECT @proceso AS proceso) AS s
+    ON w.proceso = s.proceso
+    WHEN MATCHED THEN
+        UPDATE SET marca = GREATEST(w.marca, hasta), actualizado = CURRENT_TIMESTAMP()
+    WHEN NOT MATCHED THEN
+        INSERT (proceso, marca, actualizado) VALUES (s.proceso, hasta, CURRENT_TIMESTAMP());
+
+    COMMIT TRANSACTION;
+    """
+
+
+def compact(lag_seconds: Optional[int] = None, overlap_seconds: Optional[int] = None) -> None:
+    """
+    Lleva los cambios pendientes a la tabla de pacientes.
+
+    :param lag_seconds: Cambios más recientes que esto esperan a la siguiente
+        corrida (BQ_COMPACTION_LAG_SECONDS, default 120).
+    :param overlap_seconds: Cuánto antes de la marca se vuelve a leer
+        (BQ_COMPACTION_OVERLAP_SECONDS, default 3600).
+    """
+    lag_seconds = lag_seconds if lag_seconds is not None else int(os.getenv("BQ_COMPACTION_LAG_SECONDS", "120"))
+    overlap_seconds = overlap_seconds if overlap_seconds is not None else int(os.getenv("BQ_COMPACTION_OVERLAP_SECONDS", "3600"))
+    job_config = bigquery.QueryJobConfig(query_parameters=[
+        bigquery.ScalarQueryParameter("proceso", "STRING", COMPACTION_PROCESS),
+        bigquery.ScalarQueryParameter("retraso", "INT64", lag_seconds),
+        bigquery.ScalarQueryParameter("solapamiento", "INT64", overlap_seconds),
+    ])
+    try:
+        get_client().query(compaction_script(), job_config=job_config).result()
+    except Exception as e:
+        raise Exception(f"Error during compaction: {e}")
+    logger.info("Compactación de la tabla de cambios terminada")
+
+
+def pending_changes() -> Dict:
+    """
+    Cambios registrados después de la marca y antigüedad de la última compactación.
+
+    :return: {"pendientes": filas, "segundos_desde_compactacion": segundos o None}.
+    """
+    query = f"""
+    WITH marca AS (
+        SELECT MAX(marca) AS marca, MAX(actualizado) AS actualizado
+        FROM `{watermark_table_ref()}` WHERE proceso = @proceso
+    )
+    SELECT
+        (SELECT COUNT(*) FROM `{changelog_table_ref()}`, marca
+         WHERE registrado_en > IFNULL(marca.marca, TIMESTAMP '1970-01-01 00:00:00+00')) AS pendientes,
+        (SELECT TIMESTAMP_DIFF(CURRENT_TIMESTAMP(), actualizado, SECOND) FROM marca) AS segundos
+    """
+    job_config = bigquery.QueryJobConfig(query_parameters=[
+        bigquery.ScalarQueryParameter("proceso", "STRING", COMPACTION_PROCESS),
+    ])
+    row = list(get_client().query(query, job_config=job_config).result())[0]
+    return {"pendientes": row["pendientes"], "segundos_desde_compactacion": row["segundos"]}
+
+
+def maybe_compact(min_rows: Optional[int] = None, max_interval_seconds: Optional[int] = None) -> bool:
+    """
+    Compacta si hay suficientes cambios pendientes o si pasó demasiado tiempo.
+
+    :param min_rows: Cambios pendientes que disparan la compactación (BQ_COMPACTION_MIN_ROWS, default 10000).
+    :param max_interval_seconds: Máximo entre compactaciones (BQ_COMPACTION_INTERVAL_SECONDS, default 900).
+    :return: True si se compactó.
+    """
+    min_rows = min_rows or int(os.getenv("BQ_COMPACTION_MIN_ROWS", "10000"))
+    max_interval_seconds = max_interval_seconds or int(os.getenv("BQ_COMPACTION_INTERVAL_SECONDS", "900"))
+    status = pending_changes()
+    if status["pendientes"] == 0:
+        return False
+    elapsed = status["segundos_desde_compactacion"]
+    if status["pendientes"] >= min_rows or elapsed is None or elapsed >= max_interval_seconds:
+        compact()
+        return True
+    return False
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="Compactación de la tabla de cambios de pacientes.")
+    parser.add_argument("accion", choices=("crear-tablas", "compactar", "estado"))
+    parser.add_argument("--forzar", action="store_true", help="Compactar sin revisar el umbral.")
+    args = parser.parse_args(argv)
+
+    if args.accion == "crear-tablas":
+        ensure_changelog_tables()
+    elif args.accion == "estado":
+        print(json.dumps(pending_changes()))
+    elif args.forzar:
+        compact()
+    else:
+        print("compactado" if maybe_compact() else "sin cambios suficientes")
+    return 0
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    sys.exit(main())
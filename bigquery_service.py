@@ -1,120 +1,570 @@
 import os
-from typing import Dict
-from google.cloud import bigquery
-from dotenv import load_dotenv
-from google.oauth2 import service_account
+import sys
+import json
+import hashlib
+import threading
+from datetime import datetime, timezone
+from typing import Callable, Dict, List, Optional
 
+from startup import LazyModule, load_env
 
-load_dotenv()
+# The SDK is imported on first use and the client built on first query,
+# so importing this module does no credential discovery.
+bigquery = LazyModule("google.cloud.bigquery")
 
-PROJECT_ID = os.getenv("PROJECT_ID")
-DATASET_ID = os.getenv("DATASET_ID")
-TABLE_ID = os.getenv("TABLE_ID")
+client = None
+_client_lock = threading.Lock()
+# Whether this process already brought the nested column up to PRESCRIPTION_COLUMNS
+_nested_fields_checked = False
+_nested_fields_lock = threading.Lock()
+
+# Fields of each prescripción as written by PIPProcessor.build_patient_record, in
+# column order. "medicamentos" is an ARRAY<STRUCT<MEDICATION_FIELDS>> and the rest
+# are STRING. The same STRUCT is the element of the nested `prescripciones` column,
+# the row of the normalized table and what the view rebuilds.
+PRESCRIPTION_COLUMNS = (
+    "id_session", "url_prescripcion", "categoria_riesgo", "diagnostico", "IPS", "medicamentos", "version_prompt"
+)
+MEDICATION_FIELDS = ("nombre", "dosis", "cantidad")
+PROMPT_VERSION_COLUMN = "version_prompt"
+
+# Existing prescriptions plus the new ones, without repeats and in arrival order.
+# SELECT DISTINCT is not allowed on a STRUCT that contains an ARRAY (medicamentos),
+# so rows are grouped by their JSON text instead.
+MERGE_PRESCRIPTIONS_SQL = (
+    "ARRAY(SELECT ANY_VALUE(x) "
+    "FROM UNNEST(ARRAY_CONCAT(target_table.prescripciones, source_table.prescripciones)) AS x WITH OFFSET AS o "
+    "GROUP BY TO_JSON_STRING(x) ORDER BY MIN(o))"
+)
+
+
+def get_client():
+    """
+    Retorna el cliente de BigQuery del proceso, creándolo en el primer uso.
+
+    :return: Instancia de bigquery.Client.
+    """
+    global client
+    if client is None:
+        with _client_lock:
+            if client is None:
+                load_env()
+                client = bigquery.Client()
+    return client
+
+
+def reset_client() -> None:
+    """
+    Descarta el cliente cacheado (p. ej. en tests o tras cambiar credenciales).
+    """
+    global client, _nested_fields_checked
+    with _client_lock:
+        client = None
+    with _nested_fields_lock:
+        _nested_fields_checked = False
+
+
+def table_ref() -> str:
+    """
+    Retorna la tabla de pacientes `proyecto.dataset.tabla`.
+
+    Se lee del entorno en cada llamada para respetar el .env cargado en el arranque.
+    """
+    load_env()
+    return f"{os.getenv('PROJECT_ID')}.{os.getenv('DATASET_ID')}.{os.getenv('TABLE_ID')}"
+
+
+def _scalar_type(value) -> str:
+    """
+    Retorna el tipo de BigQuery para un valor escalar de Python.
+
+    :param value: Valor del campo.
+    :return: Nombre del tipo (STRING por defecto).
+    """
+    # bool is checked first because it is a subclass of int
+    if isinstance(value, bool):
+        return "BOOL"
+    if isinstance(value, int):
+        return "INT64"
+    if isinstance(value, float):
+        return "FLOAT64"
+    # Add other type checks if necessary (e.g., for DATE, TIMESTAMP)
+    return "STRING"
+
+
+def prescription_schema_fields() -> List:
+    """
+    Campos de BigQuery de una prescripción (PRESCRIPTION_COLUMNS), tanto para
+    la columna anidada `prescripciones` como para la tabla normalizada.
+
+    :return: Lista de bigquery.SchemaField.
+    """
+    return [
+        bigquery.SchemaField(column, "RECORD", mode="REPEATED", fields=[
+            bigquery.SchemaField(field, "STRING") for field in MEDICATION_FIELDS
+        ]) if column == "medicamentos" else bigquery.SchemaField(column, "STRING")
+        for column in PRESCRIPTION_COLUMNS
+    ]
+
+
+def prescription_sql_type() -> str:
+    """
+    Tipo SQL del STRUCT de una prescripción, p. ej.
+    `STRUCT<id_session STRING, ..., medicamentos ARRAY<STRUCT<nombre STRING, ...>>, ...>`.
+
+    :return: Tipo para un constructor STRUCT<...>(...) con tipo explícito.
+    """
+    medication = ", ".join(f"{field} STRING" for field in MEDICATION_FIELDS)
+    fields = [
+        f"{column} ARRAY<STRUCT<{medication}>>" if column == "medicamentos" else f"{column} STRING"
+        for column in PRESCRIPTION_COLUMNS
+    ]
+    return f"STRUCT<{', '.join(fields)}>"
+
+
+def _medication_param_type():
+    return bigquery.StructQueryParameterType(
+        *[bigquery.ScalarQueryParameterType("STRING", name=field) for field in MEDICATION_FIELDS]
+    )
+
+
+def prescription_param_type():
+    """
+    Tipo de parámetro del STRUCT de una prescripción, con `medicamentos` como
+    ARRAY<STRUCT> anidado.
+
+    :return: bigquery.StructQueryParameterType.
+    """
+    return bigquery.StructQueryParameterType(*[
+        bigquery.ArrayQueryParameterType(_medication_param_type(), name=column) if column == "medicamentos"
+        else bigquery.ScalarQueryParameterType("STRING", name=column)
+        for column in PRESCRIPTION_COLUMNS
+    ])
+
+
+def project_prescription(prescripcion: Dict) -> Dict:
+    """
+    Prescripción tal como queda en BigQuery: exactamente los campos de
+    PRESCRIPTION_COLUMNS (y MEDICATION_FIELDS en cada medicamento), con NULL
+    en los que falten; los demás campos se descartan.
+
+    :param prescripcion: Prescripción tal como la arma build_patient_record.
+    :return: Diccionario con las columnas en orden.
+    """
+    projected = {column: prescripcion.get(column) for column in PRESCRIPTION_COLUMNS}
+    projected["medicamentos"] = [
+        {field: medicamento.get(field) for field in MEDICATION_FIELDS}
+        for medicamento in projected["medicamentos"] or []
+    ]
+    return projected
+
+
+def prescription_param(prescripcion: Dict):
+    """
+    Convierte una prescripción de build_patient_record en un parámetro STRUCT
+    con la proyección de project_prescription.
+
+    :param prescripcion: Prescripción tal como la arma build_patient_record.
+    :return: bigquery.StructQueryParameter sin nombre (elemento de un arreglo).
+    """
+    fields = []
+    for column, value in project_prescription(prescripcion).items():
+        if column == "medicamentos":
+            fields.append(bigquery.ArrayQueryParameter(column, _medication_param_type(), [
+                bigquery.StructQueryParameter(
+                    None, *[bigquery.ScalarQueryParameter(field, "STRING", field_value)
+                            for field, field_value in medicamento.items()]
+                )
+                for medicamento in value
+            ]))
+        else:
+            fields.append(bigquery.ScalarQueryParameter(column, "STRING", value))
+    return bigquery.StructQueryParameter(None, *fields)
 
-client = bigquery.Client()
 
 def insert_or_update_patient_data(paciente: Dict):
     """
     Inserta o actualiza un paciente y su prescripción en BigQuery.
 
+    Es un upsert_patients de un solo registro.
+
     :param paciente: Diccionario con la estructura del paciente.
     """
+    upsert_patients([paciente])
+
+
+def _coalesce_patients(records: List[Dict]) -> List[Dict]:
     """
-    table_ref_str = f"{PROJECT_ID}.{DATASET_ID}.{TABLE_ID}"
+    Une los registros que comparten paciente_clave dentro de un mismo lote.
 
-    # Dynamically build query components
-    update_set_clauses = []
-    insert_columns = []
-    insert_values_placeholders = []
-    query_params = []
-
-    # Define schema for prescriptions struct (used for query parameter)
-    # This should match the BigQuery table schema for the prescripciones column
-    prescription_struct_type = bigquery.StructType(
-        [
-            bigquery.SchemaField("medicamento", "STRING"),
-            bigquery.SchemaField("dosis", "STRING"),
-            bigquery.SchemaField("fecha", "STRING"), 
-            # Assuming DATE stored as STRING, adjust if actual BQ type is DATE
-        ]
-    )
+    Los campos escalares toman el último valor recibido y las prescripciones se
+    concatenan en orden de llegada, igual que si se hubieran aplicado los MERGE
+    uno por uno.
 
-    # Ensure paciente_clave is the first parameter for the USING clause
-    if "paciente_clave" not in paciente:
-        raise ValueError("paciente_clave is missing from input and is required for MERGE.")
-    
-    # Add paciente_clave parameter first (important for USING clause if referenced by name like @paciente_clave)
-    # Although the USING clause here uses a fixed name K_paciente_clave for clarity.
-    query_params.append(bigquery.ScalarQueryParameter("paciente_clave", "STRING", paciente["paciente_clave"]))
-
-    for key, value in paciente.items():
-        # Add all keys to insert columns and value placeholders
-        insert_columns.append(key)
-        insert_values_placeholders.append(f"@{key}") # Use @key for all value placeholders
-
-        if key == "paciente_clave":
-            # Already added to query_params, not added to update_set_clauses
-            pass
-        elif key == "prescripciones":
-            # For UPDATE: ARRAY_CONCAT existing with new, then select distinct
-            update_set_clauses.append(f"prescripciones = ARRAY(SELECT DISTINCT x FROM UNNEST(ARRAY_CONCAT(target_table.prescripciones, @{key})) x)")
-            
-            prescriptions_data = []
-            if isinstance(value, list): # Ensure value is a list
-                prescriptions_data = [
-                    # Ensure order matches StructType definition
-                    (p.get("medicamento"), p.get("dosis"), p.get("fecha")) for p in value
-                ]
-            
-            query_params.append(
-                bigquery.ArrayQueryParameter(
-                    key, # param name "prescripciones"
-                    prescription_struct_type, # param type for array elements (StructType object)
-                    prescriptions_data # data for the array (list of tuples)
-                )
-            )
+    :param records: Registros de pacientes.
+    :return: Un registro por paciente_clave, en orden de primera aparición.
+    """
+    merged: Dict[str, Dict] = {}
+    for record in records:
+        if "paciente_clave" not in record:
+            raise ValueError("paciente_clave is missing from input and is required for MERGE.")
+        current = merged.setdefault(record["paciente_clave"], {})
+        for key, value in record.items():
+            if key == "prescripciones":
+                current[key] = current.get(key, []) + list(value or [])
+            else:
+                current[key] = value
+    return list(merged.values())
+
+
+def _column_param(name: str, values: List) -> Callable:
+    """
+    Construye el tipo de una columna del lote y retorna una fábrica de parámetros.
+
+    El tipo se infiere del primer valor no nulo para que todos los STRUCT del
+    arreglo tengan exactamente los mismos tipos.
+
+    :param name: Nombre de la columna.
+    :param values: Valores de la columna en todos los registros del lote.
+    :return: Función valor -> parámetro de BigQuery para esa columna.
+    """
+    if name == "prescripciones":
+        struct_type = prescription_param_type()
+        return lambda value: bigquery.ArrayQueryParameter(name, struct_type, [prescription_param(p) for p in value or []])
+
+    sample = next((v for v in values if v is not None), None)
+    if isinstance(sample, list):
+        element_type = _scalar_type(next((x for v in values if v for x in v), ""))
+        return lambda value: bigquery.ArrayQueryParameter(name, element_type, list(value or []))
+
+    param_type = _scalar_type(sample)
+    return lambda value: bigquery.ScalarQueryParameter(name, param_type, value)
+
+
+def _build_bulk_merge(records: List[Dict], columns: List[str]):
+    """
+    Construye el MERGE de un lote cuyos registros tienen las mismas columnas.
+
+    :param records: Registros ya unidos por paciente_clave.
+    :param columns: Columnas comunes a todos los registros.
+    :return: Tupla (query, job_config).
+    """
+    table_ref_str = table_ref()
+
+    builders = {column: _column_param(column, [r.get(column) for r in records]) for column in columns}
+    rows = [
+        bigquery.StructQueryParameter(None, *[builders[column](record.get(column)) for column in columns])
+        for record in records
+    ]
+
+    update_set_clauses = []
+    for column in columns:
+        if column == "paciente_clave":
+            continue
+        if column == "prescripciones":
+            update_set_clauses.append(f"prescripciones = {MERGE_PRESCRIPTIONS_SQL}")
         else:
-            # For other fields, add to UPDATE SET clause and create ScalarQueryParameter
-            param_type = "STRING"  # Default to STRING
-            if isinstance(value, bool):
-                param_type = "BOOL"
-            elif isinstance(value, int):
-                param_type = "INT64"
-            elif isinstance(value, float):
-                param_type = "FLOAT64"
-            # Add other type checks if necessary (e.g., for DATE, TIMESTAMP)
-            # For example, if 'fecha' fields in patient root were DATE:
-            # elif isinstance(value, datetime.date):
-            #     param_type = "DATE"
-            
-            update_set_clauses.append(f"{key} = @{key}")
-            # Add to query_params if not already added (e.g. if patient_clave was not handled first)
-            # However, with current loop structure, all non-clave, non-prescripcion items will be added here.
-            if not any(p.name == key for p in query_params): # Avoid re-adding paciente_clave if loop order changes
-                 query_params.append(bigquery.ScalarQueryParameter(key, param_type, value))
-
-
-    # Construct the MERGE query
-    # Using a fixed alias K_paciente_clave for the source key to avoid issues if a field is also named 'K'
+            update_set_clauses.append(f"{column} = source_table.{column}")
+
+    when_matched = ""
+    if update_set_clauses:
+        when_matched = f"""
+    WHEN MATCHED THEN
+        UPDATE SET {', '.join(update_set_clauses)}"""
+
     merge_query = f"""
     MERGE `{table_ref_str}` AS target_table
-    USING (SELECT @paciente_clave AS K_paciente_clave) AS source_table
-    ON target_table.paciente_clave = source_table.K_paciente_clave
-    WHEN MATCHED THEN
-        UPDATE SET {', '.join(update_set_clauses)}
+    USING (SELECT * FROM UNNEST(@registros)) AS source_table
+    ON target_table.paciente_clave = source_table.paciente_clave{when_matched}
     WHEN NOT MATCHED BY TARGET THEN
-        INSERT ({', '.join(insert_columns)})
-        VALUES ({', '.join(insert_values_placeholders)})
+        INSERT ({', '.join(columns)})
+        VALUES ({', '.join(f'source_table.{column}' for column in columns)})
+    """
+
+    job_config = bigquery.QueryJobConfig(
+        query_parameters=[bigquery.ArrayQueryParameter("registros", "STRUCT", rows)]
+    )
+    return merge_query, job_config
+
+
+def upsert_patients(records: List[Dict], batch_size: Optional[int] = None) -> int:
+    """
+    Inserta o actualiza muchos pacientes con un solo MERGE por lote.
+
+    Mantiene la semántica de insert_or_update_patient_data: los campos enviados
+    se sobrescriben y las prescripciones se concatenan sin repetidas. Los
+    registros con el mismo paciente_clave se unen antes de enviarse, porque un
+    MERGE falla si dos filas de origen coinciden con la misma fila destino.
+    Antes del primer MERGE con prescripciones del proceso, la columna anidada
+    recibe los campos de PRESCRIPTION_COLUMNS que le falten
+    (ensure_nested_prescription_fields).
+
+    :param records: Lista de diccionarios con la estructura del paciente.
+    :param batch_size: Pacientes por MERGE (BQ_UPSERT_BATCH_SIZE, default 500).
+    :return: Número de pacientes distintos enviados a BigQuery.
+    """
+    # Maximum number of patients sent in a single MERGE (array-of-struct parameter)
+    batch_size = batch_size or int(os.getenv("BQ_UPSERT_BATCH_SIZE", "500"))
+    patients = _coalesce_patients(records)
+    if any("prescripciones" in patient for patient in patients):
+        _ensure_nested_fields_once()
+
+    # Records with different column sets cannot share one UNNEST source,
+    # so each distinct set of columns gets its own MERGE.
+    groups: Dict[tuple, List[Dict]] = {}
+    for patient in patients:
+        groups.setdefault(tuple(patient.keys()), []).append(patient)
+
+    for columns, group in groups.items():
+        for start in range(0, len(group), batch_size):
+            merge_query, job_config = _build_bulk_merge(group[start:start + batch_size], list(columns))
+            try:
+                get_client().query(merge_query, job_config=job_config).result()
+            except Exception as e:
+                raise Exception(f"Error during MERGE operation: {e}")
+
+    return len(patients)
+
+
+WRITE_MODES = ("anidado", "normalizado", "changelog")
+
+
+def prescriptions_table_ref() -> str:
+    """
+    Retorna la tabla normalizada de prescripciones (PRESCRIPTIONS_TABLE_ID,
+    default `<TABLE_ID>_prescripciones`).
     """
+    load_env()
+    table_id = os.getenv("PRESCRIPTIONS_TABLE_ID") or f"{os.getenv('TABLE_ID')}_prescripciones"
+    return f"{os.getenv('PROJECT_ID')}.{os.getenv('DATASET_ID')}.{table_id}"
 
-    job_config = bigquery.QueryJobConfig(query_parameters=query_params)
 
-    try:
-        # Execute the query and wait for completion
-        client.query(merge_query, job_config=job_config).result()
-    except Exception as e:
-        # For debugging, it can be helpful to print the generated query and parameters
-        # detailed_params = [(p.name, p.value, p.parameter_type.type if hasattr(p.parameter_type, 'type') else p.parameter_type) for p in query_params]
-        # print(f"Generated MERGE query:\n{merge_query}")
-        # print(f"Query parameters:\n{detailed_params}")
-        raise Exception(f"Error during MERGE operation: {e}")
+def patients_view_ref() -> str:
+    """
+    Retorna la vista que reconstruye la forma anidada (PATIENTS_VIEW_ID,
+    default `<TABLE_ID>_vista`).
+    """
+    load_env()
+    view_id = os.getenv("PATIENTS_VIEW_ID") or f"{os.getenv('TABLE_ID')}_vista"
+    return f"{os.getenv('PROJECT_ID')}.{os.getenv('DATASET_ID')}.{view_id}"
+
+
+def prescription_id(paciente_clave: str, prescripcion: Dict) -> str:
+    """
+    ID determinista de una prescripción.
+
+    Dos prescripciones con el mismo contenido para el mismo paciente tienen el
+    mismo ID, que es lo que hace la deduplicación del MERGE anidado.
+
+    :param paciente_clave: Llave del paciente.
+    :param prescripcion: Prescripción tal como la arma build_patient_record.
+    :return: SHA-256 hexadecimal.
+    """
+    canonical = json.dumps(prescripcion, sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.sha256(f"{paciente_clave}\0{canonical}".encode("utf-8")).hexdigest()
+
+
+def ensure_prescriptions_table():
+    """
+    Crea (si no existe) la tabla normalizada de prescripciones, particionada
+    por día de ingesta y agrupada por paciente_clave, y le agrega la columna
+    version_prompt si es anterior a ella.
+
+    :return: La tabla de BigQuery.
+    """
+    schema = [
+        bigquery.SchemaField("prescription_id", "STRING", mode="REQUIRED"),
+        bigquery.SchemaField("paciente_clave", "STRING", mode="REQUIRED"),
+        bigquery.SchemaField("ingestado_en", "TIMESTAMP", mode="REQUIRED"),
+        *prescription_schema_fields(),
+    ]
+    table = bigquery.Table(prescriptions_table_ref(), schema=schema)
+    table.time_partitioning = bigquery.TimePartitioning(type_=bigquery.TimePartitioningType.DAY, field="ingestado_en")
+    table.clustering_fields = ["paciente_clave"]
+    table = get_client().create_table(table, exists_ok=True)
+    # Tables created before the column existed get it added (nullable, so old rows are NULL)
+    if all(field.name != PROMPT_VERSION_COLUMN for field in table.schema):
+        table.schema = [*table.schema, bigquery.SchemaField(PROMPT_VERSION_COLUMN, "STRING")]
+        table = get_client().update_table(table, ["schema"])
+    return table
+
+
+def ensure_nested_prescription_fields():
+    """
+    Agrega a la columna anidada `prescripciones` de la tabla de pacientes los
+    campos de PRESCRIPTION_COLUMNS que le falten (p. ej. version_prompt), para
+    que el MERGE y la vista usen el mismo STRUCT que la tabla normalizada.
+
+    :return: La tabla de BigQuery.
+    """
+    table = get_client().get_table(table_ref())
+    schema, changed = [], False
+    for field in table.schema:
+        if field.name == "prescripciones":
+            existing = {sub.name for sub in field.fields}
+            missing = [sub for sub in prescription_schema_fields() if sub.name not in existing]
+            if missing:
+                field = bigquery.SchemaField(field.name, field.field_type, mode=field.mode, fields=[*field.fields, *missing])
+                changed = True
+        schema.append(field)
+    if changed:
+        table.schema = schema
+        table = get_client().update_table(table, ["schema"])
+    return table
+
+
+def _ensure_nested_fields_once() -> None:
+    # Tables whose nested column predates a prescription field (e.g. version_prompt)
+    # would reject the MERGE's STRUCT, so the column is completed before the first one
+    global _nested_fields_checked
+    if _nested_fields_checked:
+        return
+    with _nested_fields_lock:
+        if not _nested_fields_checked:
+            try:
+                ensure_nested_prescription_fields()
+            except Exception as e:
+                raise Exception(f"Error updating the prescripciones column: {e}")
+            _nested_fields_checked = True
+
+
+def patients_view_query() -> str:
+    """
+    SQL de la vista con la forma anidada de siempre.
+
+    Une las prescripciones que aún estén en la columna anidada (datos
+    anteriores al modo normalizado) con las de la tabla normalizada, quitando
+    duplicados por prescription_id. Las dos partes se arman con el mismo
+    STRUCT explícito (prescription_sql_type), así ARRAY_CONCAT siempre recibe
+    arreglos del mismo tipo.
+
+    :return: Query de la vista.
+    """
+    struct_type = prescription_sql_type()
+    columns = ", ".join(PRESCRIPTION_COLUMNS)
+    nested_columns = ", ".join(f"x.{column}" for column in PRESCRIPTION_COLUMNS)
+    return f"""
+    WITH recetas AS (
+        SELECT * EXCEPT (fila)
+        FROM (
+            SELECT r.*, ROW_NUMBER() OVER (PARTITION BY prescription_id ORDER BY ingestado_en) AS fila
+            FROM `{prescriptions_table_ref()}` AS r
+        )
+        WHERE fila = 1
+    ),
+    por_paciente AS (
+        SELECT paciente_clave, ARRAY_AGG({struct_type}({columns}) ORDER BY ingestado_en) AS prescripciones
+        FROM recetas
+        GROUP BY paciente_clave
+    )
+    SELECT
+        p.* EXCEPT (prescripciones),
+        ARRAY_CONCAT(
+            ARRAY(SELECT {struct_type}({nested_columns}) FROM UNNEST(p.prescripciones) AS x WITH OFFSET AS o ORDER BY o),
+            IFNULL(r.prescripciones, [])
+        ) AS prescripciones
+    FROM `{table_ref()}` AS p
+    LEFT JOIN por_paciente AS r USING (paciente_clave)
+    """
+
+
+def create_patients_view() -> None:
+    """
+    Crea o reemplaza la vista que reconstruye `prescripciones` para los
+    lectores existentes, completando antes los campos de la columna anidada.
+    """
+    ensure_nested_prescription_fields()
+    get_client().query(f"CREATE OR REPLACE VIEW `{patients_view_ref()}` AS {patients_view_query()}").result()
+
+
+def append_prescriptions(records: List[Dict], batch_size: Optional[int] = None) -> int:
+    """
+    Agrega las prescripciones de los registros a la tabla normalizada (solo inserta).
+
+    Cada prescripción se proyecta con project_prescription antes de armar la
+    fila y calcular su ID. Usa inserciones en streaming con prescription_id
+    como insertId, así un reintento inmediato no duplica filas; los duplicados
+    que pasen igual los descarta la vista.
+
+    :param records: Registros de pacientes con su lista `prescripciones`.
+    :param batch_size: Filas por solicitud (BQ_STREAM_BATCH_SIZE, default 500).
+    :return: Número de prescripciones enviadas.
+    """
+    batch_size = batch_size or int(os.getenv("BQ_STREAM_BATCH_SIZE", "500"))
+    ingested_at = datetime.now(timezone.utc).isoformat()
+    rows, row_ids = [], []
+    for record in records:
+        if "paciente_clave" not in record:
+            raise ValueError("paciente_clave is missing from input and is required for MERGE.")
+        for prescripcion in record.get("prescripciones") or []:
+            # Same projection as the nested column, so extra keys never reach
+            # insert_rows_json and the id only covers stored fields
+            projected = project_prescription(prescripcion)
+            row_id = prescription_id(record["paciente_clave"], projected)
+            rows.append({
+                "prescription_id": row_id,
+                "paciente_clave": record["paciente_clave"],
+                "ingestado_en": ingested_at,
+                **projected,
+            })
+            row_ids.append(row_id)
+
+    table = prescriptions_table_ref()
+    for start in range(0, len(rows), batch_size):
+        errors = get_client().insert_rows_json(
+            table, rows[start:start + batch_size], row_ids=row_ids[start:start + batch_size]
+        )
+        if errors:
+            raise Exception(f"Error inserting prescriptions: {errors}")
+    return len(rows)
+
+
+def upsert_patients_normalized(records: List[Dict], batch_size: Optional[int] = None) -> int:
+    """
+    Guarda pacientes en modo normalizado: el MERGE de la tabla de pacientes
+    solo lleva los campos del paciente y las prescripciones se agregan a la
+    tabla normalizada.
+
+    :param records: Lista de diccionarios con la estructura del paciente.
+    :param batch_size: Pacientes por MERGE (BQ_UPSERT_BATCH_SIZE, default 500).
+    :return: Número de pacientes distintos enviados a BigQuery.
+    """
+    # Patient first: a retry after a failed append re-sends ids the view already dedupes
+    patients = upsert_patients(
+        [{k: v for k, v in record.items() if k != "prescripciones"} for record in records], batch_size
+    )
+    append_prescriptions(records)
+    return patients
+
+
+class NormalizedPatientStore:
+    """
+    Almacén de pacientes para PIPProcessor en modo normalizado (BQ_WRITE_MODE=normalizado).
+    """
+
+    def insert_or_update_patient_data(self, paciente: Dict) -> None:
+        upsert_patients_normalized([paciente])
+
+    def upsert_patients(self, records: List[Dict], batch_size: Optional[int] = None) -> int:
+        return upsert_patients_normalized(records, batch_size)
+
+
+def get_patient_store(mode: Optional[str] = None):
+    """
+    Retorna el almacén de pacientes del modo de escritura configurado.
+
+    :param mode: "anidado" (MERGE sobre la columna prescripciones, el de
+        siempre), "normalizado" o "changelog" (BQ_WRITE_MODE, default anidado).
+    :return: Objeto con insert_or_update_patient_data y upsert_patients.
+    """
+    load_env()
+    mode = mode or os.getenv("BQ_WRITE_MODE", "anidado")
+    if mode == "normalizado":
+        return NormalizedPatientStore()
+    if mode == "changelog":
+        # Imported here: bigquery_changelog builds on this module
+        from bigquery_changelog import ChangelogPatientStore
+        return ChangelogPatientStore()
+    if mode != "anidado":
+        raise ValueError(f"BQ_WRITE_MODE inválido: {mode} (opciones: {', '.join(WRITE_MODES)})")
+    return sys.modules[__name__]
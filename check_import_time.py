@@ -0,0 +1,84 @@
+import os
+import sys
+import argparse
+import subprocess
+from typing import Dict, List, Tuple
+
+
+# Modules that must not be imported just by importing the processor
+HEAVY_MODULES = (
+    "google.cloud.bigquery",
+    "google.cloud.storage",
+    "google.auth",
+    "requests",
+    "dotenv",
+    "PIL",
+)
+
+
+def measure_import(module: str) -> Tuple[int, List[Tuple[str, int, int]]]:
+    """
+    Importa un módulo en un proceso nuevo con `python -X importtime`.
+
+    :param module: Módulo a importar (p. ej. pip_processor).
+    :return: Tupla (microsegundos acumulados del módulo, filas (nombre, self_us, cumulative_us)).
+    """
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        cwd=os.path.dirname(os.path.abspath(__file__)),
+        capture_output=True,
+        text=True,
+    )
+    if result.returncode != 0:
+        raise RuntimeError(f"No se pudo importar {module}:\n{result.stderr}")
+
+    rows = []
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:"):].split("|", 2)
+        rows.append((name.strip(), int(self_us), int(cumulative_us)))
+
+    total = next((cumulative for name, _, cumulative in rows if name == module), 0)
+    return total, rows
+
+
+def heavy_imports(rows: List[Tuple[str, int, int]]) -> Dict[str, int]:
+    """
+    Filtra los módulos pesados que aparecieron en la medición.
+
+    :param rows: Filas retornadas por measure_import.
+    :return: Diccionario módulo -> microsegundos acumulados.
+    """
+    return {
+        name: cumulative
+        for name, _, cumulative in rows
+        if any(name == heavy or name.startswith(heavy + ".") for heavy in HEAVY_MODULES)
+    }
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Mide el tiempo de import (arranque en frío) del procesador PIP.")
+    parser.add_argument("module", nargs="?", default="pip_processor")
+    parser.add_argument("--budget-ms", type=float, default=float(os.getenv("PIP_IMPORT_BUDGET_MS", "300")))
+    parser.add_argument("--top", type=int, default=10)
+    args = parser.parse_args()
+
+    total, rows = measure_import(args.module)
+    print(f"import {args.module}: {total / 1000:.1f} ms")
+    for name, _, cumulative in sorted(rows, key=lambda row: row[2], reverse=True)[:args.top]:
+        print(f"  {cumulative / 1000:8.1f} ms  {name}")
+
+    failed = False
+    heavy = heavy_imports(rows)
+    if heavy:
+        print(f"ERROR: módulos pesados importados al arrancar: {', '.join(sorted(heavy))}")
+        failed = True
+    if total / 1000 > args.budget_ms:
+        print(f"ERROR: el import supera el presupuesto de {args.budget_ms:.0f} ms")
+        failed = True
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
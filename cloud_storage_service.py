@@ -1,28 +1,297 @@
 import os
-from google.cloud import storage
-from uuid import uuid4
-from google.oauth2 import service_account
+import hashlib
+import mimetypes
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, NamedTuple, Optional, Union
 
+from startup import LazyModule, load_env
 
+# Imported on first upload so the SDK does not slow down cold starts
+storage = LazyModule("google.cloud.storage")
+service_account = LazyModule("google.oauth2.service_account")
+api_exceptions = LazyModule("google.api_core.exceptions")
 
-def upload_image_to_bucket(bucket_name: str, image_path: str) -> str:
+
+# GCS requires resumable chunk sizes to be a multiple of 256 KB
+CHUNK_MULTIPLE = 256 * 1024
+
+
+class UploadResult(NamedTuple):
+    """
+    Resultado de una subida a Cloud Storage.
+    """
+    uri: str
+    blob_name: str
+    created: bool
+    size: int
+    generation: Optional[int] = None
+
+
+class GCSUploader:
+    """
+    Subidor de imágenes a Cloud Storage con cliente reutilizable.
+
+    Las credenciales y el `storage.Client` se crean una sola vez. Los blobs se
+    nombran por el SHA-256 del contenido, así que una imagen reenviada no se
+    vuelve a subir. Los archivos grandes se suben en partes (resumable).
+
+    Como varias prescripciones pueden apuntar al mismo blob, una subida que
+    reutiliza un blob mientras una subida especulativa del mismo contenido
+    sigue pendiente (ver upload con speculative=True) lo marca en sus
+    metadatos, lo que sube su metageneration; discard solo lo retira si nadie
+    lo marcó desde que se creó. Las subidas pendientes se registran en este
+    uploader, así que la marca cubre reusos desde el mismo proceso, y los
+    demás reusos no cuestan llamadas extra.
+    """
+
+    def __init__(
+        self,
+        bucket_name: str,
+        prefix: str = "prescripciones",
+        credentials_path: Optional[str] = None,
+        chunk_size: Optional[int] = None,
+        resumable_threshold: Optional[int] = None,
+        max_workers: Optional[int] = None,
+        bucket=None,
+    ):
+        """
+        :param bucket_name: Nombre del bucket de GCS.
+        :param prefix: Carpeta dentro del bucket.
+        :param credentials_path: JSON de la cuenta de servicio (GOOGLE_APPLICATION_CREDENTIALS).
+        :param chunk_size: Tamaño de cada parte en subidas resumables (GCS_CHUNK_SIZE, default 8 MB).
+        :param resumable_threshold: Tamaño desde el cual se sube en partes (GCS_RESUMABLE_THRESHOLD, default 8 MB).
+        :param max_workers: Subidas concurrentes en upload_many (GCS_UPLOAD_WORKERS, default 8).
+        :param bucket: Bucket ya construido (p. ej. el doble local de offline_fakes);
+            si se pasa no se crea ningún cliente.
+        """
+        self.bucket_name = bucket_name
+        self.prefix = prefix
+        self.credentials_path = credentials_path or os.getenv("GOOGLE_APPLICATION_CREDENTIALS")
+        chunk_size = chunk_size or int(os.getenv("GCS_CHUNK_SIZE", str(8 * 1024 * 1024)))
+        self.chunk_size = max(CHUNK_MULTIPLE, chunk_size - chunk_size % CHUNK_MULTIPLE)
+        self.resumable_threshold = resumable_threshold or int(os.getenv("GCS_RESUMABLE_THRESHOLD", str(8 * 1024 * 1024)))
+        self.max_workers = max_workers or int(os.getenv("GCS_UPLOAD_WORKERS", "8"))
+        self._client = None
+        self._bucket = bucket
+        self._lock = threading.Lock()
+        # Blob name -> speculative uploads of it not yet settled or discarded
+        self._pending: Dict[str, int] = {}
+        self._pending_lock = threading.Lock()
+
+    @property
+    def bucket(self) -> "storage.Bucket":
+        """
+        Bucket de GCS; el cliente se crea en el primer uso y se reutiliza.
+        """
+        if self._bucket is None:
+            with self._lock:
+                if self._bucket is None:
+                    load_env()
+                    self.credentials_path = self.credentials_path or os.getenv("GOOGLE_APPLICATION_CREDENTIALS")
+                    if self.credentials_path:
+                        credentials = service_account.Credentials.from_service_account_file(self.credentials_path)
+                        self._client = storage.Client(credentials=credentials)
+                    else:
+                        self._client = storage.Client()
+                    self._bucket = self._client.bucket(self.bucket_name)
+        return self._bucket
+
+    def blob_name_for(self, digest: str, image_path: str, content_type: Optional[str] = None) -> str:
+        """
+        Construye el nombre del blob a partir del hash del contenido.
+
+        :param digest: SHA-256 hexadecimal del contenido.
+        :param image_path: Ruta original (para la extensión si no hay content_type).
+        :param content_type: Tipo MIME del contenido.
+        :return: Nombre del blob dentro del bucket.
+        """
+        extension = mimetypes.guess_extension(content_type) if content_type else None
+        if not extension:
+            extension = os.path.splitext(image_path)[1].lower()
+        return f"{self.prefix}/{digest}{extension}"
+
+    def upload(
+        self,
+        image_path: str,
+        data: Optional[bytes] = None,
+        content_type: Optional[str] = None,
+        speculative: bool = False,
+    ) -> UploadResult:
+        """
+        Sube una imagen si su contenido todavía no está en el bucket.
+
+        :param image_path: Ruta local del archivo de imagen.
+        :param data: Bytes a subir en lugar del archivo.
+        :param content_type: Tipo MIME del contenido.
+        :param speculative: La subida puede descartarse después; si crea el
+            blob, queda pendiente hasta settle o discard.
+        :return: UploadResult; created es False si el blob ya existía.
+        """
+        digest = hashlib.sha256()
+        if data is not None:
+            digest.update(data)
+            size = len(data)
+        else:
+            with open(image_path, "rb") as f:
+                for chunk in iter(lambda: f.read(1024 * 1024), b""):
+                    digest.update(chunk)
+            size = os.path.getsize(image_path)
+        content_type = content_type or mimetypes.guess_type(image_path)[0]
+
+        blob_name = self.blob_name_for(digest.hexdigest(), image_path, content_type)
+        uri = f"gs://{self.bucket_name}/{blob_name}"
+        chunk_size = self.chunk_size if size > self.resumable_threshold else None
+        blob = self.bucket.blob(blob_name, chunk_size=chunk_size)
+
+        # Checked before exists(): a discard only leaves the registry once its
+        # delete is done, so an unregistered blob that exists can be kept as is
+        with self._pending_lock:
+            shared = self._pending.get(blob_name, 0) > 0
+            if speculative:
+                self._pending[blob_name] = self._pending.get(blob_name, 0) + 1
+        created = False
+        try:
+            if blob.exists() and (not shared or self._mark_reused(blob)):
+                return UploadResult(uri, blob_name, False, size)
+
+            try:
+                # if_generation_match=0 only creates the object if it does not exist,
+                # so two concurrent uploads of the same image cannot overwrite each other
+                if data is not None:
+                    blob.upload_from_string(data, content_type=content_type, if_generation_match=0)
+                else:
+                    blob.upload_from_filename(image_path, content_type=content_type, if_generation_match=0)
+            except api_exceptions.PreconditionFailed:
+                with self._pending_lock:
+                    shared = self._pending.get(blob_name, 0) > int(speculative)
+                if shared:
+                    self._mark_reused(blob)
+                return UploadResult(uri, blob_name, False, size)
+
+            created = True
+            return UploadResult(uri, blob_name, True, size, blob.generation)
+        finally:
+            if speculative and not created:
+                self._release(blob_name)
+
+    def _release(self, blob_name: str) -> None:
+        with self._pending_lock:
+            remaining = self._pending.get(blob_name, 0) - 1
+            if remaining > 0:
+                self._pending[blob_name] = remaining
+            else:
+                self._pending.pop(blob_name, None)
+
+    @staticmethod
+    def _mark_reused(blob) -> bool:
+        """
+        Marca un blob existente como referenciado por otra subida.
+
+        :param blob: Blob que ya existe en el bucket.
+        :return: False si el blob se borró entre tanto (hay que subirlo de nuevo).
+        """
+        blob.metadata = {**(blob.metadata or {}), "reutilizado": "1"}
+        try:
+            blob.patch()
+        except api_exceptions.NotFound:
+            return False
+        return True
+
+    def settle(self, result: UploadResult) -> None:
+        """
+        Confirma una subida especulativa que se conserva: deja de estar
+        pendiente y los reusos del blob ya no lo marcan.
+
+        :param result: Resultado de upload con speculative=True.
+        """
+        if result.created:
+            self._release(result.blob_name)
+
+    def discard(self, result: UploadResult, quarantine_prefix: Optional[str] = None) -> Optional[str]:
+        """
+        Retira un blob subido de forma especulativa que no debe conservarse.
+
+        Solo actúa si esta subida creó el blob y ninguna otra lo reutilizó
+        desde entonces: el borrado exige la misma generation y metageneration 1
+        (ver _mark_reused). Si el contenido ya existía o alguien más lo
+        referencia, el blob no se toca.
+
+        :param result: Resultado de upload.
+        :param quarantine_prefix: Si se indica, el blob se mueve a esa carpeta
+            en lugar de borrarse.
+        :return: Ruta gs:// en cuarentena, o None si se borró o no se tocó.
+        """
+        if not result.created:
+            return None
+        try:
+            blob = self.bucket.blob(result.blob_name)
+            copy, moved = None, None
+            if quarantine_prefix:
+                new_name = f"{quarantine_prefix}/{os.path.basename(result.blob_name)}"
+                copy = self.bucket.copy_blob(blob, self.bucket, new_name)
+                moved = f"gs://{self.bucket_name}/{new_name}"
+            try:
+                blob.delete(if_generation_match=result.generation, if_metageneration_match=1)
+            except (api_exceptions.PreconditionFailed, api_exceptions.NotFound):
+                # Another prescription uses the blob now: it stays and so does its URI
+                if copy is not None:
+                    copy.delete()
+                return None
+            return moved
+        finally:
+            # Only after the delete, so reuses racing with it still mark the blob
+            self._release(result.blob_name)
+
+    def upload_many(self, image_paths: List[str], max_workers: Optional[int] = None) -> List[Union[UploadResult, Exception]]:
+        """
+        Sube muchas imágenes en paralelo.
+
+        :param image_paths: Rutas locales de las imágenes.
+        :param max_workers: Subidas concurrentes (default: el del uploader).
+        :return: UploadResult o la excepción de cada imagen, en el orden de entrada.
+        """
+        def upload_one(image_path: str) -> Union[UploadResult, Exception]:
+            try:
+                return self.upload(image_path)
+            except Exception as e:
+                return e
+
+        with ThreadPoolExecutor(max_workers or self.max_workers, thread_name_prefix="gcs-upload") as pool:
+            return list(pool.map(upload_one, image_paths))
+
+
+_uploaders: Dict[str, GCSUploader] = {}
+_uploaders_lock = threading.Lock()
+
+
+def get_uploader(bucket_name: str) -> GCSUploader:
+    """
+    Retorna el uploader compartido de un bucket, creándolo en el primer uso.
+
+    :param bucket_name: Nombre del bucket de GCS.
+    :return: Instancia de GCSUploader.
+    """
+    with _uploaders_lock:
+        if bucket_name not in _uploaders:
+            _uploaders[bucket_name] = GCSUploader(bucket_name)
+        return _uploaders[bucket_name]
+
+
+def upload_image_to_bucket(
+    bucket_name: str,
+    image_path: str,
+    data: Optional[bytes] = None,
+    content_type: Optional[str] = None
+) -> str:
     """
     Sube una imagen a Cloud Storage y retorna su URL pública.
 
     :param bucket_name: Nombre del bucket de GCS.
     :param image_path: Ruta local del archivo de imagen.
+    :param data: Bytes a subir en lugar del archivo (p. ej. la imagen optimizada).
+    :param content_type: Tipo MIME de data.
     :return: URL pública de la imagen subida.
     """
-    credentials_path = os.getenv("GOOGLE_APPLICATION_CREDENTIALS")
-    credentials = service_account.Credentials.from_service_account_file(credentials_path)
-    client = storage.Client(credentials=credentials)
-    
-    bucket = client.bucket(bucket_name)
-    blob_name = f"prescripciones/{uuid4().hex}_{os.path.basename(image_path)}"
-    blob = bucket.blob(blob_name)
-    
-    blob.upload_from_filename(image_path)
-
-
     # Devuelve la ruta interna gs:// para guardar en BigQuery
-    return f"gs://{bucket_name}/{blob_name}"
+    return get_uploader(bucket_name).upload(image_path, data, content_type).uri
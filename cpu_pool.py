@@ -0,0 +1,312 @@
+import os
+import json
+import time
+import base64
+import logging
+import threading
+from typing import Callable, Dict, Optional
+
+from image_preprocessing import ImagePreprocessor, PreprocessedImage, detect_mime_type
+from openai_service import build_request
+
+
+logger = logging.getLogger(__name__)
+
+# Multiple of 3 so each chunk encodes to base64 without padding
+ENCODE_CHUNK = 3 * 256 * 1024
+# JSON around the base64 (prompt excluded), for the budget estimate
+REQUEST_OVERHEAD = 4096
+
+
+class ByteBudget:
+    """
+    Límite de bytes en vuelo compartido entre hilos.
+
+    acquire bloquea hasta que haya espacio; una reserva más grande que el
+    límite entra sola cuando no hay nada más en vuelo, para no bloquearse
+    para siempre.
+    """
+
+    def __init__(self, limit: int):
+        """
+        :param limit: Máximo de bytes reservados a la vez.
+        """
+        self.limit = limit
+        self.in_use = 0
+        self.peak = 0
+        self.waited_seconds = 0.0
+        self._condition = threading.Condition()
+
+    def acquire(self, amount: int) -> None:
+        """
+        Reserva bytes; bloquea hasta que haya espacio.
+
+        :param amount: Bytes a reservar.
+        """
+        with self._condition:
+            if self.in_use and self.in_use + amount > self.limit:
+                start = time.perf_counter()
+                self._condition.wait_for(lambda: not self.in_use or self.in_use + amount <= self.limit)
+                self.waited_seconds += time.perf_counter() - start
+            self._add(amount)
+
+    def resize(self, reserved: int, actual: int) -> None:
+        """
+        Ajusta una reserva a su tamaño real (puede quedar sobre el límite).
+
+        :param reserved: Bytes reservados con acquire.
+        :param actual: Bytes que realmente se usan.
+        """
+        with self._condition:
+            self._add(actual - reserved)
+            self._condition.notify_all()
+
+    def release(self, amount: int) -> None:
+        """
+        Libera bytes reservados.
+
+        :param amount: Bytes a liberar.
+        """
+        with self._condition:
+            self._add(-amount)
+            self._condition.notify_all()
+
+    def _add(self, amount: int) -> None:
+        self.in_use += amount
+        self.peak = max(self.peak, self.in_use)
+
+
+def _attach(name: str):
+    from multiprocessing import shared_memory
+    return shared_memory.SharedMemory(name=name)
+
+
+def _encode_request(image_path: str, prompt: str, config: Optional[Dict]) -> tuple:
+    """
+    Corre en un proceso del pool: lee y preprocesa la imagen y escribe en
+    memoria compartida el cuerpo JSON de la solicitud (con el base64 ya
+    adentro) seguido de la imagen preprocesada si hay preprocesamiento.
+
+    :return: Tupla (nombre del bloque, bytes del cuerpo, bytes de la imagen,
+        modelo, max_tokens, tipo MIME, bytes originales).
+    """
+    from multiprocessing import shared_memory
+
+    with open(image_path, "rb") as f:
+        data = f.read()
+    bytes_before = len(data)
+    if config is not None:
+        image = ImagePreprocessor(**config).process(data)
+        data, mime_type = image.data, image.mime_type
+    else:
+        mime_type = detect_mime_type(data)
+
+    # Same body as build_request, serialized like requests does for json=,
+    # with the base64 written straight into the block in chunks
+    request = build_request(prompt, b"", mime_type)
+    marker = f"data:{mime_type};base64,".encode("ascii")
+    head, tail = json.dumps(request, allow_nan=False).encode("utf-8").rsplit(marker, 1)
+    head += marker
+    body_size = len(head) + 4 * ((len(data) + 2) // 3) + len(tail)
+    image_size = len(data) if config is not None else 0
+
+    block = shared_memory.SharedMemory(create=True, size=body_size + image_size)
+    try:
+        buffer = block.buf
+        position = len(head)
+        buffer[:position] = head
+        view = memoryview(data)
+        for start in range(0, len(data), ENCODE_CHUNK):
+            encoded = base64.b64encode(view[start:start + ENCODE_CHUNK])
+            buffer[position:position + len(encoded)] = encoded
+            position += len(encoded)
+        buffer[position:body_size] = tail
+        if image_size:
+            buffer[body_size:] = data
+        view.release()
+    except BaseException:
+        block.close()
+        block.unlink()
+        raise
+    block.close()
+    return block.name, body_size, image_size, request["model"], request["max_tokens"], mime_type, bytes_before
+
+
+class EncodedRequest:
+    """
+    Solicitud de extracción ya serializada por CPUPool, en memoria compartida.
+
+    Hay que cerrarla (close o with) para liberar el bloque y su parte del
+    presupuesto de bytes.
+    """
+
+    def __init__(
+        self,
+        block,
+        body_size: int,
+        image_size: int,
+        model: str,
+        max_tokens: int,
+        mime_type: str,
+        bytes_before: int,
+        on_close: Optional[Callable[[], None]] = None,
+    ):
+        self._block = block
+        self.body_size = body_size
+        self.image_size = image_size
+        self.model = model
+        self.max_tokens = max_tokens
+        self.mime_type = mime_type
+        self.bytes_before = bytes_before
+        self._on_close = on_close
+
+    @property
+    def body(self) -> memoryview:
+        """
+        Cuerpo JSON de la solicitud, sin copiarlo.
+        """
+        return self._block.buf[:self.body_size]
+
+    @property
+    def bytes_after(self) -> int:
+        """
+        Bytes de la imagen enviada (preprocesada u original).
+        """
+        return self.image_size or self.bytes_before
+
+    def image(self) -> Optional[PreprocessedImage]:
+        """
+        Copia la imagen preprocesada (para subirla en vez del original).
+
+        :return: Imagen, o None si el pool no preprocesa.
+        """
+        if not self.image_size:
+            return None
+        data = bytes(self._block.buf[self.body_size:self.body_size + self.image_size])
+        return PreprocessedImage(data, self.mime_type, self.bytes_before, self.image_size)
+
+    def close(self) -> None:
+        """
+        Libera el bloque de memoria compartida y el presupuesto.
+        """
+        if self._block is None:
+            return
+        block, self._block = self._block, None
+        try:
+            block.close()
+        except BufferError:
+            # A view is still referenced somewhere; the mapping goes away with it
+            logger.debug(f"Bloque {block.name} cerrado con vistas activas")
+        block.unlink()
+        if self._on_close is not None:
+            self._on_close()
+
+    def __enter__(self) -> "EncodedRequest":
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+
+class CPUPool:
+    """
+    Pool de procesos para el trabajo de CPU de la extracción: leer la imagen,
+    preprocesarla, codificarla en base64 y serializar el JSON.
+
+    El resultado vuelve por memoria compartida en lugar de serializarse por el
+    pipe, y el proceso principal lo envía sin armar el base64 ni el JSON. Un
+    ByteBudget limita los bytes en vuelo: encode bloquea mientras esté lleno,
+    así la memoria no crece con el tamaño del lote.
+    """
+
+    def __init__(
+        self,
+        workers: Optional[int] = None,
+        max_bytes: Optional[int] = None,
+        preprocessor: Optional[ImagePreprocessor] = None,
+        start_method: Optional[str] = None,
+    ):
+        """
+        :param workers: Procesos (PIP_CPU_WORKERS, default número de CPUs).
+        :param max_bytes: Bytes en vuelo (PIP_CPU_MAX_MB, default 256 MB).
+        :param preprocessor: Preprocesamiento que se aplica en los procesos; sin
+            él se envía la imagen original.
+        :param start_method: Método de arranque de multiprocessing
+            (PIP_CPU_START_METHOD, default "spawn": los procesos no heredan los
+            hilos ni los clientes HTTP del padre).
+        """
+        # Imported here so importing the processor stays cheap
+        import multiprocessing
+        from concurrent.futures import ProcessPoolExecutor
+
+        self.workers = workers or int(os.getenv("PIP_CPU_WORKERS", "0")) or os.cpu_count() or 1
+        max_bytes = max_bytes or int(float(os.getenv("PIP_CPU_MAX_MB", "256")) * 1024 * 1024)
+        self.budget = ByteBudget(max_bytes)
+        self.config = preprocessor.config() if preprocessor is not None else None
+        context = multiprocessing.get_context(start_method or os.getenv("PIP_CPU_START_METHOD", "spawn"))
+        self._executor = ProcessPoolExecutor(self.workers, mp_context=context)
+        self._lock = threading.Lock()
+        self._encoded = 0
+
+    def estimate(self, image_path: str, prompt: str) -> int:
+        """
+        Cota del tamaño de la solicitud a partir del archivo original.
+
+        :param image_path: Ruta local del archivo de imagen.
+        :param prompt: Prompt de extracción.
+        :return: Bytes a reservar antes de codificar.
+        """
+        size = os.path.getsize(image_path)
+        image = size if self.config is not None else 0
+        return 4 * ((size + 2) // 3) + len(prompt.encode("utf-8")) + REQUEST_OVERHEAD + image
+
+    def encode(self, image_path: str, prompt: str) -> EncodedRequest:
+        """
+        Prepara la solicitud de una imagen en un proceso del pool.
+
+        :param image_path: Ruta local del archivo de imagen.
+        :param prompt: Prompt de extracción.
+        :return: Solicitud serializada; el llamador debe cerrarla.
+        """
+        reserved = self.estimate(image_path, prompt)
+        self.budget.acquire(reserved)
+        try:
+            name, body_size, image_size, model, max_tokens, mime_type, bytes_before = self._executor.submit(
+                _encode_request, image_path, prompt, self.config
+            ).result()
+        except BaseException:
+            self.budget.release(reserved)
+            raise
+        actual = body_size + image_size
+        self.budget.resize(reserved, actual)
+        with self._lock:
+            self._encoded += 1
+        return EncodedRequest(
+            _attach(name), body_size, image_size, model, max_tokens, mime_type, bytes_before,
+            on_close=lambda: self.budget.release(actual),
+        )
+
+    def stats(self) -> Dict:
+        """
+        Retorna procesos, imágenes codificadas y uso del presupuesto de bytes.
+        """
+        return {
+            "procesos": self.workers,
+            "codificadas": self._encoded,
+            "bytes_en_vuelo": self.budget.in_use,
+            "pico_bytes": self.budget.peak,
+            "limite_bytes": self.budget.limit,
+            "segundos_esperando": round(self.budget.waited_seconds, 3),
+        }
+
+    def close(self) -> None:
+        """
+        Detiene los procesos.
+        """
+        self._executor.shutdown()
+
+    def __enter__(self) -> "CPUPool":
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
@@ -0,0 +1,196 @@
+import os
+import sys
+import json
+import logging
+import argparse
+from typing import Dict, List, Optional
+
+from benchmark_pip import percentile
+from instrumentation import Span, Tracer
+from pip_processor import IMAGE_EXTENSIONS
+from triage import HeuristicTriage, ModelTriage, TriageCascade
+
+
+logger = logging.getLogger(__name__)
+
+# Subfolder name -> whether its images are legible prescriptions
+LABELS = {"formula": True, "otro": False}
+
+
+def load_labeled_images(directory: str) -> List[tuple]:
+    """
+    Lee una carpeta etiquetada: `formula/` con fórmulas legibles y `otro/` con
+    todo lo demás (selfies, documentos, fotos borrosas...).
+
+    :param directory: Carpeta raíz.
+    :return: Lista de (ruta, es_formula).
+    """
+    images = []
+    for label, expected in LABELS.items():
+        folder = os.path.join(directory, label)
+        if not os.path.isdir(folder):
+            continue
+        for name in sorted(os.listdir(folder)):
+            if name.lower().endswith(IMAGE_EXTENSIONS):
+                images.append((os.path.join(folder, name), expected))
+    if not images:
+        raise ValueError(f"No hay imágenes en {directory}/formula ni {directory}/otro")
+    return images
+
+
+def confusion(rows: List[Dict]) -> Dict:
+    """
+    Resume las decisiones contra las etiquetas.
+
+    :param rows: Filas con "es_formula" y "pasa".
+    :return: Conteos y tasas; un falso rechazo es una fórmula descartada.
+    """
+    formulas = [row for row in rows if row["es_formula"]]
+    otros = [row for row in rows if not row["es_formula"]]
+    false_rejections = sum(1 for row in formulas if not row["pasa"])
+    true_rejections = sum(1 for row in otros if not row["pasa"])
+    rejected = false_rejections + true_rejections
+    return {
+        "formulas": len(formulas),
+        "otros": len(otros),
+        "falsos_rechazos": false_rejections,
+        "rechazos_correctos": true_rejections,
+        "tasa_falso_rechazo": round(false_rejections / len(formulas), 4) if formulas else 0.0,
+        "otros_descartados": round(true_rejections / len(otros), 4) if otros else 0.0,
+        "precision_rechazo": round(true_rejections / rejected, 4) if rejected else 0.0,
+        "extracciones_evitadas": rejected,
+    }
+
+
+def evaluate(images: List[tuple], tiers: List) -> Dict:
+    """
+    Pasa las imágenes por la cascada y mide cada nivel.
+
+    :param images: Lista de (ruta, es_formula).
+    :param tiers: Niveles de la cascada.
+    :return: {"resumen", "niveles", "imagenes"}.
+    """
+    latencies: Dict[str, List[float]] = {tier.name: [] for tier in tiers}
+
+    def collect(span: Span) -> None:
+        if span.stage.startswith("triaje_"):
+            latencies[span.stage[len("triaje_"):]].append(span.duration)
+
+    cascade = TriageCascade(tiers, tracer=Tracer([collect]))
+    rows = []
+    for path, expected in images:
+        with open(path, "rb") as f:
+            result = cascade.classify(f.read())
+        rows.append({
+            "ruta": path,
+            "es_formula": expected,
+            "pasa": result.pasa,
+            "nivel": result.nivel,
+            "puntaje": result.puntaje,
+        })
+
+    levels = cascade.stats()
+    for name, stats in levels.items():
+        stats["p50_ms"] = round(percentile(latencies[name], 50) * 1000, 1)
+        stats["p95_ms"] = round(percentile(latencies[name], 95) * 1000, 1)
+    return {"resumen": confusion(rows), "niveles": levels, "imagenes": rows}
+
+
+def sweep(images: List[tuple], heuristic: HeuristicTriage, steps: int = 10) -> List[Dict]:
+    """
+    Prueba pares de umbrales (rechazar, aceptar) del nivel heurístico.
+
+    Los puntajes se calculan una sola vez. Las imágenes entre ambos umbrales
+    quedan "indecisas": irían al siguiente nivel (o pasarían si no hay otro).
+
+    :param images: Lista de (ruta, es_formula).
+    :param heuristic: Clasificador heurístico.
+    :param steps: Divisiones del intervalo [0, 1].
+    :return: Una fila por par de umbrales.
+    """
+    scored = []
+    for path, expected in images:
+        with open(path, "rb") as f:
+            scored.append((heuristic.score(f.read()), expected))
+
+    results = []
+    thresholds = [round(i / steps, 4) for i in range(steps + 1)]
+    for reject in thresholds:
+        for accept in thresholds:
+            if accept < reject:
+                continue
+            rows = [
+                {"es_formula": expected, "pasa": score is None or score >= reject}
+                for score, expected in scored
+            ]
+            undecided = sum(1 for score, _ in scored if score is not None and reject <= score < accept)
+            results.append({
+                "rechazar": reject,
+                "aceptar": accept,
+                "indecisas": round(undecided / len(scored), 4),
+                **confusion(rows),
+            })
+    return results
+
+
+def format_summary(report: Dict) -> str:
+    lines = []
+    summary = report["resumen"]
+    lines.append(
+        f"fórmulas={summary['formulas']} otros={summary['otros']} "
+        f"falsos_rechazos={summary['falsos_rechazos']} ({summary['tasa_falso_rechazo']:.1%}) "
+        f"otros_descartados={summary['otros_descartados']:.1%} precision_rechazo={summary['precision_rechazo']:.1%}"
+    )
+    for name, stats in report["niveles"].items():
+        lines.append(
+            f"  {name:<10} evaluadas={stats['evaluadas']:>5} aprobadas={stats['aprobadas']:>5} "
+            f"rechazadas={stats['rechazadas']:>5} indecisas={stats['indecisas']:>5} "
+            f"p50={stats['p50_ms']:>7.1f}ms p95={stats['p95_ms']:>7.1f}ms "
+            f"tokens={stats['prompt_tokens'] + stats['completion_tokens']:>7} costo=${stats['costo_usd']:.4f}"
+        )
+    return "\n".join(lines)
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(
+        description="Evalúa el triaje de imágenes sobre una carpeta etiquetada (formula/ y otro/)."
+    )
+    parser.add_argument("carpeta", help="Carpeta con las subcarpetas formula/ y otro/.")
+    parser.add_argument("--niveles", nargs="+", default=["heuristica"], choices=["heuristica", "modelo"],
+                        help="Niveles de la cascada, en orden.")
+    parser.add_argument("--aceptar", type=float, help="Umbral de aprobación heurístico (PIP_TRIAGE_ACCEPT).")
+    parser.add_argument("--rechazar", type=float, help="Umbral de rechazo heurístico (PIP_TRIAGE_REJECT).")
+    parser.add_argument("--umbral-modelo", type=float, help="Umbral del modelo (PIP_TRIAGE_MODEL_THRESHOLD).")
+    parser.add_argument("--barrido", action="store_true", help="Probar pares de umbrales del nivel heurístico.")
+    parser.add_argument("--json", action="store_true", help="Imprimir los resultados como JSON.")
+    parser.add_argument("--output", help="Guardar los resultados en este archivo.")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.WARNING)
+    images = load_labeled_images(args.carpeta)
+    heuristic = HeuristicTriage(accept=args.aceptar, reject=args.rechazar)
+    tiers = [heuristic if name == "heuristica" else ModelTriage(threshold=args.umbral_modelo) for name in args.niveles]
+
+    report = evaluate(images, tiers)
+    if args.barrido:
+        report["barrido"] = sweep(images, heuristic)
+
+    if args.json:
+        print(json.dumps({key: value for key, value in report.items() if key != "imagenes"}, ensure_ascii=False, indent=2))
+    else:
+        print(format_summary(report))
+        for row in report.get("barrido", []):
+            print(
+                f"  rechazar<{row['rechazar']:.2f} aceptar>={row['aceptar']:.2f} "
+                f"falso_rechazo={row['tasa_falso_rechazo']:.1%} otros_descartados={row['otros_descartados']:.1%} "
+                f"indecisas={row['indecisas']:.1%}"
+            )
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,181 @@
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import threading
+from typing import Dict, Optional
+
+
+def file_sha256(path: str, chunk_size: int = 1024 * 1024) -> str:
+    """
+    Calcula el hash SHA-256 de un archivo leyéndolo por bloques.
+
+    :param path: Ruta local del archivo.
+    :param chunk_size: Tamaño de cada bloque leído.
+    :return: Hash hexadecimal del contenido.
+    """
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def cache_key(image_hash: str, prompt: str, params: Dict) -> str:
+    """
+    Construye la llave de caché de una extracción.
+
+    Cambiar la imagen, el prompt o cualquier parámetro del modelo produce una
+    llave distinta, así que no hace falta invalidar la caché a mano.
+
+    :param image_hash: SHA-256 de los bytes de la imagen.
+    :param prompt: Texto del prompt de extracción.
+    :param params: Modelo y parámetros de la llamada (model, max_tokens, ...).
+    :return: Llave hexadecimal.
+    """
+    digest = hashlib.sha256()
+    digest.update(image_hash.encode("utf-8"))
+    digest.update(b"\0")
+    digest.update(prompt.encode("utf-8"))
+    digest.update(b"\0")
+    digest.update(json.dumps(params, sort_keys=True).encode("utf-8"))
+    return digest.hexdigest()
+
+
+class ExtractionCache:
+    """
+    Caché persistente (SQLite) de los `datos` extraídos por el modelo.
+
+    Las entradas expiran después de `ttl_seconds` y, cuando se supera
+    `max_entries` o `max_bytes`, se eliminan las usadas hace más tiempo.
+    """
+
+    def __init__(
+        self,
+        path: Optional[str] = None,
+        ttl_seconds: Optional[float] = None,
+        max_entries: Optional[int] = None,
+        max_bytes: Optional[int] = None,
+    ):
+        """
+        :param path: Archivo SQLite (PIP_CACHE_PATH, default pip_cache.sqlite3).
+        :param ttl_seconds: Vigencia de cada entrada (PIP_CACHE_TTL_SECONDS, default 30 días).
+        :param max_entries: Máximo de entradas (PIP_CACHE_MAX_ENTRIES, default 100000).
+        :param max_bytes: Máximo de bytes almacenados (PIP_CACHE_MAX_BYTES, default 256 MB).
+        """
+        self.path = path or os.getenv("PIP_CACHE_PATH", "pip_cache.sqlite3")
+        self.ttl_seconds = ttl_seconds or float(os.getenv("PIP_CACHE_TTL_SECONDS", str(30 * 24 * 3600)))
+        self.max_entries = max_entries or int(os.getenv("PIP_CACHE_MAX_ENTRIES", "100000"))
+        self.max_bytes = max_bytes or int(os.getenv("PIP_CACHE_MAX_BYTES", str(256 * 1024 * 1024)))
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS extracciones (
+                llave TEXT PRIMARY KEY,
+                datos TEXT NOT NULL,
+                bytes INTEGER NOT NULL,
+                creado REAL NOT NULL,
+                usado REAL NOT NULL
+            )
+            """
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS extracciones_usado ON extracciones (usado)")
+
+    def get(self, key: str) -> Optional[dict]:
+        """
+        Busca una extracción en la caché.
+
+        :param key: Llave construida con cache_key.
+        :return: Diccionario `datos` o None si no existe o expiró.
+        """
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT datos, creado FROM extracciones WHERE llave = ?", (key,)
+            ).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            if row[1] + self.ttl_seconds < now:
+                self._conn.execute("DELETE FROM extracciones WHERE llave = ?", (key,))
+                self.evictions += 1
+                self.misses += 1
+                return None
+            self._conn.execute("UPDATE extracciones SET usado = ? WHERE llave = ?", (now, key))
+            self.hits += 1
+        return json.loads(row[0])
+
+    def put(self, key: str, data: dict) -> None:
+        """
+        Guarda una extracción y aplica la política de desalojo.
+
+        :param key: Llave construida con cache_key.
+        :param data: Diccionario `datos` del modelo.
+        """
+        payload = json.dumps(data, ensure_ascii=False)
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO extracciones (llave, datos, bytes, creado, usado) VALUES (?, ?, ?, ?, ?)",
+                (key, payload, len(payload.encode("utf-8")), now, now),
+            )
+            self._evict(now)
+
+    def _evict(self, now: float) -> None:
+        # Expired rows first, then least recently used. Once over a limit we
+        # trim to 90% of it so eviction does not run again on the next put.
+        cursor = self._conn.execute("DELETE FROM extracciones WHERE creado < ?", (now - self.ttl_seconds,))
+        self.evictions += max(cursor.rowcount, 0)
+
+        count, total = self._conn.execute("SELECT COUNT(*), COALESCE(SUM(bytes), 0) FROM extracciones").fetchone()
+        if count <= self.max_entries and total <= self.max_bytes:
+            return
+
+        target_count = int(self.max_entries * 0.9) if count > self.max_entries else count
+        target_bytes = int(self.max_bytes * 0.9) if total > self.max_bytes else total
+        while count > target_count or total > target_bytes:
+            rows = self._conn.execute("SELECT llave, bytes FROM extracciones ORDER BY usado LIMIT 256").fetchall()
+            if not rows:
+                break
+            for key, size in rows:
+                if count <= target_count and total <= target_bytes:
+                    break
+                self._conn.execute("DELETE FROM extracciones WHERE llave = ?", (key,))
+                count -= 1
+                total -= size
+                self.evictions += 1
+
+    def stats(self) -> Dict:
+        """
+        Retorna los contadores de la caché.
+
+        :return: Aciertos, fallos, desalojos, tasa de acierto y tamaño actual.
+        """
+        with self._lock:
+            count, total = self._conn.execute(
+                "SELECT COUNT(*), COALESCE(SUM(bytes), 0) FROM extracciones"
+            ).fetchone()
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_ratio": round(self.hits / lookups, 4) if lookups else 0.0,
+                "entries": count,
+                "bytes": total,
+            }
+
+    def close(self) -> None:
+        """
+        Cierra la conexión a SQLite.
+        """
+        with self._lock:
+            self._conn.close()
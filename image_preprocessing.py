@@ -0,0 +1,173 @@
+import io
+import os
+import logging
+from typing import Dict, NamedTuple, Optional
+
+
+logger = logging.getLogger(__name__)
+
+# Formatos que la API de visión acepta tal cual
+VISION_MIME_TYPES = ("image/jpeg", "image/png", "image/webp", "image/gif")
+# EXIF Orientation tag; 1 (or no tag) means the pixels are already upright
+EXIF_ORIENTATION = 0x0112
+
+
+class PreprocessedImage(NamedTuple):
+    """
+    Imagen lista para enviarse al modelo (y opcionalmente a Cloud Storage).
+    """
+    data: bytes
+    mime_type: str
+    bytes_before: int
+    bytes_after: int
+
+
+def detect_mime_type(data: bytes) -> str:
+    """
+    Detecta el tipo MIME real de una imagen a partir de sus primeros bytes.
+
+    :param data: Contenido (o al menos los primeros 16 bytes) de la imagen.
+    :return: Tipo MIME; application/octet-stream si no se reconoce.
+    """
+    if data.startswith(b"\xff\xd8\xff"):
+        return "image/jpeg"
+    if data.startswith(b"\x89PNG\r\n\x1a\n"):
+        return "image/png"
+    if data[:6] in (b"GIF87a", b"GIF89a"):
+        return "image/gif"
+    if data[:4] == b"RIFF" and data[8:12] == b"WEBP":
+        return "image/webp"
+    if data[4:8] == b"ftyp":
+        brand = data[8:12]
+        if brand in (b"heic", b"heix", b"hevc", b"hevx", b"heim", b"heis"):
+            return "image/heic"
+        if brand in (b"mif1", b"msf1"):
+            return "image/heif"
+        if brand == b"avif":
+            return "image/avif"
+    if data[:4] in (b"II*\x00", b"MM\x00*"):
+        return "image/tiff"
+    if data.startswith(b"BM"):
+        return "image/bmp"
+    return "application/octet-stream"
+
+
+def _load_pil():
+    """
+    Importa Pillow (y el soporte HEIC si está instalado).
+
+    :return: Tupla (Image, ImageOps) o None si Pillow no está instalado.
+    """
+    try:
+        from PIL import Image, ImageOps
+    except ImportError:
+        return None
+    try:
+        from pillow_heif import register_heif_opener
+        register_heif_opener()
+    except ImportError:
+        pass
+    return Image, ImageOps
+
+
+class ImagePreprocessor:
+    """
+    Reduce el tamaño de las fotos antes de codificarlas en base64.
+
+    Corrige la orientación EXIF, reduce el lado largo a `max_long_edge`,
+    opcionalmente pasa a escala de grises y ajusta el contraste, y recodifica
+    en JPEG con `quality`. Si Pillow no está instalado la imagen pasa sin
+    cambios, pero con su tipo MIME real.
+    """
+
+    def __init__(
+        self,
+        max_long_edge: Optional[int] = None,
+        quality: Optional[int] = None,
+        grayscale: Optional[bool] = None,
+        autocontrast: Optional[bool] = None,
+    ):
+        """
+        :param max_long_edge: Lado largo máximo en píxeles (PIP_IMG_MAX_EDGE, default 2048).
+        :param quality: Calidad JPEG de salida (PIP_IMG_QUALITY, default 85).
+        :param grayscale: Convertir a escala de grises (PIP_IMG_GRAYSCALE, default 0).
+        :param autocontrast: Aplicar autocontraste (PIP_IMG_AUTOCONTRAST, default 0).
+        """
+        self.max_long_edge = max_long_edge or int(os.getenv("PIP_IMG_MAX_EDGE", "2048"))
+        self.quality = quality or int(os.getenv("PIP_IMG_QUALITY", "85"))
+        self.grayscale = grayscale if grayscale is not None else os.getenv("PIP_IMG_GRAYSCALE", "0") == "1"
+        self.autocontrast = autocontrast if autocontrast is not None else os.getenv("PIP_IMG_AUTOCONTRAST", "0") == "1"
+
+    def config(self) -> Dict:
+        """
+        Retorna la configuración; forma parte de la llave de caché de extracción.
+
+        :return: Diccionario con los parámetros del preprocesamiento.
+        """
+        return {
+            "max_long_edge": self.max_long_edge,
+            "quality": self.quality,
+            "grayscale": self.grayscale,
+            "autocontrast": self.autocontrast,
+        }
+
+    def process_file(self, image_path: str) -> PreprocessedImage:
+        """
+        Lee y preprocesa una imagen desde disco.
+
+        :param image_path: Ruta local del archivo de imagen.
+        :return: Imagen preprocesada.
+        """
+        with open(image_path, "rb") as f:
+            return self.process(f.read())
+
+    def process(self, data: bytes) -> PreprocessedImage:
+        """
+        Preprocesa los bytes de una imagen.
+
+        :param data: Contenido original de la imagen.
+        :return: Imagen preprocesada con tamaños antes y después.
+        """
+        mime_type = detect_mime_type(data)
+        pil = _load_pil()
+        if pil is None:
+            return PreprocessedImage(data, mime_type, len(data), len(data))
+        Image, ImageOps = pil
+
+        try:
+            image = Image.open(io.BytesIO(data))
+            image.load()
+        except Exception as e:
+            logger.warning(f"No se pudo decodificar la imagen ({mime_type}), se envía sin cambios: {e}")
+            return PreprocessedImage(data, mime_type, len(data), len(data))
+
+        transformed = False
+        # exif_transpose returns a copy even when there is nothing to rotate,
+        # so the tag is checked first
+        if image.getexif().get(EXIF_ORIENTATION) not in (None, 1):
+            image, transformed = ImageOps.exif_transpose(image), True
+
+        if max(image.size) > self.max_long_edge:
+            image.thumbnail((self.max_long_edge, self.max_long_edge), Image.LANCZOS)
+            transformed = True
+
+        if self.grayscale:
+            image = image.convert("L")
+            transformed = True
+        elif image.mode not in ("RGB", "L"):
+            # JPEG does not support alpha or palette modes
+            image = image.convert("RGB")
+
+        if self.autocontrast:
+            image = ImageOps.autocontrast(image, cutoff=1)
+            transformed = True
+
+        output = io.BytesIO()
+        image.save(output, format="JPEG", quality=self.quality, optimize=True)
+        encoded = output.getvalue()
+
+        # A small, already-supported original is kept when re-encoding does not help
+        if not transformed and mime_type in VISION_MIME_TYPES and len(encoded) >= len(data):
+            return PreprocessedImage(data, mime_type, len(data), len(data))
+
+        return PreprocessedImage(encoded, "image/jpeg", len(data), len(encoded))
@@ -0,0 +1,478 @@
+import os
+import json
+import time
+import uuid
+import sqlite3
+import hashlib
+import logging
+import threading
+from typing import Dict, List, NamedTuple, Optional
+
+from extraction_cache import file_sha256
+from pip_processor import PIPError, PIPProcessor
+from prompt_registry import prompt_version
+
+
+logger = logging.getLogger(__name__)
+
+# Stage checkpoints, in order. A retried job resumes after the last one reached.
+STAGES = ("extraido", "subido", "registrado")
+
+
+class QueueFull(Exception):
+    """
+    La cola alcanzó su profundidad máxima; el llamador debe esperar y reintentar.
+    """
+
+
+class Job(NamedTuple):
+    """
+    Trabajo reclamado por un worker.
+    """
+    key: str
+    session_id: str
+    image_path: str
+    image_hash: str
+    stage: Optional[str]
+    data: Optional[dict]
+    url: Optional[str]
+    attempts: int
+    lease: str
+    prompt_version: Optional[str] = None
+    cache_key: Optional[str] = None
+
+
+def job_key(session_id: str, image_hash: str) -> str:
+    """
+    Llave de idempotencia de un trabajo: la misma imagen en la misma sesión
+    es siempre el mismo trabajo.
+
+    :param session_id: ID de sesión.
+    :param image_hash: SHA-256 de la imagen.
+    :return: Llave hexadecimal.
+    """
+    return hashlib.sha256(f"{session_id}\0{image_hash}".encode("utf-8")).hexdigest()
+
+
+class IngestionQueue:
+    """
+    Cola persistente (SQLite WAL) de imágenes por procesar.
+
+    Cada trabajo guarda la última etapa completada (extraido, subido,
+    registrado) con su resultado, así un reintento retoma desde ahí sin volver
+    a llamar a OpenAI. Un trabajo reclamado queda invisible durante
+    `visibility_timeout`; si el worker muere, otro lo retoma al vencer. Tras
+    `max_attempts` intentos el trabajo pasa a "fallido" (dead letter).
+    """
+
+    def __init__(
+        self,
+        path: Optional[str] = None,
+        max_depth: Optional[int] = None,
+        visibility_timeout: Optional[float] = None,
+        max_attempts: Optional[int] = None,
+        retry_base: Optional[float] = None,
+    ):
+        """
+        :param path: Archivo SQLite (PIP_QUEUE_PATH, default pip_queue.sqlite3).
+        :param max_depth: Máximo de trabajos pendientes o en proceso (PIP_QUEUE_MAX_DEPTH, default 10000).
+        :param visibility_timeout: Segundos que un trabajo reclamado es invisible
+            para otros workers (PIP_QUEUE_VISIBILITY_TIMEOUT, default 300).
+        :param max_attempts: Intentos antes de pasar a dead letter (PIP_QUEUE_MAX_ATTEMPTS, default 5).
+        :param retry_base: Espera base entre reintentos, se duplica en cada
+            intento (PIP_QUEUE_RETRY_BASE, default 5 segundos).
+        """
+        self.path = path or os.getenv("PIP_QUEUE_PATH", "pip_queue.sqlite3")
+        self.max_depth = max_depth or int(os.getenv("PIP_QUEUE_MAX_DEPTH", "10000"))
+        self.visibility_timeout = visibility_timeout or float(os.getenv("PIP_QUEUE_VISIBILITY_TIMEOUT", "300"))
+        self.max_attempts = max_attempts or int(os.getenv("PIP_QUEUE_MAX_ATTEMPTS", "5"))
+        self.retry_base = retry_base if retry_base is not None else float(os.getenv("PIP_QUEUE_RETRY_BASE", "5"))
+
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None, timeout=30)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS trabajos (
+                llave TEXT PRIMARY KEY,
+                session_id TEXT NOT NULL,
+                ruta TEXT NOT NULL,
+                hash_imagen TEXT NOT NULL,
+                estado TEXT NOT NULL,
+                etapa TEXT,
+                datos TEXT,
+                url TEXT,
+                version_prompt TEXT,
+                llave_cache TEXT,
+                intentos INTEGER NOT NULL DEFAULT 0,
+                visible_en REAL NOT NULL,
+                lease TEXT,
+                error TEXT,
+                creado REAL NOT NULL,
+                actualizado REAL NOT NULL
+            )
+            """
+        )
+        # Queues created before the extraido checkpoint kept the prompt version and cache key
+        columns = {row[1] for row in self._conn.execute("PRAGMA table_info(trabajos)")}
+        for column in ("version_prompt", "llave_cache"):
+            if column not in columns:
+                self._conn.execute(f"ALTER TABLE trabajos ADD COLUMN {column} TEXT")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS trabajos_estado ON trabajos (estado, visible_en)")
+
+    def enqueue(self, image_path: str, session_id: str) -> str:
+        """
+        Agrega una imagen a la cola; si ya estaba (misma sesión e imagen) no se duplica.
+
+        :param image_path: Ruta local de la imagen; debe existir hasta que el trabajo termine.
+        :param session_id: ID de sesión.
+        :return: Llave del trabajo.
+        :raises QueueFull: Si la cola alcanzó max_depth.
+        """
+        image_hash = file_sha256(image_path)
+        key = job_key(session_id, image_hash)
+        now = time.time()
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                if self._conn.execute("SELECT 1 FROM trabajos WHERE llave = ?", (key,)).fetchone() is None:
+                    depth = self._conn.execute(
+                        "SELECT COUNT(*) FROM trabajos WHERE estado IN ('pendiente', 'en_proceso')"
+                    ).fetchone()[0]
+                    if depth >= self.max_depth:
+                        raise QueueFull(f"La cola de ingesta está llena ({depth} trabajos)")
+                    self._conn.execute(
+                        "INSERT INTO trabajos (llave, session_id, ruta, hash_imagen, estado, visible_en, creado, actualizado) "
+                        "VALUES (?, ?, ?, ?, 'pendiente', ?, ?, ?)",
+                        (key, session_id, image_path, image_hash, now, now, now),
+                    )
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+            self._conn.execute("COMMIT")
+        return key
+
+    def claim(self) -> Optional[Job]:
+        """
+        Reclama el trabajo visible más antiguo.
+
+        También retoma trabajos "en_proceso" cuyo lease venció (worker caído);
+        si ya agotaron sus intentos pasan a dead letter.
+
+        :return: Job o None si no hay trabajos disponibles.
+        """
+        now = time.time()
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                while True:
+                    row = self._conn.execute(
+                        "SELECT llave, session_id, ruta, hash_imagen, etapa, datos, url, intentos, version_prompt, llave_cache "
+                        "FROM trabajos "
+                        "WHERE estado IN ('pendiente', 'en_proceso') AND visible_en <= ? "
+                        "ORDER BY visible_en LIMIT 1",
+                        (now,),
+                    ).fetchone()
+                    if row is None:
+                        job = None
+                        break
+                    key, session_id, path, image_hash, stage, data, url, attempts, version, cache_key = row
+                    if attempts >= self.max_attempts:
+                        self._conn.execute(
+                            "UPDATE trabajos SET estado = 'fallido', lease = NULL, actualizado = ?, "
+                            "error = COALESCE(error, 'Tiempo de procesamiento agotado') WHERE llave = ?",
+                            (now, key),
+                        )
+                        continue
+                    lease = uuid.uuid4().hex
+                    self._conn.execute(
+                        "UPDATE trabajos SET estado = 'en_proceso', intentos = intentos + 1, lease = ?, "
+                        "visible_en = ?, actualizado = ? WHERE llave = ?",
+                        (lease, now + self.visibility_timeout, now, key),
+                    )
+                    job = Job(key, session_id, path, image_hash, stage,
+                              json.loads(data) if data else None, url, attempts + 1, lease, version, cache_key)
+                    break
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+            self._conn.execute("COMMIT")
+        return job
+
+    def _update_leased(self, job: Job, sql: str, params: tuple) -> bool:
+        # Only the worker holding the current lease may write; a worker whose
+        # lease expired (and was re-claimed) must not overwrite the new owner.
+        with self._lock:
+            cursor = self._conn.execute(f"{sql} WHERE llave = ? AND lease = ?", params + (job.key, job.lease))
+        return cursor.rowcount == 1
+
+    def checkpoint(
+        self,
+        job: Job,
+        stage: str,
+        data: Optional[dict] = None,
+        url: Optional[str] = None,
+        version: Optional[str] = None,
+        cache_key: Optional[str] = None,
+    ) -> bool:
+        """
+        Guarda una etapa completada y renueva el lease.
+
+        :param job: Trabajo reclamado.
+        :param stage: Etapa completada (ver STAGES).
+        :param data: `datos` extraídos (etapa extraido).
+        :param url: Ruta gs:// de la imagen (etapa subido).
+        :param version: Versión del prompt con el que se extrajo (etapa extraido).
+        :param cache_key: Llave de caché de la extracción (etapa extraido).
+        :return: False si el trabajo ya no pertenece a este worker.
+        """
+        now = time.time()
+        return self._update_leased(
+            job,
+            "UPDATE trabajos SET etapa = ?, datos = COALESCE(?, datos), url = COALESCE(?, url), "
+            "version_prompt = COALESCE(?, version_prompt), llave_cache = COALESCE(?, llave_cache), "
+            "visible_en = ?, actualizado = ?",
+            (stage, json.dumps(data, ensure_ascii=False) if data is not None else None, url, version, cache_key,
+             now + self.visibility_timeout, now),
+        )
+
+    def complete(self, job: Job, data: Optional[dict] = None) -> bool:
+        """
+        Marca el trabajo como completado.
+
+        :param job: Trabajo reclamado.
+        :param data: `datos` finales si no se guardaron en un checkpoint (p. ej. acierto de caché).
+        :return: False si el trabajo ya no pertenece a este worker.
+        """
+        return self._update_leased(
+            job,
+            "UPDATE trabajos SET estado = 'completado', etapa = 'registrado', datos = COALESCE(?, datos), "
+            "lease = NULL, error = NULL, actualizado = ?",
+            (json.dumps(data, ensure_ascii=False) if data is not None else None, time.time()),
+        )
+
+    def fail(self, job: Job, error: str, retryable: bool) -> bool:
+        """
+        Registra un intento fallido: reprograma el trabajo con backoff
+        exponencial o lo pasa a dead letter.
+
+        :param job: Trabajo reclamado.
+        :param error: Mensaje del error.
+        :param retryable: False para errores definitivos (p. ej. imagen rechazada).
+        :return: False si el trabajo ya no pertenece a este worker.
+        """
+        now = time.time()
+        if retryable and job.attempts < self.max_attempts:
+            delay = self.retry_base * 2 ** (job.attempts - 1)
+            return self._update_leased(
+                job,
+                "UPDATE trabajos SET estado = 'pendiente', lease = NULL, visible_en = ?, error = ?, actualizado = ?",
+                (now + delay, error, now),
+            )
+        return self._update_leased(
+            job,
+            "UPDATE trabajos SET estado = 'fallido', lease = NULL, error = ?, actualizado = ?",
+            (error, now),
+        )
+
+    def requeue(self, key: str) -> bool:
+        """
+        Devuelve a la cola un trabajo en dead letter, conservando sus checkpoints.
+
+        :param key: Llave del trabajo.
+        :return: False si el trabajo no estaba en dead letter.
+        """
+        now = time.time()
+        with self._lock:
+            cursor = self._conn.execute(
+                "UPDATE trabajos SET estado = 'pendiente', intentos = 0, visible_en = ?, actualizado = ? "
+                "WHERE llave = ? AND estado = 'fallido'",
+                (now, now, key),
+            )
+        return cursor.rowcount == 1
+
+    def get(self, key: str) -> Optional[Dict]:
+        """
+        Estado de un trabajo.
+
+        :param key: Llave del trabajo.
+        :return: estado, etapa, intentos, error, datos y url; None si no existe.
+        """
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT estado, etapa, intentos, error, datos, url FROM trabajos WHERE llave = ?", (key,)
+            ).fetchone()
+        if row is None:
+            return None
+        estado, etapa, intentos, error, datos, url = row
+        return {
+            "estado": estado,
+            "etapa": etapa,
+            "intentos": intentos,
+            "error": error,
+            "datos": json.loads(datos) if datos else None,
+            "url": url,
+        }
+
+    def dead_letters(self, limit: int = 100) -> List[Dict]:
+        """
+        Trabajos en dead letter, los más recientes primero.
+
+        :param limit: Máximo de trabajos a retornar.
+        :return: Lista con llave, session_id, ruta, intentos y error.
+        """
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT llave, session_id, ruta, intentos, error FROM trabajos WHERE estado = 'fallido' "
+                "ORDER BY actualizado DESC LIMIT ?",
+                (limit,),
+            ).fetchall()
+        return [dict(zip(("llave", "session_id", "ruta", "intentos", "error"), row)) for row in rows]
+
+    def stats(self) -> Dict:
+        """
+        Número de trabajos por estado.
+        """
+        with self._lock:
+            rows = self._conn.execute("SELECT estado, COUNT(*) FROM trabajos GROUP BY estado").fetchall()
+        counts = {"pendiente": 0, "en_proceso": 0, "completado": 0, "fallido": 0}
+        counts.update(dict(rows))
+        return counts
+
+    def depth(self) -> int:
+        """
+        Trabajos pendientes o en proceso.
+        """
+        counts = self.stats()
+        return counts["pendiente"] + counts["en_proceso"]
+
+    def close(self) -> None:
+        """
+        Cierra la conexión a SQLite.
+        """
+        with self._lock:
+            self._conn.close()
+
+
+class IngestionWorkerPool:
+    """
+    Workers que consumen la cola con los métodos de etapa de PIPProcessor.
+
+    Cada etapa completada queda en la cola antes de pasar a la siguiente; un
+    reintento no repite la extracción si ya estaba hecha. El MERGE es
+    idempotente (las prescripciones se combinan sin duplicados), así que
+    repetir la persistencia tras una caída no duplica datos.
+    """
+
+    def __init__(
+        self,
+        queue: IngestionQueue,
+        processor: Optional[PIPProcessor] = None,
+        workers: Optional[int] = None,
+        poll_interval: float = 0.5,
+    ):
+        """
+        :param queue: Cola de ingesta.
+        :param processor: Procesador con la configuración; por defecto uno nuevo.
+        :param workers: Hilos consumidores (PIP_QUEUE_WORKERS, default 4).
+        :param poll_interval: Segundos de espera cuando la cola está vacía.
+        """
+        self.queue = queue
+        self.processor = processor or PIPProcessor()
+        self.workers = workers or int(os.getenv("PIP_QUEUE_WORKERS", "4"))
+        self.poll_interval = poll_interval
+        self._stop = threading.Event()
+        self._threads: List[threading.Thread] = []
+
+    def process_job(self, job: Job) -> None:
+        """
+        Ejecuta las etapas pendientes de un trabajo y registra el resultado en la cola.
+
+        :param job: Trabajo reclamado.
+        """
+        processor = self.processor
+        try:
+            data, url, stage = job.data, job.url, job.stage
+            # A resumed job keeps the prompt version and cache key of its extraction,
+            # even if the prompt was reloaded since
+            version, key = job.prompt_version, job.cache_key
+            image = None
+
+            if stage is None:
+                prompt = processor.read_prompt(job.session_id)
+                version = prompt_version(prompt)
+                key, cached = processor.cache_lookup(job.image_path, prompt)
+                if cached is not None:
+                    self.queue.complete(job, cached)
+                    return
+                image = processor.prepare_image(job.image_path)
+                data = processor.extract_data(job.image_path, prompt, image)
+                if not self.queue.checkpoint(job, "extraido", data=data, version=version, cache_key=key):
+                    return
+
+            if stage in (None, "extraido"):
+                if image is None and processor.upload_optimized:
+                    image = processor.prepare_image(job.image_path)
+                url = processor.upload_image(job.image_path, image)
+                if not self.queue.checkpoint(job, "subido", url=url):
+                    return
+
+            processor.save_patient(processor.build_patient_record(data, job.session_id, url, version=version))
+            if self.queue.complete(job):
+                processor.cache_store(key, data)
+        except PIPError as e:
+            logger.warning(f"Trabajo {job.key[:12]} falló en {e.stage} (intento {job.attempts}): {e.message}")
+            self.queue.fail(job, e.message, e.retryable)
+        except FileNotFoundError as e:
+            self.queue.fail(job, f"Imagen no encontrada: {e}", retryable=False)
+        except Exception as e:
+            logger.exception(f"Error inesperado en el trabajo {job.key[:12]}: {e}")
+            self.queue.fail(job, f"Error inesperado: {e}", retryable=True)
+
+    def _run(self) -> None:
+        while not self._stop.is_set():
+            try:
+                job = self.queue.claim()
+            except sqlite3.Error as e:
+                logger.error(f"No se pudo leer la cola de ingesta: {e}")
+                job = None
+            if job is None:
+                self._stop.wait(self.poll_interval)
+                continue
+            self.process_job(job)
+
+    def start(self) -> None:
+        """
+        Inicia los workers en hilos de fondo.
+        """
+        self._stop.clear()
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._run, name=f"pip-queue-{i}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self, wait: bool = True) -> None:
+        """
+        Detiene los workers; cada uno termina el trabajo que tiene en curso.
+
+        :param wait: Esperar a que los hilos terminen.
+        """
+        self._stop.set()
+        if wait:
+            for thread in self._threads:
+                thread.join()
+        self._threads = []
+
+    def drain(self, timeout: Optional[float] = None) -> bool:
+        """
+        Espera a que no queden trabajos pendientes ni en proceso.
+
+        :param timeout: Máximo de segundos a esperar.
+        :return: True si la cola quedó vacía.
+        """
+        deadline = time.monotonic() + timeout if timeout is not None else None
+        while self.queue.depth() > 0:
+            if deadline is not None and time.monotonic() >= deadline:
+                return False
+            time.sleep(self.poll_interval / 5)
+        return True
@@ -0,0 +1,311 @@
+import os
+import json
+import time
+import logging
+import threading
+import contextvars
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterator, List, Optional
+
+
+logger = logging.getLogger(__name__)
+
+# Upper bounds in seconds; from a local cache hit up to a slow MERGE
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+# Attributes that are added up per stage in the metrics
+COUNTED_ATTRIBUTES = ("bytes", "prompt_tokens", "completion_tokens", "cached_tokens", "retries")
+
+
+def cached_token_ratio(totals: Dict) -> Optional[float]:
+    """
+    Fracción de los prompt tokens que el proveedor sirvió desde su caché.
+
+    :param totals: Totales de una etapa (o cualquier diccionario con
+        prompt_tokens y cached_tokens).
+    :return: Fracción entre 0 y 1, o None si no hubo prompt tokens.
+    """
+    prompt_tokens = totals.get("prompt_tokens") or 0
+    if not prompt_tokens:
+        return None
+    return round((totals.get("cached_tokens") or 0) / prompt_tokens, 4)
+
+
+_current_span: contextvars.ContextVar = contextvars.ContextVar("pip_span", default=None)
+
+
+class Span:
+    """
+    Medición de una etapa del pipeline.
+
+    :param stage: Nombre de la etapa (prompt, extraccion, openai, parseo, subida, persistencia...).
+    :param parent: Etapa que la contiene, si la hay.
+    """
+
+    def __init__(self, stage: str, parent: Optional[str] = None, **attributes):
+        self.stage = stage
+        self.parent = parent
+        self.attributes: Dict = dict(attributes)
+        self.outcome: Optional[str] = None
+        self.started = time.time()
+        self.duration = 0.0
+
+    def set(self, **attributes) -> None:
+        """
+        Agrega atributos a la medición (bytes, tokens, reintentos...).
+        """
+        self.attributes.update(attributes)
+
+    def to_dict(self) -> Dict:
+        """
+        Representación serializable de la medición.
+        """
+        return {
+            "ts": round(self.started, 6),
+            "stage": self.stage,
+            "parent": self.parent,
+            "duration_ms": round(self.duration * 1000, 3),
+            "outcome": self.outcome,
+            **self.attributes,
+        }
+
+
+def annotate(**attributes) -> None:
+    """
+    Agrega atributos a la medición activa en este hilo; no hace nada si no hay.
+
+    Permite que openai_service y openai_client reporten tokens y reintentos
+    sin cambiar lo que retornan.
+    """
+    span = _current_span.get()
+    if span is not None:
+        span.set(**attributes)
+
+
+class Tracer:
+    """
+    Abre mediciones por etapa y las entrega a los hooks registrados.
+
+    Un hook es cualquier callable que recibe el Span terminado; si además
+    tiene un método flush(), Tracer.flush() lo llama.
+    """
+
+    def __init__(self, hooks: Optional[List[Callable[[Span], None]]] = None):
+        self.hooks: List[Callable[[Span], None]] = list(hooks or [])
+
+    def add_hook(self, hook: Callable[[Span], None]) -> None:
+        """
+        Registra un hook.
+
+        :param hook: Callable que recibe cada Span terminado.
+        """
+        self.hooks.append(hook)
+
+    @contextmanager
+    def span(self, stage: str, **attributes) -> Iterator[Span]:
+        """
+        Mide el bloque como una etapa.
+
+        El resultado es "ok", o "error" si el bloque lanza una excepción,
+        salvo que el bloque haya asignado span.outcome.
+
+        :param stage: Nombre de la etapa.
+        :param attributes: Atributos iniciales.
+        """
+        parent = _current_span.get()
+        span = Span(stage, parent.stage if parent is not None else None, **attributes)
+        token = _current_span.set(span)
+        started = time.perf_counter()
+        try:
+            yield span
+        except BaseException:
+            span.outcome = span.outcome or "error"
+            raise
+        else:
+            span.outcome = span.outcome or "ok"
+        finally:
+            span.duration = time.perf_counter() - started
+            _current_span.reset(token)
+            self._emit(span)
+
+    def _emit(self, span: Span) -> None:
+        for hook in self.hooks:
+            try:
+                hook(span)
+            except Exception as e:
+                # Metrics must never break the pipeline
+                logger.warning(f"Error en hook de instrumentación: {e}")
+
+    def flush(self) -> None:
+        """
+        Llama flush() en los hooks que lo tengan (p. ej. para escribir el archivo de métricas).
+        """
+        for hook in self.hooks:
+            flush = getattr(hook, "flush", None)
+            if flush is None:
+                continue
+            try:
+                flush()
+            except Exception as e:
+                logger.warning(f"Error escribiendo métricas: {e}")
+
+
+class StageMetrics:
+    """
+    Hook que agrega las mediciones en histogramas y contadores por etapa.
+    """
+
+    def __init__(self, buckets: tuple = DURATION_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        self._lock = threading.Lock()
+        self._stages: Dict[str, Dict] = {}
+
+    def __call__(self, span: Span) -> None:
+        with self._lock:
+            stage = self._stages.get(span.stage)
+            if stage is None:
+                stage = {
+                    "buckets": [0] * len(self.buckets),
+                    "count": 0,
+                    "sum": 0.0,
+                    "outcomes": {},
+                    "totals": {name: 0 for name in COUNTED_ATTRIBUTES},
+                }
+                self._stages[span.stage] = stage
+            for i, bound in enumerate(self.buckets):
+                if span.duration <= bound:
+                    stage["buckets"][i] += 1
+            stage["count"] += 1
+            stage["sum"] += span.duration
+            stage["outcomes"][span.outcome] = stage["outcomes"].get(span.outcome, 0) + 1
+            for name in COUNTED_ATTRIBUTES:
+                value = span.attributes.get(name)
+                if isinstance(value, (int, float)):
+                    stage["totals"][name] += value
+
+    def snapshot(self) -> Dict:
+        """
+        Copia de las métricas acumuladas por etapa.
+
+        :return: {etapa: {buckets, count, sum, outcomes, totals}}.
+        """
+        with self._lock:
+            return json.loads(json.dumps(self._stages))
+
+    def prometheus_text(self) -> str:
+        """
+        Métricas en el formato de texto de Prometheus.
+        """
+        stages = self.snapshot()
+        lines = [
+            "# HELP pip_stage_duration_seconds Duración de cada etapa del pipeline PIP.",
+            "# TYPE pip_stage_duration_seconds histogram",
+        ]
+        for name, stage in sorted(stages.items()):
+            for bound, count in zip(self.buckets, stage["buckets"]):
+                lines.append(f'pip_stage_duration_seconds_bucket{{stage="{name}",le="{bound}"}} {count}')
+            lines.append(f'pip_stage_duration_seconds_bucket{{stage="{name}",le="+Inf"}} {stage["count"]}')
+            lines.append(f'pip_stage_duration_seconds_sum{{stage="{name}"}} {stage["sum"]:.6f}')
+            lines.append(f'pip_stage_duration_seconds_count{{stage="{name}"}} {stage["count"]}')
+
+        lines += ["# HELP pip_stage_total Etapas terminadas por resultado.", "# TYPE pip_stage_total counter"]
+        for name, stage in sorted(stages.items()):
+            for outcome, count in sorted(stage["outcomes"].items()):
+                lines.append(f'pip_stage_total{{stage="{name}",outcome="{outcome}"}} {count}')
+
+        counters = (
+            ("pip_stage_bytes_total", "bytes", "Bytes enviados por etapa."),
+            ("pip_stage_retries_total", "retries", "Reintentos por etapa."),
+        )
+        for metric, attribute, help_text in counters:
+            lines += [f"# HELP {metric} {help_text}", f"# TYPE {metric} counter"]
+            for name, stage in sorted(stages.items()):
+                lines.append(f'{metric}{{stage="{name}"}} {stage["totals"][attribute]}')
+
+        lines += ["# HELP pip_openai_tokens_total Tokens reportados por OpenAI en usage.",
+                  "# TYPE pip_openai_tokens_total counter"]
+        for name, stage in sorted(stages.items()):
+            for kind in ("prompt", "completion", "cached"):
+                total = stage["totals"][f"{kind}_tokens"]
+                if total:
+                    lines.append(f'pip_openai_tokens_total{{stage="{name}",type="{kind}"}} {total}')
+
+        lines += ["# HELP pip_openai_cached_token_ratio Fracción de los prompt tokens servidos desde la caché de prefijos.",
+                  "# TYPE pip_openai_cached_token_ratio gauge"]
+        for name, stage in sorted(stages.items()):
+            ratio = cached_token_ratio(stage["totals"])
+            if ratio is not None:
+                lines.append(f'pip_openai_cached_token_ratio{{stage="{name}"}} {ratio}')
+        return "\n".join(lines) + "\n"
+
+
+class PrometheusTextfileExporter(StageMetrics):
+    """
+    StageMetrics que escribe sus métricas a un archivo .prom en cada flush
+    (para el textfile collector de node_exporter o para revisarlas a mano).
+
+    :param path: Ruta del archivo .prom.
+    """
+
+    def __init__(self, path: str, buckets: tuple = DURATION_BUCKETS):
+        super().__init__(buckets)
+        self.path = path
+
+    def flush(self) -> None:
+        # Write to a temporary file and rename so readers never see a partial file
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.write(self.prometheus_text())
+        os.replace(tmp_path, self.path)
+
+
+class JsonLinesExporter:
+    """
+    Hook que agrega cada medición como una línea JSON a un archivo.
+
+    :param path: Ruta del archivo .jsonl.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self._file = open(path, "a", encoding="utf-8", buffering=1)
+
+    def __call__(self, span: Span) -> None:
+        line = json.dumps(span.to_dict(), ensure_ascii=False, default=str)
+        with self._lock:
+            self._file.write(line + "\n")
+
+    def flush(self) -> None:
+        with self._lock:
+            self._file.flush()
+
+    def close(self) -> None:
+        with self._lock:
+            self._file.close()
+
+
+_tracer: Optional[Tracer] = None
+_tracer_lock = threading.Lock()
+
+
+def get_tracer() -> Tracer:
+    """
+    Retorna el tracer compartido del proceso, creándolo en el primer uso.
+
+    PIP_TRACE_PATH agrega un JsonLinesExporter y PIP_METRICS_PATH un
+    PrometheusTextfileExporter; sin ninguna de las dos el tracer no tiene hooks.
+
+    :return: Instancia de Tracer.
+    """
+    global _tracer
+    if _tracer is None:
+        with _tracer_lock:
+            if _tracer is None:
+                hooks: List[Callable[[Span], None]] = []
+                if os.getenv("PIP_TRACE_PATH"):
+                    hooks.append(JsonLinesExporter(os.getenv("PIP_TRACE_PATH")))
+                if os.getenv("PIP_METRICS_PATH"):
+                    hooks.append(PrometheusTextfileExporter(os.getenv("PIP_METRICS_PATH")))
+                _tracer = Tracer(hooks)
+    return _tracer
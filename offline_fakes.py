@@ -0,0 +1,606 @@
+import os
+import json
+import time
+import random
+import shutil
+import sqlite3
+import hashlib
+import threading
+from email.parser import BytesParser
+from email.policy import HTTP
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Optional
+
+from bigquery_service import project_prescription
+from openai_service import REJECTION_MESSAGE
+
+
+class FaultInjector:
+    """
+    Latencia y errores configurables para los dobles locales.
+
+    :param latency_ms: Latencia base de cada operación.
+    :param jitter_ms: Latencia adicional aleatoria (uniforme entre 0 y jitter_ms).
+    :param error_rate: Probabilidad de fallar con un error de servidor.
+    :param rate_limit_rate: Probabilidad de responder 429 (solo aplica al doble de OpenAI).
+    :param seed: Semilla para que las corridas sean reproducibles.
+    """
+
+    def __init__(
+        self,
+        latency_ms: float = 0.0,
+        jitter_ms: float = 0.0,
+        error_rate: float = 0.0,
+        rate_limit_rate: float = 0.0,
+        seed: Optional[int] = None,
+    ):
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.error_rate = error_rate
+        self.rate_limit_rate = rate_limit_rate
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def delay(self) -> None:
+        """
+        Duerme la latencia configurada.
+        """
+        with self._lock:
+            jitter = self._random.uniform(0, self.jitter_ms) if self.jitter_ms else 0.0
+        seconds = (self.latency_ms + jitter) / 1000.0
+        if seconds > 0:
+            time.sleep(seconds)
+
+    def roll(self) -> Optional[str]:
+        """
+        Decide si la operación actual falla.
+
+        :return: "error", "rate_limit" o None.
+        """
+        with self._lock:
+            value = self._random.random()
+        if value < self.rate_limit_rate:
+            return "rate_limit"
+        if value < self.rate_limit_rate + self.error_rate:
+            return "error"
+        return None
+
+
+def fake_datos(seed: str) -> Dict:
+    """
+    Genera un `datos` determinista a partir de una semilla (p. ej. la imagen).
+
+    :param seed: Texto del que se deriva el paciente.
+    :return: Diccionario con la estructura que devuelve el modelo.
+    """
+    digest = hashlib.sha256(seed.encode("utf-8")).hexdigest()
+    numero = str(int(digest[:12], 16) % 10 ** 10)
+    return {
+        "tipo_documento": "CC",
+        "numero_documento": numero,
+        "paciente": f"PACIENTE {digest[:6].upper()}",
+        "telefono": [f"3{numero[:9]}"],
+        "fecha_atencion": "01/01/2025",
+        "ips": "IPS LOCAL",
+        "eps": "EPS LOCAL",
+        "doctor": "DOCTOR LOCAL",
+        "regimen": "Contributivo",
+        "ciudad": "Bogotá",
+        "direccion": None,
+        "diagnostico": "Diagnóstico de prueba",
+        "medicamentos": [{"nombre": "ACETAMINOFEN", "dosis": "500 mg", "cantidad": "30"}],
+    }
+
+
+class FakeOpenAIServer:
+    """
+    Servidor HTTP local que imita el endpoint de chat completions.
+
+    Responde un `datos` determinista por imagen, con bloque `usage`, e inyecta
+    latencia, 5xx y 429 según el FaultInjector. Las imágenes cuyo base64
+    contenga `reject_marker` reciben el mensaje de rechazo del prompt. Las
+    solicitudes con varias imágenes reciben el arreglo `imagenes`; con
+    response_format json_schema se responde con la forma del esquema y con
+    "stream": true la respuesta llega como eventos SSE. Las imágenes con
+    detail "low" se tratan como triaje y reciben {"probabilidad": ...}.
+    Como la caché de prefijos del proveedor, un mensaje de sistema de 1024
+    tokens o más que ya se vio se reporta en usage.prompt_tokens_details.cached_tokens.
+
+    También imita la Batch API (/v1/files y /v1/batches): un lote queda
+    completado después de `batch_polls` consultas, y las solicitudes a las que
+    el FaultInjector asigna error van al archivo de errores.
+    """
+
+    def __init__(
+        self,
+        faults: Optional[FaultInjector] = None,
+        reject_marker: Optional[str] = None,
+        batch_polls: int = 1,
+    ):
+        self.faults = faults or FaultInjector()
+        self.reject_marker = reject_marker
+        self.batch_polls = batch_polls
+        self.requests = 0
+        self.bytes_received = 0
+        self.files: Dict[str, bytes] = {}
+        self.batches: Dict[str, Dict] = {}
+        self._prefixes = set()
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), self._handler())
+        self._server.daemon_threads = True
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def url(self) -> str:
+        """
+        URL del endpoint de chat completions del servidor local.
+        """
+        return f"{self.base_url}/chat/completions"
+
+    @property
+    def base_url(self) -> str:
+        """
+        URL base (/v1) del servidor local, para la Batch API.
+        """
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}/v1"
+
+    def _handler(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, format, *args):
+                pass
+
+            def _send(self, status: int, body: Dict, headers: Optional[Dict] = None) -> None:
+                payload = json.dumps(body).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(payload)))
+                for key, value in (headers or {}).items():
+                    self.send_header(key, value)
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def do_GET(self):
+                parts = self.path.strip("/").split("/")
+                if parts[:2] == ["v1", "batches"] and len(parts) == 3:
+                    batch = fake.poll_batch(parts[2])
+                    self._send(200 if batch else 404, batch or {"error": {"message": "No such batch"}})
+                elif parts[:2] == ["v1", "files"] and len(parts) == 4 and parts[3] == "content":
+                    content = fake.files.get(parts[2])
+                    if content is None:
+                        self._send(404, {"error": {"message": "No such file"}})
+                        return
+                    self.send_response(200)
+                    self.send_header("Content-Type", "application/octet-stream")
+                    self.send_header("Content-Length", str(len(content)))
+                    self.end_headers()
+                    self.wfile.write(content)
+                else:
+                    self._send(404, {"error": {"message": "Not found"}})
+
+            def do_POST(self):
+                length = int(self.headers.get("Content-Length", "0"))
+                body = self.rfile.read(length)
+                if self.path.rstrip("/") == "/v1/files":
+                    self._send(200, fake.create_file(self.headers.get("Content-Type", ""), body))
+                    return
+                if self.path.rstrip("/") == "/v1/batches":
+                    batch = fake.create_batch(json.loads(body))
+                    self._send(200 if batch else 400, batch or {"error": {"message": "No such input file"}})
+                    return
+
+                with fake._lock:
+                    fake.requests += 1
+                    fake.bytes_received += length
+                fake.faults.delay()
+
+                outcome = fake.faults.roll()
+                if outcome == "rate_limit":
+                    self._send(429, {"error": {"message": "Rate limit reached"}}, {"Retry-After": "0"})
+                    return
+                if outcome == "error":
+                    self._send(500, {"error": {"message": "Internal error"}})
+                    return
+
+                request = json.loads(body)
+                completion = fake.completion(request)
+                if not request.get("stream"):
+                    self._send(200, completion)
+                    return
+
+                payload = "".join(
+                    f"data: {json.dumps(event)}\n\n" for event in fake.stream_events(completion)
+                ).encode("utf-8") + b"data: [DONE]\n\n"
+                self.send_response(200)
+                self.send_header("Content-Type", "text/event-stream")
+                self.send_header("Content-Length", str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+        return Handler
+
+    def completion(self, request: Dict) -> Dict:
+        """
+        Construye la respuesta de chat completions para una solicitud.
+
+        :param request: Cuerpo JSON recibido.
+        :return: Respuesta con choices y usage.
+        """
+        image_urls = []
+        low_detail = False
+        prompt = ""
+        for message in request.get("messages", []):
+            if isinstance(message.get("content"), str):
+                prompt += message["content"]
+                continue
+            for part in message.get("content", []):
+                if part.get("type") == "image_url":
+                    image_urls.append(part["image_url"]["url"])
+                    low_detail = low_detail or part["image_url"].get("detail") == "low"
+                elif part.get("type") == "text":
+                    prompt += part["text"]
+
+        schema = (request.get("response_format") or {}).get("type") == "json_schema"
+
+        def rejected(image_url: str) -> bool:
+            return bool(self.reject_marker) and self.reject_marker in image_url
+
+        def result(image_url: str) -> Dict:
+            if schema:
+                return {"rechazada": rejected(image_url), "datos": None if rejected(image_url) else fake_datos(image_url[-256:])}
+            return {"rechazada": True} if rejected(image_url) else {"datos": fake_datos(image_url[-256:])}
+
+        if low_detail:
+            content = json.dumps({"probabilidad": 0.05 if rejected(image_urls[0]) else 0.95})
+        elif len(image_urls) > 1:
+            content = json.dumps({"imagenes": [
+                {"imagen": number, **result(image_url)} for number, image_url in enumerate(image_urls, start=1)
+            ]}, ensure_ascii=False)
+        elif not schema and image_urls and rejected(image_urls[0]):
+            content = REJECTION_MESSAGE
+        else:
+            content = json.dumps(result((image_urls or [""])[0]), ensure_ascii=False)
+
+        prompt_tokens = len(prompt) // 4 + 1105
+        completion_tokens = len(content) // 4
+        system = next((m["content"] for m in request.get("messages", [])
+                       if m.get("role") == "system" and isinstance(m.get("content"), str)), "")
+        prefix = hashlib.sha256(system.encode("utf-8")).digest()
+        with self._lock:
+            seen = prefix in self._prefixes
+            self._prefixes.add(prefix)
+        # Cache hits are counted in 128-token blocks from 1024 tokens up
+        cached_tokens = len(system) // 4 // 128 * 128 if seen and len(system) // 4 >= 1024 else 0
+        return {
+            "id": "chatcmpl-local",
+            "object": "chat.completion",
+            "model": request.get("model"),
+            "choices": [{"index": 0, "message": {"role": "assistant", "content": content}, "finish_reason": "stop"}],
+            "usage": {
+                "prompt_tokens": prompt_tokens,
+                "completion_tokens": completion_tokens,
+                "total_tokens": prompt_tokens + completion_tokens,
+                "prompt_tokens_details": {"cached_tokens": cached_tokens},
+            },
+        }
+
+    def create_file(self, content_type: str, body: bytes) -> Dict:
+        """
+        Guarda un archivo subido como multipart/form-data (POST /v1/files).
+
+        :param content_type: Header Content-Type de la solicitud.
+        :param body: Cuerpo de la solicitud.
+        :return: Objeto file.
+        """
+        message = BytesParser(policy=HTTP).parsebytes(
+            f"Content-Type: {content_type}\r\n\r\n".encode("latin-1") + body
+        )
+        content = b""
+        for part in message.iter_parts():
+            if part.get_param("name", header="content-disposition") == "file":
+                content = part.get_payload(decode=True) or b""
+        with self._lock:
+            file_id = f"file-{len(self.files) + 1}"
+            self.files[file_id] = content
+        return {"id": file_id, "object": "file", "bytes": len(content), "purpose": "batch"}
+
+    def create_batch(self, request: Dict) -> Optional[Dict]:
+        """
+        Crea un lote (POST /v1/batches).
+
+        :param request: Cuerpo con input_file_id, endpoint y completion_window.
+        :return: Objeto batch, o None si el archivo no existe.
+        """
+        if request.get("input_file_id") not in self.files:
+            return None
+        with self._lock:
+            batch_id = f"batch_{len(self.batches) + 1}"
+            self.batches[batch_id] = {
+                "id": batch_id,
+                "object": "batch",
+                "endpoint": request.get("endpoint"),
+                "input_file_id": request["input_file_id"],
+                "completion_window": request.get("completion_window"),
+                "status": "validating",
+                "output_file_id": None,
+                "error_file_id": None,
+                "metadata": request.get("metadata"),
+                "request_counts": {"total": 0, "completed": 0, "failed": 0},
+                "polls": 0,
+            }
+            return {k: v for k, v in self.batches[batch_id].items() if k != "polls"}
+
+    def poll_batch(self, batch_id: str) -> Optional[Dict]:
+        """
+        Consulta un lote (GET /v1/batches/{id}); lo ejecuta en la consulta número `batch_polls`.
+
+        :param batch_id: ID del lote.
+        :return: Objeto batch, o None si no existe.
+        """
+        with self._lock:
+            batch = self.batches.get(batch_id)
+            if batch is None:
+                return None
+            batch["polls"] += 1
+            run = batch["status"] in ("validating", "in_progress") and batch["polls"] >= self.batch_polls
+            if run:
+                batch["status"] = "finalizing"
+            elif batch["status"] == "validating":
+                batch["status"] = "in_progress"
+            lines = self.files[batch["input_file_id"]].decode("utf-8").splitlines() if run else []
+
+        outputs, errors = [], []
+        for number, line in enumerate(filter(None, lines), start=1):
+            request = json.loads(line)
+            result = {"id": f"batch_req_{number}", "custom_id": request["custom_id"], "error": None}
+            if self.faults.roll() is None:
+                result["response"] = {"status_code": 200, "request_id": f"req_{number}", "body": self.completion(request["body"])}
+                outputs.append(result)
+            else:
+                result["response"] = {"status_code": 500, "request_id": f"req_{number}", "body": {"error": {"message": "Internal error"}}}
+                errors.append(result)
+
+        with self._lock:
+            if run:
+                for key, rows in (("output_file_id", outputs), ("error_file_id", errors)):
+                    if rows:
+                        file_id = f"file-{len(self.files) + 1}"
+                        self.files[file_id] = "".join(json.dumps(row) + "\n" for row in rows).encode("utf-8")
+                        batch[key] = file_id
+                batch["request_counts"] = {"total": len(outputs) + len(errors), "completed": len(outputs), "failed": len(errors)}
+                batch["status"] = "completed"
+            return {k: v for k, v in batch.items() if k != "polls"}
+
+    @staticmethod
+    def stream_events(completion: Dict, chunk_size: int = 16) -> List[Dict]:
+        """
+        Parte una respuesta en los eventos de streaming de chat completions.
+
+        :param completion: Respuesta construida por completion().
+        :param chunk_size: Caracteres de contenido por evento.
+        :return: Eventos con `delta`, y al final uno con `usage`.
+        """
+        content = completion["choices"][0]["message"]["content"]
+        events = [
+            {"id": completion["id"], "model": completion["model"],
+             "choices": [{"index": 0, "delta": {"content": content[i:i + chunk_size]}, "finish_reason": None}]}
+            for i in range(0, len(content), chunk_size)
+        ]
+        events.append({"id": completion["id"], "model": completion["model"], "choices": [], "usage": completion["usage"]})
+        return events
+
+    def start(self) -> "FakeOpenAIServer":
+        """
+        Inicia el servidor en un hilo de fondo.
+        """
+        self._thread = threading.Thread(target=self._server.serve_forever, name="fake-openai", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        """
+        Detiene el servidor.
+        """
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self) -> "FakeOpenAIServer":
+        return self.start()
+
+    def __exit__(self, *exc) -> None:
+        self.stop()
+
+
+class FilesystemBlob:
+    """
+    Blob de FilesystemBucket guardado como archivo.
+
+    generation y metageneration se llevan en el bucket con la misma regla de
+    GCS: cada escritura crea una generation nueva con metageneration 1, y cada
+    patch() de metadatos sube la metageneration.
+    """
+
+    def __init__(self, bucket: "FilesystemBucket", name: str):
+        self.bucket = bucket
+        self.name = name
+        self.path = os.path.join(bucket.root, name)
+        self.metadata: Optional[Dict] = None
+
+    @property
+    def generation(self) -> Optional[int]:
+        return self.bucket.generations.get(self.name, (None, None))[0]
+
+    def exists(self) -> bool:
+        self.bucket.faults.delay()
+        return os.path.exists(self.path)
+
+    def _write(self, write, if_generation_match: Optional[int]) -> None:
+        self.bucket.faults.delay()
+        if self.bucket.faults.roll() is not None:
+            raise RuntimeError("503 Service Unavailable (simulado)")
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with self.bucket.lock:
+            if if_generation_match == 0 and os.path.exists(self.path):
+                # Same exception GCSUploader expects from the real precondition
+                from cloud_storage_service import api_exceptions
+                raise api_exceptions.PreconditionFailed(self.name)
+            write()
+            self.bucket.uploads += 1
+            self.bucket.generations[self.name] = (self.bucket.next_generation(), 1)
+
+    def upload_from_filename(self, filename: str, content_type: Optional[str] = None, if_generation_match: Optional[int] = None) -> None:
+        self._write(lambda: shutil.copyfile(filename, self.path), if_generation_match)
+
+    def upload_from_string(self, data: bytes, content_type: Optional[str] = None, if_generation_match: Optional[int] = None) -> None:
+        def write():
+            with open(self.path, "wb") as f:
+                f.write(data)
+        self._write(write, if_generation_match)
+
+    def patch(self) -> None:
+        from cloud_storage_service import api_exceptions
+        with self.bucket.lock:
+            if not os.path.exists(self.path):
+                raise api_exceptions.NotFound(self.name)
+            generation, metageneration = self.bucket.generations.get(self.name, (None, 1))
+            self.bucket.generations[self.name] = (generation, metageneration + 1)
+
+    def delete(self, if_generation_match: Optional[int] = None, if_metageneration_match: Optional[int] = None) -> None:
+        from cloud_storage_service import api_exceptions
+        with self.bucket.lock:
+            if not os.path.exists(self.path):
+                raise api_exceptions.NotFound(self.name)
+            generation, metageneration = self.bucket.generations.get(self.name, (None, 1))
+            if (if_generation_match is not None and if_generation_match != generation) or (
+                if_metageneration_match is not None and if_metageneration_match != metageneration
+            ):
+                raise api_exceptions.PreconditionFailed(self.name)
+            os.remove(self.path)
+            self.bucket.generations.pop(self.name, None)
+
+
+class FilesystemBucket:
+    """
+    Doble local de un bucket de GCS respaldado por una carpeta.
+
+    Implementa lo que usa GCSUploader: blob(), exists(), upload_from_*,
+    patch(), delete() con precondiciones y copy_blob().
+    """
+
+    def __init__(self, root: str, faults: Optional[FaultInjector] = None):
+        self.root = root
+        self.faults = faults or FaultInjector()
+        self.lock = threading.Lock()
+        self.uploads = 0
+        # blob name -> (generation, metageneration)
+        self.generations: Dict[str, tuple] = {}
+        self._generation = 0
+        os.makedirs(root, exist_ok=True)
+
+    def next_generation(self) -> int:
+        self._generation += 1
+        return self._generation
+
+    def blob(self, name: str, chunk_size: Optional[int] = None) -> FilesystemBlob:
+        return FilesystemBlob(self, name)
+
+    def copy_blob(self, blob: FilesystemBlob, destination_bucket: "FilesystemBucket", new_name: str) -> FilesystemBlob:
+        target = destination_bucket.blob(new_name)
+        os.makedirs(os.path.dirname(target.path), exist_ok=True)
+        shutil.copyfile(blob.path, target.path)
+        with destination_bucket.lock:
+            destination_bucket.generations[new_name] = (destination_bucket.next_generation(), 1)
+        return target
+
+
+class SQLitePatientStore:
+    """
+    Emulación en SQLite de la tabla de pacientes y su MERGE.
+
+    Tiene la misma interfaz que bigquery_service (insert_or_update_patient_data
+    y upsert_patients) y la misma semántica: los campos enviados se
+    sobrescriben y las prescripciones se concatenan sin duplicados. Las
+    prescripciones se guardan con la misma proyección que el STRUCT del MERGE
+    (bigquery_service.project_prescription), así un campo que BigQuery
+    recibiría como NULL también queda en None aquí. Cada llamada cuenta como
+    un "job" y paga la latencia del FaultInjector.
+    """
+
+    def __init__(self, path: str = ":memory:", faults: Optional[FaultInjector] = None):
+        self.faults = faults or FaultInjector()
+        self.jobs = 0
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("CREATE TABLE IF NOT EXISTS pacientes (paciente_clave TEXT PRIMARY KEY, fila TEXT NOT NULL)")
+
+    def _merge(self, paciente: Dict) -> None:
+        if "paciente_clave" not in paciente:
+            raise ValueError("paciente_clave is missing from input and is required for MERGE.")
+        if "prescripciones" in paciente:
+            paciente = {**paciente, "prescripciones": [project_prescription(p) for p in paciente["prescripciones"] or []]}
+        row = self._conn.execute(
+            "SELECT fila FROM pacientes WHERE paciente_clave = ?", (paciente["paciente_clave"],)
+        ).fetchone()
+        if row is None:
+            merged = dict(paciente)
+        else:
+            merged = json.loads(row[0])
+            for key, value in paciente.items():
+                if key == "prescripciones":
+                    existing = merged.get(key) or []
+                    seen = {json.dumps(p, sort_keys=True) for p in existing}
+                    merged[key] = existing + [
+                        p for p in (value or []) if json.dumps(p, sort_keys=True) not in seen
+                    ]
+                else:
+                    merged[key] = value
+        self._conn.execute(
+            "INSERT OR REPLACE INTO pacientes (paciente_clave, fila) VALUES (?, ?)",
+            (paciente["paciente_clave"], json.dumps(merged, ensure_ascii=False)),
+        )
+
+    def _job(self, pacientes: List[Dict]) -> None:
+        self.faults.delay()
+        if self.faults.roll() is not None:
+            raise Exception("Error during MERGE operation: 500 backendError (simulado)")
+        with self._lock:
+            self.jobs += 1
+            self._conn.execute("BEGIN")
+            try:
+                for paciente in pacientes:
+                    self._merge(paciente)
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+            self._conn.execute("COMMIT")
+
+    def insert_or_update_patient_data(self, paciente: Dict) -> None:
+        self._job([paciente])
+
+    def upsert_patients(self, records: List[Dict], batch_size: Optional[int] = None) -> int:
+        self._job(records)
+        return len({r["paciente_clave"] for r in records})
+
+    def get(self, paciente_clave: str) -> Optional[Dict]:
+        """
+        Lee el estado actual de un paciente.
+
+        :param paciente_clave: Llave del paciente.
+        :return: Fila del paciente o None.
+        """
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT fila FROM pacientes WHERE paciente_clave = ?", (paciente_clave,)
+            ).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def count(self) -> int:
+        """
+        Número de pacientes en la tabla.
+        """
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM pacientes").fetchone()[0]
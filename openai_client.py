@@ -0,0 +1,500 @@
+import os
+import time
+import asyncio
+import random
+import logging
+import threading
+import weakref
+from email.utils import parsedate_to_datetime
+from typing import Dict, Mapping, NamedTuple, Optional, Tuple, Union
+
+from instrumentation import annotate
+from startup import LazyModule, load_env
+
+
+logger = logging.getLogger(__name__)
+
+# Imported on first request so it does not slow down cold starts
+requests = LazyModule("requests")
+aiohttp = LazyModule("aiohttp")
+
+DEFAULT_API_URL = "https://api.openai.com/v1/chat/completions"
+
+# Status codes worth retrying: rate limit and transient server errors
+RETRYABLE_STATUS = (408, 409, 429, 500, 502, 503, 504)
+
+# Rough token cost of one image at detail=auto, used only for the TPM budget
+IMAGE_TOKEN_ESTIMATE = 1105
+
+
+def estimate_tokens(prompt: str, max_tokens: int, images: int = 1) -> int:
+    """
+    Estima los tokens que una llamada consume del límite por minuto.
+
+    OpenAI descuenta del límite el prompt más max_tokens, así que la estimación
+    usa ~4 caracteres por token para el texto y un costo fijo por imagen.
+
+    :param prompt: Texto del prompt.
+    :param max_tokens: Máximo de tokens de la respuesta.
+    :param images: Número de imágenes en el mensaje.
+    :return: Tokens estimados.
+    """
+    return len(prompt) // 4 + images * IMAGE_TOKEN_ESTIMATE + max_tokens
+
+
+class TokenBucket:
+    """
+    Limitador token bucket: `rate_per_minute` unidades por minuto con ráfagas
+    de hasta `capacity`.
+    """
+
+    def __init__(self, rate_per_minute: float, capacity: Optional[float] = None):
+        self.rate = rate_per_minute / 60.0
+        self.capacity = capacity or rate_per_minute
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def try_acquire(self, amount: float = 1) -> float:
+        """
+        Consume `amount` unidades si están disponibles, sin bloquear.
+
+        :param amount: Unidades a consumir (se limita a la capacidad).
+        :return: 0.0 si se consumieron; si no, segundos que faltan para que alcancen.
+        """
+        amount = min(amount, self.capacity)
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            if self._tokens >= amount:
+                self._tokens -= amount
+                return 0.0
+            return (amount - self._tokens) / self.rate
+
+    def acquire(self, amount: float = 1) -> float:
+        """
+        Bloquea hasta que haya `amount` unidades disponibles y las consume.
+
+        :param amount: Unidades a consumir (se limita a la capacidad).
+        :return: Segundos que se esperó.
+        """
+        waited = 0.0
+        while True:
+            delay = self.try_acquire(amount)
+            if not delay:
+                return waited
+            time.sleep(delay)
+            waited += delay
+
+    async def acquire_async(self, amount: float = 1) -> float:
+        """
+        Igual que acquire, pero espera sin bloquear el event loop.
+
+        :param amount: Unidades a consumir (se limita a la capacidad).
+        :return: Segundos que se esperó.
+        """
+        waited = 0.0
+        while True:
+            delay = self.try_acquire(amount)
+            if not delay:
+                return waited
+            await asyncio.sleep(delay)
+            waited += delay
+
+
+_limiters: Dict[tuple, Tuple[TokenBucket, TokenBucket]] = {}
+_limiters_lock = threading.Lock()
+
+
+def shared_limiters(
+    api_key: Optional[str], api_url: str, requests_per_minute: float, tokens_per_minute: float
+) -> Tuple[TokenBucket, TokenBucket]:
+    """
+    Limitadores de solicitudes y de tokens del proceso para una cuenta.
+
+    OpenAI aplica los límites por minuto a toda la API key, así que el cliente
+    síncrono y los asíncronos (uno por event loop) con la misma key, endpoint
+    y límites descuentan de los mismos buckets.
+
+    :param api_key: API key.
+    :param api_url: Endpoint de chat completions.
+    :param requests_per_minute: Límite de solicitudes.
+    :param tokens_per_minute: Límite de tokens.
+    :return: Tupla (limitador de solicitudes, limitador de tokens).
+    """
+    key = (api_key, api_url, requests_per_minute, tokens_per_minute)
+    with _limiters_lock:
+        if key not in _limiters:
+            _limiters[key] = (TokenBucket(requests_per_minute), TokenBucket(tokens_per_minute))
+        return _limiters[key]
+
+
+def retry_after_seconds(response: "requests.Response") -> Optional[float]:
+    """
+    Lee el tiempo de espera sugerido por el servidor.
+
+    :param response: Respuesta con status 429 o 5xx.
+    :return: Segundos a esperar, o None si no viene en los headers.
+    """
+    retry_after_ms = response.headers.get("retry-after-ms")
+    if retry_after_ms:
+        try:
+            return float(retry_after_ms) / 1000.0
+        except ValueError:
+            pass
+    retry_after = response.headers.get("Retry-After")
+    if not retry_after:
+        return None
+    try:
+        return max(0.0, float(retry_after))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(retry_after).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+class _ChatCompletionsClient:
+    """
+    Configuración, límites por minuto, backoff y contadores comunes a los
+    clientes síncrono y asíncrono. Los límites son los del proceso
+    (shared_limiters), no los de cada instancia.
+    """
+
+    def __init__(
+        self,
+        api_key: Optional[str] = None,
+        api_url: Optional[str] = None,
+        requests_per_minute: Optional[float] = None,
+        tokens_per_minute: Optional[float] = None,
+        max_retries: Optional[int] = None,
+        connect_timeout: Optional[float] = None,
+        read_timeout: Optional[float] = None,
+        pool_size: Optional[int] = None,
+        backoff_base: float = 1.0,
+        backoff_max: float = 60.0,
+    ):
+        """
+        :param api_key: API key (OPENAI_API_KEY).
+        :param api_url: Endpoint de chat completions (OPENAI_API_URL).
+        :param requests_per_minute: Límite de solicitudes (OPENAI_RPM, default 500).
+        :param tokens_per_minute: Límite de tokens (OPENAI_TPM, default 200000).
+        :param max_retries: Reintentos por llamada (OPENAI_MAX_RETRIES, default 5).
+        :param connect_timeout: Timeout de conexión en segundos (OPENAI_CONNECT_TIMEOUT, default 5).
+        :param read_timeout: Timeout de lectura en segundos (OPENAI_READ_TIMEOUT, default 120).
+        :param pool_size: Conexiones reutilizables (OPENAI_POOL_SIZE, default 16).
+        :param backoff_base: Espera base del backoff exponencial.
+        :param backoff_max: Espera máxima entre reintentos.
+        """
+        load_env()
+        self.api_key = api_key or os.getenv("OPENAI_API_KEY")
+        self.api_url = api_url or os.getenv("OPENAI_API_URL", DEFAULT_API_URL)
+        self.max_retries = max_retries if max_retries is not None else int(os.getenv("OPENAI_MAX_RETRIES", "5"))
+        self.timeout = (
+            connect_timeout or float(os.getenv("OPENAI_CONNECT_TIMEOUT", "5")),
+            read_timeout or float(os.getenv("OPENAI_READ_TIMEOUT", "120")),
+        )
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+
+        self.request_limiter, self.token_limiter = shared_limiters(
+            self.api_key,
+            self.api_url,
+            requests_per_minute or float(os.getenv("OPENAI_RPM", "500")),
+            tokens_per_minute or float(os.getenv("OPENAI_TPM", "200000")),
+        )
+        self.pool_size = pool_size or int(os.getenv("OPENAI_POOL_SIZE", "16"))
+        self.headers = {
+            "Authorization": f"Bearer {self.api_key}",
+            "Content-Type": "application/json"
+        }
+
+        self._stats_lock = threading.Lock()
+        self._stats = {
+            "requests": 0,
+            "retries": 0,
+            "rate_limited": 0,
+            "server_errors": 0,
+            "connection_errors": 0,
+            "throttled_seconds": 0.0,
+            "backoff_seconds": 0.0,
+        }
+
+    def _count(self, name: str, amount: float = 1) -> None:
+        with self._stats_lock:
+            self._stats[name] += amount
+
+    def stats(self) -> Dict:
+        """
+        Retorna los contadores del cliente.
+
+        :return: Solicitudes, reintentos, 429, 5xx, errores de conexión y
+            segundos esperados por el limitador y por el backoff.
+        """
+        with self._stats_lock:
+            return dict(self._stats)
+
+    def _backoff(self, attempt: int, response=None) -> float:
+        delay = retry_after_seconds(response) if response is not None else None
+        if delay is None:
+            # Full jitter: uniform between 0 and the exponential cap
+            delay = random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+        return min(delay, self.backoff_max)
+
+
+class _BodyReader:
+    """
+    Lee un cuerpo ya serializado por bloques, para que requests lo envíe sin
+    copiarlo entero. Cada intento necesita uno nuevo.
+    """
+
+    def __init__(self, body: Union[bytes, memoryview], block_size: int = 64 * 1024):
+        self._body = memoryview(body)
+        self._size = len(self._body)
+        self._position = 0
+        self._block_size = block_size
+
+    def __len__(self) -> int:
+        return self._size - self._position
+
+    def read(self, size: int = -1) -> bytes:
+        if self._position >= self._size:
+            # Drop the view so the caller can free the underlying buffer
+            self._body.release()
+            return b""
+        if size is None or size < 0:
+            size = self._block_size
+        chunk = bytes(self._body[self._position:self._position + size])
+        self._position += len(chunk)
+        return chunk
+
+
+class OpenAIClient(_ChatCompletionsClient):
+    """
+    Cliente HTTP compartido para chat completions.
+
+    Reutiliza conexiones (keep-alive) con un pool de `requests.Session`, limita
+    solicitudes y tokens por minuto del lado del cliente, usa timeouts
+    explícitos y reintenta 429/5xx respetando Retry-After con backoff
+    exponencial y jitter.
+    """
+
+    def __init__(self, *args, **kwargs):
+        """
+        Recibe los mismos parámetros que _ChatCompletionsClient.
+        """
+        super().__init__(*args, **kwargs)
+        self.session = requests.Session()
+        adapter_kwargs = {"pool_connections": 1, "pool_maxsize": self.pool_size}
+        self.session.mount("https://", requests.adapters.HTTPAdapter(**adapter_kwargs))
+        self.session.mount("http://", requests.adapters.HTTPAdapter(**adapter_kwargs))
+        self.session.headers.update(self.headers)
+
+    def post_json(
+        self,
+        payload: Union[Dict, bytes, memoryview],
+        estimated_tokens: int = 0,
+        stream: bool = False,
+    ) -> "requests.Response":
+        """
+        Envía una solicitud a chat completions con límites y reintentos.
+
+        :param payload: Cuerpo JSON de la solicitud, o ese cuerpo ya serializado
+            (p. ej. la memoria compartida de cpu_pool), que se envía sin copiarlo entero.
+        :param estimated_tokens: Tokens a descontar del límite por minuto.
+        :param stream: No leer el cuerpo de la respuesta (streaming); el llamador
+            debe cerrarla.
+        :return: Última respuesta recibida (exitosa o no, tras agotar reintentos).
+        :raises requests.RequestException: Si todos los intentos fallan por conexión/timeout.
+        """
+        attempt = 0
+        throttled_total = 0.0
+        while True:
+            throttled = self.request_limiter.acquire()
+            throttled += self.token_limiter.acquire(estimated_tokens)
+            if throttled:
+                self._count("throttled_seconds", throttled)
+                throttled_total += throttled
+
+            self._count("requests")
+            response = None
+            try:
+                if isinstance(payload, dict):
+                    body = {"json": payload}
+                else:
+                    body = {"data": _BodyReader(payload), "headers": {"Content-Type": "application/json"}}
+                response = self.session.post(self.api_url, timeout=self.timeout, stream=stream, **body)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                self._count("connection_errors")
+                if attempt >= self.max_retries:
+                    annotate(retries=attempt, throttled_seconds=round(throttled_total, 3))
+                    raise
+                logger.warning(f"Error de conexión con OpenAI (intento {attempt + 1}): {e}")
+            else:
+                if response.status_code not in RETRYABLE_STATUS or attempt >= self.max_retries:
+                    annotate(retries=attempt, throttled_seconds=round(throttled_total, 3), status=response.status_code)
+                    return response
+                self._count("rate_limited" if response.status_code == 429 else "server_errors")
+                logger.warning(f"OpenAI respondió {response.status_code} (intento {attempt + 1}), reintentando")
+                # Return the connection to the pool before retrying
+                response.close()
+
+            delay = self._backoff(attempt, response)
+            self._count("retries")
+            self._count("backoff_seconds", delay)
+            time.sleep(delay)
+            attempt += 1
+
+
+class AsyncResponse(NamedTuple):
+    """
+    Respuesta ya leída de AsyncOpenAIClient (la conexión vuelve al pool).
+    """
+    status_code: int
+    headers: Mapping
+    body: Optional[Dict]
+
+
+class AsyncOpenAIClient(_ChatCompletionsClient):
+    """
+    Versión asyncio de OpenAIClient sobre `aiohttp`.
+
+    Mismos timeouts, reintentos y contadores, y los mismos limitadores del
+    proceso que OpenAIClient (shared_limiters), pero las esperas no
+    bloquean el event loop. La `aiohttp.ClientSession` se crea en el primer
+    uso dentro del loop y se libera con close().
+    """
+
+    def __init__(self, *args, **kwargs):
+        """
+        Recibe los mismos parámetros que _ChatCompletionsClient.
+        """
+        super().__init__(*args, **kwargs)
+        self.session = None
+
+    def _get_session(self) -> "aiohttp.ClientSession":
+        if self.session is None or self.session.closed:
+            self.session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.pool_size),
+                timeout=aiohttp.ClientTimeout(sock_connect=self.timeout[0], sock_read=self.timeout[1]),
+                headers=self.headers,
+            )
+        return self.session
+
+    async def post_json(self, payload: Dict, estimated_tokens: int = 0) -> AsyncResponse:
+        """
+        Envía una solicitud a chat completions con límites y reintentos.
+
+        :param payload: Cuerpo JSON de la solicitud.
+        :param estimated_tokens: Tokens a descontar del límite por minuto.
+        :return: Última respuesta recibida (exitosa o no, tras agotar reintentos).
+        :raises aiohttp.ClientError: Si todos los intentos fallan por conexión.
+        :raises asyncio.TimeoutError: Si todos los intentos fallan por timeout.
+        """
+        session = self._get_session()
+        attempt = 0
+        throttled_total = 0.0
+        while True:
+            throttled = await self.request_limiter.acquire_async()
+            throttled += await self.token_limiter.acquire_async(estimated_tokens)
+            if throttled:
+                self._count("throttled_seconds", throttled)
+                throttled_total += throttled
+
+            self._count("requests")
+            response = None
+            try:
+                async with session.post(self.api_url, json=payload) as raw:
+                    try:
+                        body = await raw.json(content_type=None) if raw.status == 200 else None
+                    except ValueError:
+                        body = None
+                    # CIMultiDictProxy: case-insensitive like requests, for retry_after_seconds
+                    response = AsyncResponse(raw.status, raw.headers, body)
+            except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as e:
+                self._count("connection_errors")
+                if attempt >= self.max_retries:
+                    annotate(retries=attempt, throttled_seconds=round(throttled_total, 3))
+                    raise
+                logger.warning(f"Error de conexión con OpenAI (intento {attempt + 1}): {e!r}")
+            else:
+                if response.status_code not in RETRYABLE_STATUS or attempt >= self.max_retries:
+                    annotate(retries=attempt, throttled_seconds=round(throttled_total, 3), status=response.status_code)
+                    return response
+                self._count("rate_limited" if response.status_code == 429 else "server_errors")
+                logger.warning(f"OpenAI respondió {response.status_code} (intento {attempt + 1}), reintentando")
+
+            delay = self._backoff(attempt, response)
+            self._count("retries")
+            self._count("backoff_seconds", delay)
+            await asyncio.sleep(delay)
+            attempt += 1
+
+    async def close(self) -> None:
+        """
+        Cierra la sesión HTTP y sus conexiones.
+        """
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
+
+
+_client: Optional[OpenAIClient] = None
+_client_lock = threading.Lock()
+
+
+def get_client() -> OpenAIClient:
+    """
+    Retorna el cliente compartido del proceso, creándolo en el primer uso.
+
+    :return: Instancia de OpenAIClient.
+    """
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                _client = OpenAIClient()
+    return _client
+
+
+def set_client(client: OpenAIClient) -> None:
+    """
+    Reemplaza el cliente compartido (p. ej. uno apuntando a un servidor local).
+
+    :param client: Cliente a usar en adelante.
+    """
+    global _client
+    with _client_lock:
+        _client = client
+
+
+_async_clients: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, AsyncOpenAIClient]" = weakref.WeakKeyDictionary()
+
+
+def get_async_client() -> AsyncOpenAIClient:
+    """
+    Retorna el cliente asíncrono del event loop actual, creándolo en el primer uso.
+
+    Una `aiohttp.ClientSession` solo sirve en el loop donde se creó, por eso
+    hay un cliente por loop.
+
+    :return: Instancia de AsyncOpenAIClient.
+    """
+    loop = asyncio.get_running_loop()
+    client = _async_clients.get(loop)
+    if client is None:
+        client = _async_clients[loop] = AsyncOpenAIClient()
+    return client
+
+
+def reset_client() -> None:
+    """
+    Descarta el cliente compartido (p. ej. después de cambiar variables de entorno).
+    """
+    global _client
+    with _client_lock:
+        if _client is not None:
+            _client.session.close()
+        _client = None
@@ -1,51 +1,504 @@
 import os
+import re
+import json
 import base64
-import requests
+import asyncio
 
-from typing import Optional
-from dotenv import load_dotenv
+from typing import Callable, Dict, List, Optional, Tuple
 
-load_dotenv()
+from image_preprocessing import detect_mime_type
+from instrumentation import annotate
+from openai_client import AsyncOpenAIClient, aiohttp, estimate_tokens, get_async_client, get_client, requests
+from prompt_registry import prompt_version
+from startup import load_env
 
-OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
-OPENAI_API_URL = "https://api.openai.com/v1/chat/completions"
 
+REJECTION_MESSAGE = (
+    "Por favor, envía una foto de una fórmula médica válida y legible para poder procesarla correctamente."
+)
+# Substring of REJECTION_MESSAGE that identifies a rejected image in free text
+REJECTION_MARKER = "fórmula médica válida"
 
-def extract_data_from_prescription(image_path: str, prompt: str) -> str:
+IDENTITY_FIELDS = ("tipo_documento", "numero_documento")
+
+
+def _nullable(type_name: str) -> Dict:
+    return {"type": [type_name, "null"]}
+
+
+# Same fields and order as the "datos" object in prompt_PIP.txt. Identity fields
+# come first so they can be validated while the completion is still streaming.
+DATOS_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "tipo_documento": {"type": ["string", "null"], "enum": ["CC", "TI", "RC", "PPT", "PP", None]},
+        "numero_documento": _nullable("string"),
+        "paciente": _nullable("string"),
+        "telefono": {"type": "array", "items": {"type": "string"}},
+        "fecha_atencion": _nullable("string"),
+        "ips": _nullable("string"),
+        "eps": _nullable("string"),
+        "doctor": _nullable("string"),
+        "regimen": _nullable("string"),
+        "ciudad": _nullable("string"),
+        "direccion": _nullable("string"),
+        "diagnostico": _nullable("string"),
+        "medicamentos": {
+            "type": "array",
+            "items": {
+                "type": "object",
+                "properties": {
+                    "nombre": _nullable("string"),
+                    "dosis": _nullable("string"),
+                    "cantidad": _nullable("string"),
+                },
+                "required": ["nombre", "dosis", "cantidad"],
+                "additionalProperties": False,
+            },
+        },
+    },
+    "additionalProperties": False,
+}
+DATOS_SCHEMA["required"] = list(DATOS_SCHEMA["properties"])
+
+_RESULT_PROPERTIES = {
+    "rechazada": {"type": "boolean", "description": "true si la imagen no contiene una fórmula médica."},
+    "datos": {"anyOf": [DATOS_SCHEMA, {"type": "null"}]},
+}
+
+RESPONSE_SCHEMA = {
+    "type": "object",
+    "properties": _RESULT_PROPERTIES,
+    "required": ["rechazada", "datos"],
+    "additionalProperties": False,
+}
+
+MULTI_RESPONSE_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "imagenes": {
+            "type": "array",
+            "items": {
+                "type": "object",
+                "properties": {"imagen": {"type": "integer"}, **_RESULT_PROPERTIES},
+                "required": ["imagen", "rechazada", "datos"],
+                "additionalProperties": False,
+            },
+        },
+    },
+    "required": ["imagenes"],
+    "additionalProperties": False,
+}
+
+# Appended to the system prompt (never interleaved) so the prefix stays identical across requests.
+MULTI_IMAGE_INSTRUCTIONS = """
+
+MODO VARIAS IMÁGENES: en este mensaje recibirás varias imágenes, cada una precedida por el texto "Imagen N".
+Analiza cada imagen por separado con las reglas anteriores y devuelve UN solo objeto JSON con esta estructura:
+{
+  "imagenes": [
+    {"imagen": 1, "datos": { ...misma estructura de "datos"... }},
+    {"imagen": 2, "rechazada": true}
+  ]
+}
+Incluye exactamente un elemento por imagen, en el mismo orden. Usa "rechazada": true (sin "datos") para las imágenes que no contienen una fórmula médica.
+"""
+
+
+def model_params() -> Dict:
     """
-    Envía una imagen y prompt a la API de OpenAI para extraer información.
+    Modelo y parámetros de la extracción (también forman parte de la llave de caché).
 
-    :param image_path: Ruta local de la imagen.
-    :param prompt: Prompt específico para extracción de datos.
-    :return: Respuesta del modelo como string.
+    :return: Diccionario con model, max_tokens y temperature.
     """
-    headers = {
-        "Authorization": f"Bearer {OPENAI_API_KEY}",
-        "Content-Type": "application/json"
+    load_env()
+    params = {
+        "model": os.getenv("OPENAI_MODEL", "gpt-4.1-mini"),
+        "max_tokens": 1500,
+        "temperature": 0
+    }
+    # The output format changes what gets cached, but only when it is enabled
+    if os.getenv("OPENAI_JSON_SCHEMA", "0") == "1":
+        params["response_format"] = "json_schema"
+    return params
+
+
+def response_format(images: int = 1) -> Dict:
+    """
+    response_format de chat completions que restringe la salida al esquema.
+
+    :param images: Imágenes en la solicitud; con más de una se usa el arreglo `imagenes`.
+    :return: Diccionario response_format de tipo json_schema estricto.
+    """
+    schema = MULTI_RESPONSE_SCHEMA if images > 1 else RESPONSE_SCHEMA
+    return {
+        "type": "json_schema",
+        "json_schema": {"name": "prescripciones" if images > 1 else "prescripcion", "strict": True, "schema": schema},
     }
 
-    with open(image_path, "rb") as image_file:
-        image_base64 = base64.b64encode(image_file.read()).decode("utf-8")
 
+def parse_model_json(text: str) -> Dict:
+    """
+    Interpreta el JSON que devuelve el modelo.
+
+    Tolera cercos de markdown (```json), texto antes o después del objeto y
+    comas finales antes de } o ].
+
+    :param text: Contenido de la respuesta del modelo.
+    :return: Objeto JSON.
+    :raises ValueError: Si no hay un objeto JSON interpretable.
+    """
+    if not isinstance(text, str):
+        raise ValueError("La respuesta del modelo no es texto")
+    try:
+        value = json.loads(text)
+    except ValueError:
+        start, end = text.find("{"), text.rfind("}")
+        if start == -1 or end < start:
+            raise ValueError("La respuesta no contiene un objeto JSON")
+        candidate = text[start:end + 1]
+        try:
+            value = json.loads(candidate)
+        except ValueError:
+            value = json.loads(re.sub(r",\s*([}\]])", r"\1", candidate))
+    if not isinstance(value, dict):
+        raise ValueError("La respuesta no es un objeto JSON")
+    return value
+
+
+def build_request(prompt: str, image_bytes: bytes, mime_type: Optional[str] = None) -> Dict:
+    """
+    Arma el cuerpo de la solicitud de chat completions para una imagen.
+
+    :param prompt: Prompt específico para extracción de datos.
+    :param image_bytes: Bytes de la imagen.
+    :param mime_type: Tipo MIME de image_bytes; si no se pasa se detecta.
+    :return: Cuerpo JSON de la solicitud.
+    """
+    return build_multi_request(prompt, [(image_bytes, mime_type)])
+
+
+def build_multi_request(prompt: str, images: List[Tuple[bytes, Optional[str]]]) -> Dict:
+    """
+    Arma una solicitud de chat completions con una o varias imágenes.
+
+    Con más de una imagen se agregan MULTI_IMAGE_INSTRUCTIONS al prompt, cada
+    imagen va precedida de "Imagen N" y max_tokens se multiplica por N.
+
+    Todo lo fijo (el prompt) va antes que lo variable (las imágenes), así el
+    prefijo es idéntico byte a byte entre llamadas con la misma versión del
+    prompt y el proveedor lo puede reutilizar de su caché. Con
+    OPENAI_PROMPT_CACHE_KEY=1 se envía además prompt_cache_key con esa versión
+    para que esas llamadas lleguen a la misma caché.
+
+    :param prompt: Prompt específico para extracción de datos.
+    :param images: Pares (bytes, tipo MIME o None para detectarlo).
+    :return: Cuerpo JSON de la solicitud.
+    """
+    multi = len(images) > 1
+    version = prompt_version(prompt)
+    if multi:
+        prompt += MULTI_IMAGE_INSTRUCTIONS
+
+    content = []
+    size = len(prompt.encode("utf-8"))
+    for number, (image_bytes, mime_type) in enumerate(images, start=1):
+        mime_type = mime_type or detect_mime_type(image_bytes)
+        image_base64 = base64.b64encode(image_bytes).decode("utf-8")
+        size += len(image_base64)
+        if multi:
+            content.append({"type": "text", "text": f"Imagen {number}"})
+        content.append({"type": "image_url", "image_url": {"url": f"data:{mime_type};base64,{image_base64}"}})
+    annotate(bytes=size)
+
+    params = model_params()
     data = {
-        "model": "gpt-4.1-mini",
+        "model": params["model"],
         "messages": [
             {"role": "system", "content": prompt},
-            {"role": "user", "content": [
-                {"type": "image_url", "image_url": {"url": f"data:image/jpeg;base64,{image_base64}"}}
-            ]}
+            {"role": "user", "content": content}
         ],
-        "max_tokens": 1500,
-        "temperature": 0
+        "max_tokens": params["max_tokens"] * len(images),
+        "temperature": params["temperature"]
     }
+    if params.get("response_format") == "json_schema":
+        data["response_format"] = response_format(len(images))
+    if os.getenv("OPENAI_PROMPT_CACHE_KEY", "0") == "1":
+        data["prompt_cache_key"] = f"pip-{version}"
+    return data
 
-    response = requests.post(OPENAI_API_URL, headers=headers, json=data)
 
-    if response.status_code != 200:
-        return f"Error en la API de OpenAI: {response.status_code}"
+def split_multi_response(response: str, count: int) -> List[str]:
+    """
+    Separa la respuesta de una solicitud de varias imágenes.
+
+    :param response: Respuesta del modelo a build_multi_request.
+    :param count: Número de imágenes enviadas.
+    :return: Por imagen, una respuesta con el formato de una sola imagen
+        ({"datos": ...} en JSON o REJECTION_MESSAGE), en el orden de envío.
+    :raises ValueError: Si la respuesta no tiene un elemento válido por imagen.
+    """
+    try:
+        items = parse_model_json(response)["imagenes"]
+    except (ValueError, KeyError) as e:
+        raise ValueError(f"Respuesta de varias imágenes inválida: {e}")
+    if not isinstance(items, list) or len(items) != count:
+        raise ValueError(f"Se esperaban {count} imágenes en la respuesta")
+
+    parts: List[Optional[str]] = [None] * count
+    for position, item in enumerate(items, start=1):
+        if not isinstance(item, dict):
+            raise ValueError(f"Elemento {position} inválido en la respuesta")
+        number = item.get("imagen", position)
+        if not isinstance(number, int) or not 1 <= number <= count or parts[number - 1] is not None:
+            raise ValueError(f"Número de imagen inválido en la respuesta: {number!r}")
+        if item.get("rechazada"):
+            parts[number - 1] = REJECTION_MESSAGE
+        elif isinstance(item.get("datos"), dict):
+            parts[number - 1] = json.dumps({"datos": item["datos"]}, ensure_ascii=False)
+        else:
+            raise ValueError(f"La imagen {number} no trae datos")
+    return parts
+
+
+def read_response(status_code: int, body: Optional[Dict], model: str) -> str:
+    """
+    Extrae el contenido del modelo de una respuesta y registra el uso de tokens.
+
+    :param status_code: Status HTTP de la respuesta.
+    :param body: JSON de la respuesta.
+    :param model: Modelo solicitado (si la respuesta no lo trae).
+    :return: Respuesta del modelo, o el mensaje de error.
+    """
+    if status_code != 200:
+        return f"Error en la API de OpenAI: {status_code}"
 
     try:
-        content = response.json()["choices"][0]["message"]["content"]
+        usage = body.get("usage") or {}
+        annotate(
+            model=body.get("model", model),
+            prompt_tokens=usage.get("prompt_tokens", 0),
+            completion_tokens=usage.get("completion_tokens", 0),
+            # Prompt tokens the provider served from its prefix cache
+            cached_tokens=(usage.get("prompt_tokens_details") or {}).get("cached_tokens", 0),
+        )
+        content = body["choices"][0]["message"]["content"]
         return content
     except Exception as e:
         return f"Error interpretando la respuesta del modelo: {e}"
+
+
+def extract_data_from_prescription(
+    image_path: str,
+    prompt: str,
+    image_bytes: Optional[bytes] = None,
+    mime_type: Optional[str] = None
+) -> str:
+    """
+    Envía una imagen y prompt a la API de OpenAI para extraer información.
+
+    :param image_path: Ruta local de la imagen.
+    :param prompt: Prompt específico para extracción de datos.
+    :param image_bytes: Bytes ya preprocesados; si no se pasan se lee image_path.
+    :param mime_type: Tipo MIME de image_bytes; si no se pasa se detecta.
+    :return: Respuesta del modelo como string.
+    """
+    if image_bytes is None:
+        with open(image_path, "rb") as image_file:
+            image_bytes = image_file.read()
+    return _post_request(build_request(prompt, image_bytes, mime_type), prompt)
+
+
+def extract_data_from_prescriptions(
+    image_paths: List[str],
+    prompt: str,
+    image_bytes: Optional[List[bytes]] = None,
+    mime_types: Optional[List[Optional[str]]] = None
+) -> str:
+    """
+    Envía varias imágenes en una sola solicitud (ver build_multi_request).
+
+    :param image_paths: Rutas locales de las imágenes.
+    :param prompt: Prompt específico para extracción de datos.
+    :param image_bytes: Bytes ya preprocesados, uno por imagen; si no se pasan se leen los archivos.
+    :param mime_types: Tipos MIME de image_bytes; si no se pasan se detectan.
+    :return: Respuesta del modelo como string; se separa con split_multi_response.
+    """
+    if image_bytes is None:
+        image_bytes = []
+        for image_path in image_paths:
+            with open(image_path, "rb") as image_file:
+                image_bytes.append(image_file.read())
+    mime_types = mime_types or [None] * len(image_bytes)
+    data = build_multi_request(prompt, list(zip(image_bytes, mime_types)))
+    return _post_request(data, prompt, images=len(image_bytes))
+
+
+def extract_data_from_encoded(encoded, prompt: str) -> str:
+    """
+    Envía una solicitud que ya serializó un proceso de cpu_pool.
+
+    :param encoded: EncodedRequest (cuerpo en memoria compartida, modelo y max_tokens).
+    :param prompt: Prompt con el que se armó, para estimar los tokens.
+    :return: Respuesta del modelo como string.
+    """
+    annotate(bytes=encoded.body_size)
+    return _post_request({"model": encoded.model, "max_tokens": encoded.max_tokens}, prompt, body=encoded.body)
+
+
+class ExtractionStream:
+    """
+    Valida la respuesta del modelo a medida que llega por streaming.
+
+    Detecta el rechazo apenas aparece (mensaje del prompt o "rechazada": true)
+    y revisa tipo y número de documento en cuanto cada valor está completo.
+    """
+
+    _REJECTED = re.compile(r'"rechazada"\s*:\s*true')
+    _FIELDS = {
+        name: re.compile(rf'"{name}"\s*:\s*(null|"(?:[^"\\]|\\.)*")\s*[,}}]') for name in IDENTITY_FIELDS
+    }
+
+    def __init__(self, on_identified: Optional[Callable[[], None]] = None):
+        """
+        :param on_identified: Se llama una vez, cuando tipo y número de
+            documento ya llegaron con valor.
+        """
+        self.on_identified = on_identified
+        self.identified = False
+        self.text = ""
+
+    def feed(self, delta: str) -> Optional[str]:
+        """
+        Agrega un fragmento del contenido.
+
+        :param delta: Texto nuevo de la respuesta.
+        :return: None para seguir leyendo, o la respuesta con la que se corta el
+            stream: REJECTION_MESSAGE, o un `datos` con la identificación
+            incompleta (que parse_response rechaza).
+        """
+        if not delta:
+            return None
+        self.text += delta
+        text = self.text
+        if REJECTION_MARKER in text or self._REJECTED.search(text):
+            return REJECTION_MESSAGE
+        if self.identified:
+            return None
+
+        values = {}
+        for name, pattern in self._FIELDS.items():
+            match = pattern.search(text)
+            if match:
+                values[name] = json.loads(match.group(1))
+        if any(not value for value in values.values()):
+            return json.dumps({"datos": {name: values.get(name) for name in IDENTITY_FIELDS}})
+        if len(values) == len(IDENTITY_FIELDS):
+            self.identified = True
+            if self.on_identified is not None:
+                self.on_identified()
+        return None
+
+
+def stream_data_from_prescription(
+    image_path: str,
+    prompt: str,
+    image_bytes: Optional[bytes] = None,
+    mime_type: Optional[str] = None,
+    on_identified: Optional[Callable[[], None]] = None
+) -> str:
+    """
+    Igual que extract_data_from_prescription, pero leyendo la respuesta por
+    streaming y cortándola apenas ExtractionStream la descarta.
+
+    :param image_path: Ruta local de la imagen.
+    :param prompt: Prompt específico para extracción de datos.
+    :param image_bytes: Bytes ya preprocesados; si no se pasan se lee image_path.
+    :param mime_type: Tipo MIME de image_bytes; si no se pasa se detecta.
+    :param on_identified: Ver ExtractionStream.
+    :return: Respuesta del modelo como string (parcial si se cortó).
+    """
+    if image_bytes is None:
+        with open(image_path, "rb") as image_file:
+            image_bytes = image_file.read()
+    data = build_request(prompt, image_bytes, mime_type)
+    data["stream"] = True
+    data["stream_options"] = {"include_usage": True}
+
+    try:
+        response = get_client().post_json(data, estimate_tokens(prompt, data["max_tokens"]), stream=True)
+    except requests.RequestException as e:
+        return f"Error en la API de OpenAI: {e}"
+
+    stream = ExtractionStream(on_identified)
+    body = {"model": data["model"], "usage": {}}
+    # Closing the response early drops the connection, which stops generation
+    with response:
+        if response.status_code != 200:
+            return read_response(response.status_code, None, data["model"])
+        try:
+            for line in response.iter_lines():
+                # Decoded here: requests would assume ISO-8859-1 for text/event-stream
+                line = line.decode("utf-8").strip()
+                if not line.startswith("data:"):
+                    continue
+                payload = line[len("data:"):].strip()
+                if payload == "[DONE]":
+                    break
+                chunk = json.loads(payload)
+                body["model"] = chunk.get("model", body["model"])
+                body["usage"] = chunk.get("usage") or body["usage"]
+                for choice in chunk.get("choices") or []:
+                    early = stream.feed((choice.get("delta") or {}).get("content") or "")
+                    if early is not None:
+                        annotate(stream_aborted=True)
+                        return early
+        except requests.RequestException as e:
+            return f"Error en la API de OpenAI: {e}"
+        except ValueError as e:
+            return f"Error interpretando la respuesta del modelo: {e}"
+
+    body["choices"] = [{"message": {"content": stream.text}}]
+    return read_response(200, body, data["model"])
+
+
+def _post_request(data: Dict, prompt: str, body: Optional[memoryview] = None, images: int = 1) -> str:
+    try:
+        tokens = estimate_tokens(prompt, data["max_tokens"], images)
+        response = get_client().post_json(data if body is None else body, tokens)
+    except requests.RequestException as e:
+        return f"Error en la API de OpenAI: {e}"
+
+    if response.status_code != 200:
+        return read_response(response.status_code, None, data["model"])
+    try:
+        body = response.json()
+    except Exception as e:
+        return f"Error interpretando la respuesta del modelo: {e}"
+    return read_response(response.status_code, body, data["model"])
+
+
+async def extract_data_from_prescription_async(
+    image_bytes: bytes,
+    prompt: str,
+    mime_type: Optional[str] = None,
+    client: Optional[AsyncOpenAIClient] = None
+) -> str:
+    """
+    Versión asyncio de extract_data_from_prescription.
+
+    :param image_bytes: Bytes de la imagen (leer el archivo es cosa del llamador).
+    :param prompt: Prompt específico para extracción de datos.
+    :param mime_type: Tipo MIME de image_bytes; si no se pasa se detecta.
+    :param client: Cliente asíncrono; por defecto el compartido del event loop.
+    :return: Respuesta del modelo como string.
+    """
+    data = build_request(prompt, image_bytes, mime_type)
+    client = client or get_async_client()
+
+    try:
+        response = await client.post_json(data, estimate_tokens(prompt, data["max_tokens"]))
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        return f"Error en la API de OpenAI: {e!r}"
+
+    return read_response(response.status_code, response.body, data["model"])
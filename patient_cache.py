@@ -0,0 +1,308 @@
+import os
+import json
+import time
+import logging
+import threading
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
+
+import bigquery_service
+from bigquery_service import prescription_id, project_prescription
+
+
+logger = logging.getLogger(__name__)
+
+
+def _canonical(value) -> str:
+    return json.dumps(value, sort_keys=True, ensure_ascii=False, default=str)
+
+
+def _recipe_id(paciente_clave: str, prescripcion: Dict) -> str:
+    # Same id the store computes for the stored (projected) prescription
+    return prescription_id(paciente_clave, project_prescription(prescripcion))
+
+
+class PatientCache:
+    """
+    Caché write-through del último estado guardado de cada paciente.
+
+    Envuelve un almacén de pacientes (bigquery_service o cualquiera con
+    insert_or_update_patient_data / upsert_patients). Antes de escribir compara
+    el registro con lo último que se guardó: si nada cambió no se lanza ningún
+    job; si cambió algo, solo se envían los campos distintos y las
+    prescripciones nuevas. El estado se actualiza solo después de una escritura
+    exitosa.
+
+    La caché solo ve lo que escribe este proceso: si otro sistema modifica la
+    tabla, `ttl_seconds` limita cuánto tiempo puede quedar desactualizada.
+
+    Una prescripción se da por conocida solo si su prescription_id ya está en
+    caché, y ese ID es el hash de la prescripción completa (incluye
+    id_session, url_prescripcion y version_prompt). La misma fórmula enviada
+    en otra sesión o extraída con otro prompt cuenta como nueva y se escribe,
+    igual que la trataría la tabla; esos registros no suman a "omitidos".
+    """
+
+    def __init__(
+        self,
+        store=None,
+        max_entries: Optional[int] = None,
+        ttl_seconds: Optional[float] = None,
+        path: Optional[str] = None,
+        save_every: int = 100,
+    ):
+        """
+        :param store: Almacén real; por defecto el de BQ_WRITE_MODE.
+        :param max_entries: Pacientes en memoria (PIP_PATIENT_CACHE_MAX_ENTRIES, default 50000).
+        :param ttl_seconds: Vigencia de cada estado (PIP_PATIENT_CACHE_TTL_SECONDS, default 1 día).
+        :param path: Archivo JSON donde se guarda la caché entre ejecuciones
+            (PIP_PATIENT_CACHE_PATH; sin valor no se persiste).
+        :param save_every: Escrituras entre guardados a disco.
+        """
+        self.store = store or bigquery_service.get_patient_store()
+        self.max_entries = max_entries or int(os.getenv("PIP_PATIENT_CACHE_MAX_ENTRIES", "50000"))
+        self.ttl_seconds = ttl_seconds or float(os.getenv("PIP_PATIENT_CACHE_TTL_SECONDS", str(24 * 3600)))
+        self.path = path if path is not None else os.getenv("PIP_PATIENT_CACHE_PATH")
+        self.save_every = save_every
+
+        self._lock = threading.Lock()
+        # paciente_clave -> {"campos": {...}, "recetas": [prescription_id, ...], "guardado": ts}
+        self._entries: "OrderedDict[str, Dict]" = OrderedDict()
+        self._dirty = 0
+        self._stats = {"registros": 0, "omitidos": 0, "parciales": 0, "completos": 0, "hits": 0, "misses": 0}
+        if self.path and os.path.exists(self.path):
+            self.load()
+
+    def _get(self, key: str, now: float) -> Optional[Dict]:
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        if entry["guardado"] + self.ttl_seconds < now:
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return entry
+
+    def _put(self, key: str, entry: Dict) -> None:
+        self._entries[key] = entry
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    @staticmethod
+    def _merge_state(base: Optional[Dict], record: Dict, now: float) -> Dict:
+        fields = dict(base["campos"]) if base else {}
+        recipes = list(base["recetas"]) if base else []
+        known = set(recipes)
+        for name, value in record.items():
+            if name == "prescripciones":
+                for prescripcion in value or []:
+                    recipe_id = _recipe_id(record["paciente_clave"], prescripcion)
+                    if recipe_id not in known:
+                        known.add(recipe_id)
+                        recipes.append(recipe_id)
+            elif name != "paciente_clave":
+                fields[name] = json.loads(_canonical(value))
+        return {"campos": fields, "recetas": recipes, "guardado": now}
+
+    @staticmethod
+    def diff(state: Dict, record: Dict) -> Optional[Dict]:
+        """
+        Compara un registro con el último estado guardado.
+
+        :param state: Estado en caché del paciente.
+        :param record: Registro armado por build_patient_record.
+        :return: Registro reducido (paciente_clave, campos distintos y
+            prescripciones cuyo prescription_id no está en caché) o None si no
+            hay cambios.
+        """
+        reduced = {}
+        known = set(state["recetas"])
+        for name, value in record.items():
+            if name == "paciente_clave":
+                continue
+            if name == "prescripciones":
+                new = [p for p in value or [] if _recipe_id(record["paciente_clave"], p) not in known]
+                if new:
+                    reduced[name] = new
+            elif name not in state["campos"] or _canonical(state["campos"][name]) != _canonical(value):
+                reduced[name] = value
+        if not reduced:
+            return None
+        return {"paciente_clave": record["paciente_clave"], **reduced}
+
+    @staticmethod
+    def align(reduced: List[Tuple[Dict, Optional[Dict]]]) -> List[Dict]:
+        """
+        Da a todos los registros de un lote las mismas columnas, en el mismo orden.
+
+        upsert_patients lanza un MERGE por cada conjunto de columnas distinto;
+        las columnas que un registro parcial no trae se llenan con el valor en
+        caché (que es el que ya está en la tabla) y las prescripciones con una
+        lista vacía.
+
+        :param reduced: Pares (registro reducido, estado base en caché o None).
+        :return: Registros con las columnas de todo el lote.
+        """
+        columns = list(dict.fromkeys(name for record, _ in reduced for name in record))
+        aligned = []
+        for record, base in reduced:
+            filled = {}
+            for name in columns:
+                if name in record:
+                    filled[name] = record[name]
+                elif name == "prescripciones":
+                    filled[name] = []
+                elif base is not None and name in base["campos"]:
+                    filled[name] = base["campos"][name]
+            aligned.append(filled)
+        return aligned
+
+    def _reduce(self, records: List[Dict]) -> Tuple[List[Tuple[Dict, Optional[Dict]]], Dict[str, Dict]]:
+        # Diff each record against the cache plus the earlier records of the same
+        # batch; the resulting states are only committed after the write succeeds.
+        now = time.time()
+        reduced: List[Tuple[Dict, Optional[Dict]]] = []
+        pending: Dict[str, Dict] = {}
+        with self._lock:
+            for record in records:
+                if "paciente_clave" not in record:
+                    raise ValueError("paciente_clave is missing from input and is required for MERGE.")
+                key = record["paciente_clave"]
+                base = pending.get(key) or self._get(key, now)
+                self._stats["registros"] += 1
+                if base is None:
+                    self._stats["misses"] += 1
+                    self._stats["completos"] += 1
+                    reduced.append((record, None))
+                else:
+                    self._stats["hits"] += 1
+                    changes = self.diff(base, record)
+                    if changes is None:
+                        self._stats["omitidos"] += 1
+                        continue
+                    self._stats["parciales"] += 1
+                    reduced.append((changes, base))
+                pending[key] = self._merge_state(base, record, now)
+        return reduced, pending
+
+    def _commit(self, pending: Dict[str, Dict]) -> None:
+        with self._lock:
+            for key, entry in pending.items():
+                self._put(key, entry)
+            self._dirty += len(pending)
+            save = self.path and self._dirty >= self.save_every
+        if save:
+            self.save()
+
+    def insert_or_update_patient_data(self, paciente: Dict) -> None:
+        reduced, pending = self._reduce([paciente])
+        if reduced:
+            self.store.insert_or_update_patient_data(reduced[0][0])
+        self._commit(pending)
+
+    def upsert_patients(self, records: List[Dict], batch_size: Optional[int] = None) -> int:
+        reduced, pending = self._reduce(records)
+        if reduced:
+            self.store.upsert_patients(self.align(reduced), batch_size)
+        self._commit(pending)
+        return len({record["paciente_clave"] for record, _ in reduced})
+
+    def invalidate(self, paciente_clave: Optional[str] = None) -> None:
+        """
+        Olvida el estado de un paciente, o de todos si no se indica.
+
+        :param paciente_clave: Llave del paciente.
+        """
+        with self._lock:
+            if paciente_clave is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(paciente_clave, None)
+
+    def warm(self, rows: List[Dict]) -> int:
+        """
+        Carga estados ya guardados (p. ej. leídos de BigQuery).
+
+        :param rows: Filas con la forma del registro de paciente.
+        :return: Pacientes cargados.
+        """
+        now = time.time()
+        with self._lock:
+            for row in rows:
+                self._put(row["paciente_clave"], self._merge_state(None, row, now))
+        return len(rows)
+
+    def warm_from_bigquery(self, limit: Optional[int] = None, source: Optional[str] = None) -> int:
+        """
+        Carga en la caché los pacientes actuales de BigQuery.
+
+        :param limit: Máximo de pacientes (default: max_entries).
+        :param source: Tabla o vista `proyecto.dataset.tabla`; por defecto la
+            vista anidada si BQ_WRITE_MODE no es "anidado", si no la tabla.
+        :return: Pacientes cargados.
+        """
+        if source is None:
+            nested = os.getenv("BQ_WRITE_MODE", "anidado") == "anidado"
+            source = bigquery_service.table_ref() if nested else bigquery_service.patients_view_ref()
+        query = f"SELECT * FROM `{source}` LIMIT @limite"
+        job_config = bigquery_service.bigquery.QueryJobConfig(query_parameters=[
+            bigquery_service.bigquery.ScalarQueryParameter("limite", "INT64", limit or self.max_entries),
+        ])
+        rows = bigquery_service.get_client().query(query, job_config=job_config).result()
+        loaded = self.warm([dict(row.items()) for row in rows])
+        logger.info(f"Caché de pacientes precargada con {loaded} pacientes desde {source}")
+        return loaded
+
+    def save(self) -> None:
+        """
+        Guarda la caché en `path` (escritura atómica).
+        """
+        if not self.path:
+            return
+        with self._lock:
+            payload = json.dumps(list(self._entries.items()), ensure_ascii=False)
+            self._dirty = 0
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.write(payload)
+        os.replace(tmp_path, self.path)
+
+    def load(self) -> int:
+        """
+        Carga la caché guardada en `path`, descartando estados vencidos.
+
+        :return: Pacientes cargados.
+        """
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                items = json.load(f)
+        except (OSError, ValueError) as e:
+            logger.warning(f"No se pudo leer la caché de pacientes {self.path}: {e}")
+            return 0
+        now = time.time()
+        with self._lock:
+            for key, entry in items:
+                if entry["guardado"] + self.ttl_seconds >= now:
+                    self._put(key, entry)
+            return len(self._entries)
+
+    def stats(self) -> Dict:
+        """
+        Retorna los contadores de la caché.
+
+        :return: Registros recibidos, omitidos (sin job), parciales, completos,
+            aciertos, fallos, tasa de omisión y tamaño. Una prescripción
+            repetida con otra sesión o URL no es omitible (ver la clase).
+        """
+        with self._lock:
+            stats = dict(self._stats)
+            stats["tasa_omision"] = round(stats["omitidos"] / stats["registros"], 4) if stats["registros"] else 0.0
+            stats["entradas"] = len(self._entries)
+        return stats
+
+    def close(self) -> None:
+        """
+        Guarda la caché en disco si está configurada.
+        """
+        self.save()
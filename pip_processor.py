@@ -1,63 +1,576 @@
 import os
 import json
+import time
 import logging
-from typing import Union
-from uuid import uuid4
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Callable, Dict, List, Optional, Union
 
-from openai_service import extract_data_from_prescription
-from cloud_storage_service import upload_image_to_bucket
-from bigquery_service import insert_or_update_patient_data
+from openai_service import (
+    REJECTION_MARKER,
+    REJECTION_MESSAGE,
+    extract_data_from_encoded,
+    extract_data_from_prescription,
+    extract_data_from_prescriptions,
+    model_params,
+    parse_model_json,
+    split_multi_response,
+    stream_data_from_prescription,
+)
+from extraction_cache import ExtractionCache, cache_key, file_sha256
+from image_preprocessing import ImagePreprocessor, PreprocessedImage
+from cloud_storage_service import GCSUploader, UploadResult, get_uploader
+from cpu_pool import CPUPool, EncodedRequest
+from instrumentation import Span, Tracer, get_tracer
+from patient_cache import PatientCache
+from prompt_registry import PromptRegistry, prompt_version
+from triage import TriageCascade
+import bigquery_service
+from startup import load_env
 
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png", ".heic", ".webp")
+
+
+def _json_size(value) -> int:
+    return len(json.dumps(value, ensure_ascii=False, default=str).encode("utf-8"))
+
+
+class PIPError(Exception):
+    """
+    Error de una etapa del pipeline PIP.
+
+    :param message: Mensaje para el usuario (el mismo que retorna process_image).
+    :param stage: Etapa que falló (extraccion, subida, persistencia).
+    :param retryable: True si el error es transitorio y vale la pena reintentar.
+    """
+
+    def __init__(self, message: str, stage: str, retryable: bool = False):
+        super().__init__(message)
+        self.message = message
+        self.stage = stage
+        self.retryable = retryable
+
 
 class PIPProcessor:
     """
     Procesador de Imágenes y Prescripciones (PIP)
     """
 
-    def __init__(self):
+    def __init__(
+        self,
+        cache: Optional[ExtractionCache] = None,
+        preprocessor: Optional[ImagePreprocessor] = None,
+        upload_optimized: Optional[bool] = None,
+        uploader: Optional[GCSUploader] = None,
+        speculative_upload: Optional[bool] = None,
+        patient_store=None,
+        tracer: Optional[Tracer] = None,
+        images_per_request: Optional[int] = None,
+        streaming: Optional[bool] = None,
+        triage: Optional[TriageCascade] = None,
+        cpu_pool: Optional[CPUPool] = None,
+        prompts: Optional[PromptRegistry] = None,
+    ):
+        """
+        :param cache: Caché de extracciones. Si no se pasa y PIP_CACHE_PATH está
+            definido, se abre una caché en esa ruta.
+        :param preprocessor: Preprocesamiento de imagen antes de OpenAI. Si no se
+            pasa y PIP_PREPROCESS=1, se usa uno con la configuración del entorno.
+        :param upload_optimized: Subir a GCS la imagen optimizada en vez del
+            original (PIP_UPLOAD_OPTIMIZED, default 0).
+        :param uploader: Subidor de Cloud Storage; por defecto el compartido del bucket.
+        :param speculative_upload: En process_image, subir la imagen en paralelo
+            con la extracción (PIP_SPECULATIVE_UPLOAD, default 0). Si la imagen se
+            rechaza, el blob se mueve a PIP_QUARANTINE_PREFIX (default
+            "cuarentena") o se borra si ese valor está vacío, salvo que otra
+            prescripción lo reutilice (GCSUploader.discard). Tras un error
+            reintentable el blob se conserva.
+        :param patient_store: Objeto con insert_or_update_patient_data y
+            upsert_patients; por defecto el del modo BQ_WRITE_MODE
+            (bigquery_service.get_patient_store), envuelto en una PatientCache
+            si PIP_PATIENT_CACHE=1 para omitir los MERGE sin cambios.
+        :param tracer: Recibe una medición por etapa (duración, bytes, tokens,
+            reintentos y resultado); por defecto el compartido de instrumentation,
+            que exporta a PIP_TRACE_PATH / PIP_METRICS_PATH si están definidos.
+        :param images_per_request: Imágenes por solicitud al modelo en
+            process_batch y process_session (PIP_IMAGES_PER_REQUEST, default 1).
+        :param streaming: Leer la respuesta del modelo por streaming y cortarla
+            apenas se rechaza la imagen o falta la identificación del paciente
+            (PIP_STREAMING, default 0). En process_image sin subida especulativa,
+            la subida empieza cuando la identificación ya llegó.
+        :param triage: Triaje que descarta, antes de la extracción, las imágenes
+            que no son fórmulas legibles. Si no se pasa y PIP_TRIAGE está
+            definido (p. ej. "heuristica,modelo"), se arma con esos niveles.
+        :param cpu_pool: Pool de procesos que lee, preprocesa y serializa las
+            solicitudes de una imagen en process_batch (sin streaming). Si no se
+            pasa y PIP_CPU_WORKERS está definido, se crea uno con el
+            preprocesador del procesador.
+        :param prompts: Registro de prompts (lectura única, recarga por mtime,
+            versión y variantes A/B); por defecto uno sobre PROMPT_PIP_PATH.
+        """
+        load_env()
         self.bucket_name = os.getenv("BUCKET_PRESCRIPCIONES")
-        self.prompt_path = os.getenv("PROMPT_PIP_PATH", "prompt_PIP.txt")
+        self.prompts = prompts or PromptRegistry()
+        if cache is None and os.getenv("PIP_CACHE_PATH"):
+            cache = ExtractionCache()
+        self.cache = cache
+        if preprocessor is None and os.getenv("PIP_PREPROCESS", "0") == "1":
+            preprocessor = ImagePreprocessor()
+        self.preprocessor = preprocessor
+        if upload_optimized is None:
+            upload_optimized = os.getenv("PIP_UPLOAD_OPTIMIZED", "0") == "1"
+        self.upload_optimized = upload_optimized
+        self._uploader = uploader
+        if speculative_upload is None:
+            speculative_upload = os.getenv("PIP_SPECULATIVE_UPLOAD", "0") == "1"
+        self.speculative_upload = speculative_upload
+        self.quarantine_prefix = os.getenv("PIP_QUARANTINE_PREFIX", "cuarentena")
+        self._speculative_pool: Optional[ThreadPoolExecutor] = None
+        self._speculative_lock = threading.Lock()
+        if patient_store is None:
+            patient_store = bigquery_service.get_patient_store()
+            if os.getenv("PIP_PATIENT_CACHE", "0") == "1":
+                patient_store = PatientCache(patient_store)
+        self.patient_store = patient_store
+        self.tracer = tracer or get_tracer()
+        self.images_per_request = max(1, images_per_request or int(os.getenv("PIP_IMAGES_PER_REQUEST", "1")))
+        if streaming is None:
+            streaming = os.getenv("PIP_STREAMING", "0") == "1"
+        self.streaming = streaming
+        if triage is None and os.getenv("PIP_TRIAGE"):
+            triage = TriageCascade(tracer=self.tracer)
+        self.triage = triage
+        if cpu_pool is None and os.getenv("PIP_CPU_WORKERS"):
+            cpu_pool = CPUPool(preprocessor=self.preprocessor)
+        self.cpu_pool = cpu_pool
 
-    def process_image(self, image_path: str, session_id: str) -> Union[str, dict]:
+    @property
+    def uploader(self) -> GCSUploader:
         """
-        Procesa la imagen, extrae datos con LLM y guarda en GCS + BigQuery.
+        Subidor de Cloud Storage; se crea en el primer uso.
+        """
+        if self._uploader is None:
+            self._uploader = get_uploader(self.bucket_name)
+        return self._uploader
+
+    @uploader.setter
+    def uploader(self, uploader: GCSUploader) -> None:
+        self._uploader = uploader
+
+    def prepare_image(self, image_path: str) -> Optional[PreprocessedImage]:
+        """
+        Preprocesa la imagen si hay un preprocesador configurado.
 
         :param image_path: Ruta local del archivo de imagen.
-        :param session_id: ID de sesión actual.
-        :return: Mensaje de error o datos extraídos.
+        :return: Imagen preprocesada o None si no hay preprocesamiento.
         """
-        # Paso 1: Leer el prompt
-        with open(self.prompt_path, "r", encoding="utf-8") as f:
-            prompt = f.read()
+        if self.preprocessor is None:
+            return None
+        with self.tracer.span("preprocesamiento") as span:
+            image = self.preprocessor.process_file(image_path)
+            span.set(bytes=image.bytes_after, bytes_before=image.bytes_before)
+        logger.info(
+            f"Imagen {os.path.basename(image_path)}: {image.bytes_before} -> {image.bytes_after} bytes ({image.mime_type})"
+        )
+        return image
 
-        # Paso 2: Llamar al servicio OpenAI con imagen y prompt
-        response = extract_data_from_prescription(image_path, prompt)
+    def cache_lookup(self, image_path: str, prompt: str) -> tuple:
+        """
+        Busca en la caché una extracción previa de la misma imagen.
 
-        if isinstance(response, str) and "fórmula médica válida" in response:
-            return response
+        :param image_path: Ruta local del archivo de imagen.
+        :param prompt: Prompt de extracción.
+        :return: Tupla (llave, datos); (None, None) si no hay caché configurada.
+        """
+        if self.cache is None:
+            return None, None
+        params = model_params()
+        if self.preprocessor is not None:
+            params["preprocesamiento"] = self.preprocessor.config()
+        with self.tracer.span("cache") as span:
+            key = cache_key(file_sha256(image_path), prompt, params)
+            data = self.cache.get(key)
+            span.set(hit=data is not None)
+        return key, data
+
+    def cache_store(self, key: Optional[str], data: dict) -> None:
+        """
+        Guarda en la caché una extracción ya persistida en GCS y BigQuery.
 
+        :param key: Llave retornada por cache_lookup.
+        :param data: Datos extraídos por el modelo.
+        """
+        if self.cache is None or key is None:
+            return
         try:
-            data = json.loads(response).get("datos", {})
+            self.cache.put(key, data)
         except Exception as e:
-            logger.error(f"Respuesta inválida del modelo: {e}")
-            return "Hubo un error procesando la fórmula médica."
+            logger.warning(f"No se pudo guardar la extracción en caché: {e}")
+
+    def read_prompt(self, key: Optional[str] = None) -> str:
+        """
+        Retorna el prompt de extracción del registro (solo se relee del disco
+        si el archivo cambió).
 
-        if not data.get("tipo_documento") or not data.get("numero_documento"):
-            return "No se pudieron extraer datos suficientes para identificar al paciente."
+        :param key: Llave de asignación de variantes A/B (el ID de sesión).
+        :return: Texto del prompt.
+        """
+        with self.tracer.span("prompt") as span:
+            prompt = self.prompts.choose(key)
+            span.set(version_prompt=prompt.version)
+            return prompt.text
 
-        # Paso 3: Subir imagen a Cloud Storage
-        try:
-            image_url = upload_image_to_bucket(self.bucket_name, image_path)
-        except Exception as e:
-            logger.error(f"Error subiendo imagen a Storage: {e}")
-            return "Error al subir la fórmula al sistema."
+    def triage_image(self, image_path: str, image: Optional[PreprocessedImage] = None) -> None:
+        """
+        Pasa la imagen por el triaje, si hay uno configurado.
+
+        :param image_path: Ruta local del archivo de imagen.
+        :param image: Imagen ya preprocesada; si no, se lee image_path.
+        :raises PIPError: Si el triaje descarta la imagen.
+        """
+        if self.triage is None:
+            return
+        if image is not None:
+            data = image.data
+        else:
+            with open(image_path, "rb") as f:
+                data = f.read()
+        with self.tracer.span("triaje") as span:
+            result = self.triage.classify(data)
+            span.set(nivel=result.nivel, puntaje=result.puntaje)
+            if not result.pasa:
+                span.outcome = "rechazada"
+        if not result.pasa:
+            logger.info(f"Imagen {os.path.basename(image_path)} descartada por el triaje ({result.nivel}: {result.puntaje})")
+            raise PIPError(REJECTION_MESSAGE, "extraccion")
+
+    def extract_data(
+        self,
+        image_path: str,
+        prompt: str,
+        image: Optional[PreprocessedImage] = None,
+        on_identified: Optional[Callable[[], None]] = None,
+        triage: bool = True,
+        encoded: Optional[EncodedRequest] = None,
+    ) -> dict:
+        """
+        Llama al modelo y valida que la respuesta identifique al paciente.
+
+        :param image_path: Ruta local del archivo de imagen.
+        :param prompt: Prompt de extracción.
+        :param image: Imagen ya preprocesada (prepare_image); si no, se lee image_path.
+        :param on_identified: Con streaming, se llama apenas llegan tipo y
+            número de documento (ver ExtractionStream).
+        :param triage: Pasar antes por triage_image (False si ya se hizo).
+        :param encoded: Solicitud ya serializada por cpu_pool; se envía tal cual.
+        :return: Diccionario `datos` extraído por el modelo.
+        :raises PIPError: Si la imagen es rechazada o la respuesta es inválida.
+        """
+        with self.tracer.span("extraccion") as stage:
+            if triage:
+                try:
+                    self.triage_image(image_path, image)
+                except PIPError:
+                    stage.outcome = "rechazada"
+                    raise
+
+            with self.tracer.span("openai") as call:
+                if encoded is not None:
+                    response = extract_data_from_encoded(encoded, prompt)
+                elif self.streaming:
+                    response = stream_data_from_prescription(
+                        image_path,
+                        prompt,
+                        image_bytes=image.data if image is not None else None,
+                        mime_type=image.mime_type if image is not None else None,
+                        on_identified=on_identified,
+                    )
+                elif image is None:
+                    response = extract_data_from_prescription(image_path, prompt)
+                else:
+                    response = extract_data_from_prescription(
+                        image_path, prompt, image_bytes=image.data, mime_type=image.mime_type
+                    )
+                # The service reports API failures as text instead of raising
+                if isinstance(response, str) and response.startswith("Error en la API de OpenAI"):
+                    call.outcome = "error"
+
+            return self.parse_response(response, stage)
+
+    def extract_data_pooled(self, image_path: str, prompt: str) -> tuple:
+        """
+        Como extract_data, pero leer, preprocesar, codificar en base64 y armar
+        el JSON ocurre en cpu_pool; este hilo solo envía el cuerpo y valida la
+        respuesta. El triaje va primero para no codificar imágenes rechazadas.
+
+        :param image_path: Ruta local del archivo de imagen.
+        :param prompt: Prompt de extracción.
+        :return: Tupla (datos, imagen preprocesada o None); la imagen solo se
+            copia fuera del pool si upload_optimized la va a usar.
+        :raises PIPError: Si la imagen es rechazada o la respuesta es inválida.
+        """
+        self.triage_image(image_path)
+        with self.tracer.span("preprocesamiento") as span:
+            encoded = self.cpu_pool.encode(image_path, prompt)
+            span.set(bytes=encoded.bytes_after, bytes_before=encoded.bytes_before)
+        with encoded:
+            image = encoded.image() if self.upload_optimized else None
+            return self.extract_data(image_path, prompt, triage=False, encoded=encoded), image
+
+    def extract_data_multi(
+        self,
+        image_paths: List[str],
+        prompt: str,
+        images: Optional[List[Optional[PreprocessedImage]]] = None,
+    ) -> List[Union[dict, PIPError]]:
+        """
+        Extrae varias imágenes con una sola llamada al modelo.
+
+        Cada imagen se valida por separado con parse_response. Si la respuesta
+        no trae un elemento válido por imagen, se repite la extracción imagen
+        por imagen.
+
+        :param image_paths: Rutas locales de las imágenes.
+        :param prompt: Prompt de extracción.
+        :param images: Imágenes ya preprocesadas (prepare_image), una por ruta.
+        :return: Por imagen, el diccionario `datos` o el PIPError de esa imagen.
+        """
+        images = images or [None] * len(image_paths)
+        if len(image_paths) == 1:
+            try:
+                return [self.extract_data(image_paths[0], prompt, images[0])]
+            except PIPError as e:
+                return [e]
+
+        # Images discarded by the triage never reach the shared request
+        results: List[Union[dict, PIPError, None]] = [None] * len(image_paths)
+        passed = []
+        for index, (image_path, image) in enumerate(zip(image_paths, images)):
+            try:
+                self.triage_image(image_path, image)
+            except PIPError as e:
+                results[index] = e
+            else:
+                passed.append(index)
+        extracted = self._extract_data_multi(
+            [image_paths[index] for index in passed], prompt, [images[index] for index in passed]
+        )
+        for index, outcome in zip(passed, extracted):
+            results[index] = outcome
+        return results
+
+    def _extract_data_multi(
+        self,
+        image_paths: List[str],
+        prompt: str,
+        images: List[Optional[PreprocessedImage]],
+    ) -> List[Union[dict, PIPError]]:
+        if not image_paths:
+            return []
+        if len(image_paths) == 1:
+            try:
+                return [self.extract_data(image_paths[0], prompt, images[0], triage=False)]
+            except PIPError as e:
+                return [e]
+
+        with self.tracer.span("extraccion", imagenes=len(image_paths)) as stage:
+            with self.tracer.span("openai") as call:
+                if all(image is None for image in images):
+                    response = extract_data_from_prescriptions(image_paths, prompt)
+                else:
+                    data = []
+                    for image_path, image in zip(image_paths, images):
+                        if image is None:
+                            with open(image_path, "rb") as f:
+                                data.append((f.read(), None))
+                        else:
+                            data.append((image.data, image.mime_type))
+                    response = extract_data_from_prescriptions(
+                        image_paths, prompt, [d for d, _ in data], [m for _, m in data]
+                    )
+                if isinstance(response, str) and response.startswith("Error en la API de OpenAI"):
+                    call.outcome = "error"
+
+            if call.outcome == "error":
+                # Splitting into single calls would multiply the load on a failing API
+                error = PIPError("Hubo un error procesando la fórmula médica.", "extraccion", retryable=True)
+                stage.outcome = "error"
+                return [error] * len(image_paths)
+
+            try:
+                parts = split_multi_response(response, len(image_paths))
+            except ValueError as e:
+                logger.warning(f"{e}; se extrae imagen por imagen")
+                stage.outcome = "fallback"
+            else:
+                results: List[Union[dict, PIPError]] = []
+                for part in parts:
+                    try:
+                        results.append(self.parse_response(part))
+                    except PIPError as e:
+                        results.append(e)
+                return results
+
+        results = []
+        for image_path, image in zip(image_paths, images):
+            try:
+                results.append(self.extract_data(image_path, prompt, image, triage=False))
+            except PIPError as e:
+                results.append(e)
+        return results
+
+    def parse_response(self, response: str, stage: Optional[Span] = None) -> dict:
+        """
+        Valida la respuesta del modelo y extrae `datos`.
+
+        :param response: Texto retornado por el servicio de OpenAI.
+        :param stage: Medición de la etapa de extracción; recibe el mismo
+            resultado (rechazada, incompleta) que la del parseo.
+        :return: Diccionario `datos` extraído por el modelo.
+        :raises PIPError: Si la imagen es rechazada o la respuesta es inválida.
+        """
+        with self.tracer.span("parseo") as span:
+            rejected = isinstance(response, str) and REJECTION_MARKER in response
+            if not rejected:
+                try:
+                    parsed = parse_model_json(response)
+                except Exception as e:
+                    logger.error(f"Respuesta inválida del modelo: {e}")
+                    retryable = isinstance(response, str) and response.startswith("Error en la API de OpenAI")
+                    raise PIPError("Hubo un error procesando la fórmula médica.", "extraccion", retryable)
+                # Schema-constrained responses flag rejection instead of returning the message
+                if parsed.get("rechazada"):
+                    rejected, response = True, REJECTION_MESSAGE
+
+            if rejected:
+                span.outcome = "rechazada"
+                if stage is not None:
+                    stage.outcome = span.outcome
+                raise PIPError(response, "extraccion")
+
+            data = parsed.get("datos") or {}
+
+            if not data.get("tipo_documento") or not data.get("numero_documento"):
+                span.outcome = "incompleta"
+                if stage is not None:
+                    stage.outcome = span.outcome
+                raise PIPError("No se pudieron extraer datos suficientes para identificar al paciente.", "extraccion")
+
+        return data
+
+    def upload_image(self, image_path: str, image: Optional[PreprocessedImage] = None) -> str:
+        """
+        Sube la imagen a Cloud Storage.
+
+        :param image_path: Ruta local del archivo de imagen.
+        :param image: Imagen preprocesada; se sube en lugar del original si
+            upload_optimized está activo.
+        :return: Ruta gs:// de la imagen subida.
+        :raises PIPError: Si la subida falla.
+        """
+        return self.upload_image_result(image_path, image).uri
+
+    def upload_image_result(
+        self, image_path: str, image: Optional[PreprocessedImage] = None, speculative: bool = False
+    ) -> UploadResult:
+        """
+        Igual que upload_image, pero retorna el UploadResult completo.
+
+        :param image_path: Ruta local del archivo de imagen.
+        :param image: Imagen preprocesada (ver upload_image).
+        :param speculative: La subida puede descartarse (ver GCSUploader.upload).
+        :return: Resultado de la subida.
+        :raises PIPError: Si la subida falla.
+        """
+        with self.tracer.span("subida") as span:
+            try:
+                if image is not None and self.upload_optimized:
+                    result = self.uploader.upload(
+                        image_path, data=image.data, content_type=image.mime_type, speculative=speculative
+                    )
+                else:
+                    result = self.uploader.upload(image_path, speculative=speculative)
+            except Exception as e:
+                logger.error(f"Error subiendo imagen a Storage: {e}")
+                raise PIPError("Error al subir la fórmula al sistema.", "subida", retryable=True)
+            # Deduplicated uploads send nothing
+            span.set(bytes=result.size if result.created else 0, created=result.created)
+            return result
+
+    def start_speculative_upload(self, image_path: str, image: Optional[PreprocessedImage] = None) -> Future:
+        """
+        Inicia la subida a Cloud Storage sin esperar a la extracción.
+
+        :param image_path: Ruta local del archivo de imagen.
+        :param image: Imagen preprocesada (ver upload_image).
+        :return: Future con el UploadResult.
+        """
+        with self._speculative_lock:
+            if self._speculative_pool is None:
+                self._speculative_pool = ThreadPoolExecutor(
+                    int(os.getenv("PIP_SPECULATIVE_WORKERS", "4")), thread_name_prefix="pip-speculative"
+                )
+        return self._speculative_pool.submit(self.upload_image_result, image_path, image, True)
 
-        # Paso 4: Preparar estructura para BigQuery
+    def settle_speculative_upload(self, upload: Future) -> None:
+        """
+        Confirma (en segundo plano) una subida especulativa que se conserva,
+        para que los reusos de su blob ya no lo marquen.
+
+        :param upload: Future retornado por start_speculative_upload.
+        """
+        def settle(done: Future) -> None:
+            if done.exception() is None:
+                self.uploader.settle(done.result())
+
+        upload.add_done_callback(settle)
+
+    def discard_speculative_upload(self, upload: Future) -> None:
+        """
+        Retira (en segundo plano) el blob de una subida especulativa cuya
+        imagen se rechazó de forma definitiva.
+
+        :param upload: Future retornado por start_speculative_upload.
+        """
+        def discard(done: Future) -> None:
+            if done.exception() is not None:
+                return
+            try:
+                moved = self.uploader.discard(done.result(), self.quarantine_prefix or None)
+                if moved:
+                    logger.info(f"Imagen rechazada movida a {moved}")
+            except Exception as e:
+                logger.warning(f"No se pudo retirar la subida especulativa {done.result().uri}: {e}")
+
+        upload.add_done_callback(discard)
+
+    def build_patient_record(
+        self,
+        data: dict,
+        session_id: str,
+        image_url: str,
+        prompt: Optional[str] = None,
+        version: Optional[str] = None,
+    ) -> dict:
+        """
+        Arma la estructura del paciente que se guarda en BigQuery.
+
+        :param data: Datos extraídos por el modelo.
+        :param session_id: ID de sesión actual.
+        :param image_url: Ruta gs:// de la imagen.
+        :param prompt: Prompt con el que se extrajo; su versión queda en la
+            prescripción (por defecto el prompt actual de la sesión).
+        :param version: Versión del prompt ya calculada (p. ej. guardada en un
+            checkpoint); si se pasa, prompt no se usa.
+        :return: Registro del paciente con su prescripción.
+        """
         paciente_clave = f"CO{data['tipo_documento']}{data['numero_documento']}"
+        if version is None:
+            version = prompt_version(prompt if prompt is not None else self.read_prompt(session_id))
 
         prescripcion = {
             "id_session": session_id,
@@ -65,10 +578,11 @@ class PIPProcessor:
             "categoria_riesgo": None,
             "diagnostico": data.get("diagnostico"),
             "IPS": data.get("ips"),
-            "medicamentos": data.get("medicamentos", [])
+            "medicamentos": data.get("medicamentos", []),
+            "version_prompt": version,
         }
 
-        paciente_record = {
+        return {
             "paciente_clave": paciente_clave,
             "pais": "CO",
             "tipo_documento": data.get("tipo_documento"),
@@ -82,10 +596,417 @@ class PIPProcessor:
             "prescripciones": [prescripcion]
         }
 
+    @staticmethod
+    def merge_session_pages(paciente_records: List[dict]) -> List[dict]:
+        """
+        Une las páginas de una misma fórmula.
+
+        Los registros del mismo paciente se unen en uno, y sus prescripciones de
+        la misma sesión en una sola: medicamentos sin repetir, el primer
+        diagnóstico/IPS no vacío y las rutas de las páginas separadas por coma
+        en url_prescripcion.
+
+        :param paciente_records: Registros armados por build_patient_record.
+        :return: Un registro por paciente, en orden de primera aparición.
+        """
+        merged: Dict[str, dict] = {}
+        for record in paciente_records:
+            target = merged.get(record["paciente_clave"])
+            if target is None:
+                target = merged[record["paciente_clave"]] = {**record, "prescripciones": []}
+            else:
+                for name, value in record.items():
+                    if name == "telefono_contacto":
+                        target[name] = list(dict.fromkeys((target.get(name) or []) + (value or [])))
+                    elif name != "prescripciones" and target.get(name) in (None, "") and value not in (None, ""):
+                        target[name] = value
+
+            for prescripcion in record.get("prescripciones") or []:
+                same = next((p for p in target["prescripciones"] if p["id_session"] == prescripcion["id_session"]), None)
+                if same is None:
+                    target["prescripciones"].append({
+                        **prescripcion, "medicamentos": list(prescripcion.get("medicamentos") or [])
+                    })
+                    continue
+                urls = same["url_prescripcion"].split(",") if same.get("url_prescripcion") else []
+                if prescripcion.get("url_prescripcion") and prescripcion["url_prescripcion"] not in urls:
+                    same["url_prescripcion"] = ",".join(urls + [prescripcion["url_prescripcion"]])
+                for name in ("categoria_riesgo", "diagnostico", "IPS"):
+                    if same.get(name) in (None, ""):
+                        same[name] = prescripcion.get(name)
+                for medicamento in prescripcion.get("medicamentos") or []:
+                    if medicamento not in same["medicamentos"]:
+                        same["medicamentos"].append(medicamento)
+        return list(merged.values())
+
+    def save_patient(self, paciente_record: dict) -> None:
+        """
+        Inserta o actualiza el paciente en BigQuery.
+
+        :param paciente_record: Registro armado por build_patient_record.
+        :raises PIPError: Si la operación en BigQuery falla.
+        """
         try:
-            insert_or_update_patient_data(paciente_record)
+            with self.tracer.span("persistencia", registros=1, bytes=_json_size(paciente_record)):
+                self.patient_store.insert_or_update_patient_data(paciente_record)
         except Exception as e:
             logger.error(f"Error al insertar en BigQuery: {e}")
-            return "Error al registrar los datos en el sistema."
+            raise PIPError("Error al registrar los datos en el sistema.", "persistencia", retryable=True)
+
+    def save_patients(self, paciente_records: List[dict]) -> None:
+        """
+        Inserta o actualiza varios pacientes con un MERGE por lote.
+
+        :param paciente_records: Registros armados por build_patient_record.
+        :raises PIPError: Si la operación en BigQuery falla.
+        """
+        try:
+            with self.tracer.span("persistencia", registros=len(paciente_records), bytes=_json_size(paciente_records)):
+                self.patient_store.upsert_patients(paciente_records)
+        except Exception as e:
+            logger.error(f"Error al insertar lote en BigQuery: {e}")
+            raise PIPError("Error al registrar los datos en el sistema.", "persistencia", retryable=True)
+
+    def process_image(self, image_path: str, session_id: str) -> Union[str, dict]:
+        """
+        Procesa la imagen, extrae datos con LLM y guarda en GCS + BigQuery.
+
+        :param image_path: Ruta local del archivo de imagen.
+        :param session_id: ID de sesión actual.
+        :return: Mensaje de error o datos extraídos.
+        """
+        with self.tracer.span("imagen") as span:
+            result = self._process_image(image_path, session_id)
+            if isinstance(result, str):
+                span.outcome = "error"
+        self.tracer.flush()
+        return result
+
+    def _process_image(self, image_path: str, session_id: str) -> Union[str, dict]:
+        try:
+            # Paso 1: Leer el prompt
+            prompt = self.read_prompt(session_id)
 
+            # Una imagen reenviada ya fue extraída y guardada: se responde desde caché
+            key, cached = self.cache_lookup(image_path, prompt)
+            if cached is not None:
+                return cached
+
+            # Paso 2: Preprocesar la imagen y llamar al servicio OpenAI
+            image = self.prepare_image(image_path)
+            if self.speculative_upload:
+                # La subida no depende de la extracción: corren en paralelo
+                upload = self.start_speculative_upload(image_path, image)
+                try:
+                    data = self.extract_data(image_path, prompt, image)
+                except PIPError as e:
+                    # A retryable failure is sent again with the same image, which reuses the blob
+                    if e.retryable:
+                        self.settle_speculative_upload(upload)
+                    else:
+                        self.discard_speculative_upload(upload)
+                    raise
+                self.settle_speculative_upload(upload)
+
+                # Paso 3: Esperar la subida a Cloud Storage
+                image_url = upload.result().uri
+            else:
+                early_uploads: List[Future] = []
+                on_identified = None
+                if self.streaming:
+                    # El paciente ya está identificado: la subida no espera al resto de la respuesta
+                    on_identified = lambda: early_uploads.append(self.start_speculative_upload(image_path, image))
+                try:
+                    data = self.extract_data(image_path, prompt, image, on_identified)
+                except PIPError as e:
+                    for upload in early_uploads:
+                        if e.retryable:
+                            self.settle_speculative_upload(upload)
+                        else:
+                            self.discard_speculative_upload(upload)
+                    raise
+                for upload in early_uploads:
+                    self.settle_speculative_upload(upload)
+
+                # Paso 3: Subir imagen a Cloud Storage
+                if early_uploads:
+                    image_url = early_uploads[0].result().uri
+                else:
+                    image_url = self.upload_image(image_path, image)
+
+            # Paso 4: Preparar estructura y guardar en BigQuery
+            self.save_patient(self.build_patient_record(data, session_id, image_url, prompt))
+        except PIPError as e:
+            return e.message
+
+        self.cache_store(key, data)
         return data
+
+    def process_session(self, image_paths: List[str], session_id: str) -> List[Union[str, dict]]:
+        """
+        Procesa las páginas enviadas en una sesión.
+
+        Las imágenes se extraen de a `images_per_request` por llamada, y las
+        páginas del mismo paciente se guardan como una sola prescripción
+        (merge_session_pages) en un solo MERGE.
+
+        :param image_paths: Rutas locales de las imágenes, en orden de página.
+        :param session_id: ID de sesión actual.
+        :return: Por imagen, mensaje de error o datos extraídos.
+        """
+        with self.tracer.span("sesion", imagenes=len(image_paths)) as span:
+            results = self._process_session(image_paths, session_id)
+            if any(isinstance(result, str) for result in results):
+                span.outcome = "error"
+        self.tracer.flush()
+        return results
+
+    def _process_session(self, image_paths: List[str], session_id: str) -> List[Union[str, dict]]:
+        prompt = self.read_prompt(session_id)
+        results: List[Union[str, dict, None]] = [None] * len(image_paths)
+        keys: List[Optional[str]] = [None] * len(image_paths)
+        pending = []
+        for index, image_path in enumerate(image_paths):
+            keys[index], cached = self.cache_lookup(image_path, prompt)
+            if cached is not None:
+                results[index] = cached
+            else:
+                pending.append(index)
+
+        extracted = []
+        for start in range(0, len(pending), self.images_per_request):
+            chunk = pending[start:start + self.images_per_request]
+            images = [self.prepare_image(image_paths[index]) for index in chunk]
+            outcomes = self.extract_data_multi([image_paths[index] for index in chunk], prompt, images)
+            for index, image, outcome in zip(chunk, images, outcomes):
+                if isinstance(outcome, PIPError):
+                    results[index] = outcome.message
+                else:
+                    extracted.append((index, outcome, image))
+
+        records = []
+        for index, data, image in extracted:
+            try:
+                image_url = self.upload_image(image_paths[index], image)
+            except PIPError as e:
+                results[index] = e.message
+                continue
+            records.append((index, data, self.build_patient_record(data, session_id, image_url, prompt)))
+
+        if records:
+            try:
+                self.save_patients(self.merge_session_pages([record for _, _, record in records]))
+            except PIPError as e:
+                for index, _, _ in records:
+                    results[index] = e.message
+                return results
+            for index, data, _ in records:
+                self.cache_store(keys[index], data)
+                results[index] = data
+        return results
+
+    def process_batch(
+        self,
+        image_paths: List[str],
+        session_id: str,
+        extract_workers: Optional[int] = None,
+        upload_workers: Optional[int] = None,
+        persist_workers: Optional[int] = None,
+        max_in_flight: Optional[int] = None,
+        persist_batch_size: Optional[int] = None,
+    ) -> Dict:
+        """
+        Procesa muchas imágenes como un pipeline concurrente y acotado.
+
+        Cada etapa (extracción, subida, persistencia) tiene su propio pool de
+        hilos; una imagen pasa a la siguiente etapa apenas termina la anterior.
+        `max_in_flight` limita cuántas imágenes hay dentro del pipeline a la vez.
+        La persistencia acumula registros y los guarda con un MERGE por lote
+        (save_patients) en vez de un MERGE por paciente.
+
+        :param image_paths: Rutas locales de las imágenes.
+        :param session_id: ID de sesión con el que se registran las prescripciones.
+        :param extract_workers: Hilos para OpenAI (PIP_EXTRACT_WORKERS, default 4).
+        :param upload_workers: Hilos para Cloud Storage (PIP_UPLOAD_WORKERS, default 4).
+        :param persist_workers: Hilos para BigQuery (PIP_PERSIST_WORKERS, default 2).
+        :param max_in_flight: Máximo de imágenes en proceso (default: suma de hilos x 2).
+        :param persist_batch_size: Registros por MERGE (PIP_PERSIST_BATCH_SIZE, default 50).
+        :return: {"resultados": [...], "resumen": {...}}, resultados en el orden de entrada.
+
+        Con images_per_request > 1 cada tarea de extracción envía varias
+        imágenes consecutivas en una sola llamada (extract_data_multi). Con
+        cpu_pool y una imagen por solicitud, el trabajo de CPU de cada imagen
+        corre en ese pool (extract_data_pooled).
+        """
+        extract_workers = extract_workers or int(os.getenv("PIP_EXTRACT_WORKERS", "4"))
+        upload_workers = upload_workers or int(os.getenv("PIP_UPLOAD_WORKERS", "4"))
+        persist_workers = persist_workers or int(os.getenv("PIP_PERSIST_WORKERS", "2"))
+        max_in_flight = max_in_flight or 2 * (extract_workers + upload_workers + persist_workers)
+        persist_batch_size = persist_batch_size or int(os.getenv("PIP_PERSIST_BATCH_SIZE", "50"))
+        # Buffered records hold their in-flight slot, so a batch larger than
+        # max_in_flight would never fill up.
+        persist_batch_size = min(persist_batch_size, max_in_flight)
+        # A request holds one slot per image, so it cannot need more than exist
+        images_per_request = min(self.images_per_request, max_in_flight)
+
+        prompt = self.read_prompt(session_id)
+        results: List[Union[str, dict, None]] = [None] * len(image_paths)
+        failures: Dict[str, int] = {}
+        slots = threading.BoundedSemaphore(max_in_flight)
+        done = threading.Condition()
+        pending = [len(image_paths)]
+        # Images that have not yet reached the persistence buffer
+        upstream = [len(image_paths)]
+        buffer: List[tuple] = []
+        keys: List[Optional[str]] = [None] * len(image_paths)
+
+        def finish(index: int, result: Union[str, dict], stage: Optional[str] = None) -> None:
+            results[index] = result
+            with done:
+                if stage is not None:
+                    failures[stage] = failures.get(stage, 0) + 1
+                pending[0] -= 1
+                done.notify_all()
+            slots.release()
+
+        def run_stage(index: int, func, on_success) -> None:
+            try:
+                value = func()
+            except PIPError as e:
+                finish(index, e.message, e.stage)
+                leave_upstream(None)
+            except Exception as e:
+                logger.exception(f"Error inesperado procesando {image_paths[index]}: {e}")
+                finish(index, "Hubo un error procesando la fórmula médica.", "desconocido")
+                leave_upstream(None)
+            else:
+                on_success(value)
+
+        def leave_upstream(entry: Optional[tuple]) -> None:
+            # Called once per image when it either fails before persistence or
+            # is buffered; flushes when the buffer is full or nothing else is coming.
+            with done:
+                if entry is not None:
+                    buffer.append(entry)
+                upstream[0] -= 1
+                if not buffer or (len(buffer) < persist_batch_size and upstream[0] > 0):
+                    return
+                flush = buffer[:]
+                buffer.clear()
+            persist_pool.submit(persist, flush)
+
+        def persist(entries: List[tuple]) -> None:
+            try:
+                self.save_patients([record for _, _, record in entries])
+            except PIPError as e:
+                for index, _, _ in entries:
+                    finish(index, e.message, e.stage)
+            else:
+                for index, data, _ in entries:
+                    self.cache_store(keys[index], data)
+                    finish(index, data)
+
+        started = time.perf_counter()
+        with ThreadPoolExecutor(extract_workers, thread_name_prefix="pip-extract") as extract_pool, \
+                ThreadPoolExecutor(upload_workers, thread_name_prefix="pip-upload") as upload_pool, \
+                ThreadPoolExecutor(persist_workers, thread_name_prefix="pip-persist") as persist_pool:
+
+            def upload(index: int, data: dict, image: Optional[PreprocessedImage]) -> None:
+                run_stage(
+                    index,
+                    lambda: self.upload_image(image_paths[index], image),
+                    lambda url: leave_upstream((index, data, self.build_patient_record(data, session_id, url, prompt))),
+                )
+
+            def extract(chunk: List[int]) -> None:
+                todo = []
+                for index in chunk:
+                    try:
+                        keys[index], cached = self.cache_lookup(image_paths[index], prompt)
+                    except OSError as e:
+                        logger.warning(f"No se pudo consultar la caché para {image_paths[index]}: {e}")
+                        cached = None
+                    if cached is not None:
+                        finish(index, cached)
+                        leave_upstream(None)
+                    else:
+                        todo.append(index)
+                if not todo:
+                    return
+
+                try:
+                    if self.cpu_pool is not None and len(todo) == 1 and not self.streaming:
+                        try:
+                            data, image = self.extract_data_pooled(image_paths[todo[0]], prompt)
+                            outcomes, images = [data], [image]
+                        except PIPError as e:
+                            outcomes, images = [e], [None]
+                    else:
+                        images = [self.prepare_image(image_paths[index]) for index in todo]
+                        outcomes = self.extract_data_multi([image_paths[index] for index in todo], prompt, images)
+                except Exception as e:
+                    logger.exception(f"Error inesperado extrayendo {[image_paths[index] for index in todo]}: {e}")
+                    for index in todo:
+                        finish(index, "Hubo un error procesando la fórmula médica.", "desconocido")
+                        leave_upstream(None)
+                    return
+
+                def extract_stage(outcome: Union[dict, PIPError], image: Optional[PreprocessedImage]):
+                    if isinstance(outcome, PIPError):
+                        raise outcome
+                    # Only keep the optimized bytes in flight if the upload will use them
+                    return outcome, (image if self.upload_optimized else None)
+
+                for index, image, outcome in zip(todo, images, outcomes):
+                    run_stage(
+                        index,
+                        lambda outcome=outcome, image=image: extract_stage(outcome, image),
+                        lambda result, index=index: upload_pool.submit(upload, index, *result),
+                    )
+
+            for start in range(0, len(image_paths), images_per_request):
+                chunk = list(range(start, min(start + images_per_request, len(image_paths))))
+                for _ in chunk:
+                    slots.acquire()
+                extract_pool.submit(extract, chunk)
+
+            with done:
+                done.wait_for(lambda: pending[0] == 0)
+
+        elapsed = time.perf_counter() - started
+        failed = sum(failures.values())
+        summary = {
+            "total": len(image_paths),
+            "exitosas": len(image_paths) - failed,
+            "fallidas": failed,
+            "fallas_por_etapa": failures,
+            "segundos": round(elapsed, 3),
+            "imagenes_por_segundo": round(len(image_paths) / elapsed, 3) if elapsed > 0 else 0.0,
+        }
+        if self.cache is not None:
+            summary["cache"] = self.cache.stats()
+        if isinstance(self.patient_store, PatientCache):
+            summary["pacientes_cache"] = self.patient_store.stats()
+        if self.cpu_pool is not None:
+            summary["cpu"] = self.cpu_pool.stats()
+        logger.info(f"Lote procesado: {summary}")
+        self.tracer.flush()
+        return {"resultados": results, "resumen": summary}
+
+    def process_directory(self, directory: str, session_id: str, **kwargs) -> Dict:
+        """
+        Procesa todas las imágenes de una carpeta con process_batch.
+
+        :param directory: Carpeta con las imágenes (no recursivo).
+        :param session_id: ID de sesión con el que se registran las prescripciones.
+        :param kwargs: Parámetros de concurrencia de process_batch.
+        :return: Igual que process_batch, con la lista de rutas en "rutas".
+        """
+        image_paths = sorted(
+            os.path.join(directory, name)
+            for name in os.listdir(directory)
+            if name.lower().endswith(IMAGE_EXTENSIONS)
+        )
+        batch = self.process_batch(image_paths, session_id, **kwargs)
+        batch["rutas"] = image_paths
+        return batch
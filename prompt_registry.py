@@ -0,0 +1,159 @@
+import os
+import time
+import hashlib
+import logging
+import threading
+from typing import Dict, List, NamedTuple, Optional, Tuple
+
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_PROMPT = "pip"
+VERSION_LENGTH = 12
+
+
+def prompt_version(text: str) -> str:
+    """
+    Versión de un prompt: los primeros 12 caracteres del SHA-256 de su texto.
+
+    Dos prompts con el mismo texto tienen la misma versión sin importar de
+    qué archivo salieron.
+
+    :param text: Texto del prompt.
+    :return: Versión en hexadecimal.
+    """
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()[:VERSION_LENGTH]
+
+
+class Prompt(NamedTuple):
+    """
+    Un prompt cargado, con su versión.
+    """
+    name: str
+    text: str
+    version: str
+    path: str
+    mtime_ns: int
+
+
+def parse_variants(value: str) -> Dict[str, Tuple[str, int]]:
+    """
+    Interpreta PIP_PROMPT_VARIANTS: "b=prompt_PIP_b.txt:10,c=prompt_c.txt:5".
+
+    :param value: Variantes separadas por coma, cada una nombre=ruta:porcentaje.
+    :return: nombre -> (ruta, porcentaje).
+    :raises ValueError: Si una variante está mal escrita o los porcentajes suman más de 100.
+    """
+    variants = {}
+    for item in filter(None, (part.strip() for part in value.split(","))):
+        name, sep, rest = item.partition("=")
+        path, _, percent = rest.rpartition(":")
+        if not sep or not name.strip() or not path or not percent.strip().isdigit():
+            raise ValueError(f"Variante de prompt inválida: {item!r} (se espera nombre=ruta:porcentaje)")
+        variants[name.strip()] = (path.strip(), int(percent))
+    if sum(percent for _, percent in variants.values()) > 100:
+        raise ValueError("Los porcentajes de las variantes de prompt suman más de 100")
+    return variants
+
+
+class PromptRegistry:
+    """
+    Prompts de extracción leídos una vez y recargados cuando cambia el archivo.
+
+    Cada prompt tiene una versión (prompt_version) que se guarda con cada
+    prescripción. Para probar prompts nuevos se registran variantes con un
+    porcentaje: choose(llave) asigna cada sesión siempre a la misma variante y
+    el resto de las sesiones usa el prompt principal.
+    """
+
+    def __init__(
+        self,
+        path: Optional[str] = None,
+        variants: Optional[Dict[str, Tuple[str, int]]] = None,
+        check_interval: Optional[float] = None,
+    ):
+        """
+        :param path: Prompt principal (PROMPT_PIP_PATH, default prompt_PIP.txt).
+        :param variants: nombre -> (ruta, porcentaje de sesiones); por defecto PIP_PROMPT_VARIANTS.
+        :param check_interval: Segundos entre revisiones del mtime de cada
+            archivo (PIP_PROMPT_CHECK_SECONDS, default 2); 0 revisa en cada uso.
+        """
+        if variants is None:
+            variants = parse_variants(os.getenv("PIP_PROMPT_VARIANTS", ""))
+        if check_interval is None:
+            check_interval = float(os.getenv("PIP_PROMPT_CHECK_SECONDS", "2"))
+        self.check_interval = check_interval
+        self._paths: Dict[str, str] = {DEFAULT_PROMPT: path or os.getenv("PROMPT_PIP_PATH", "prompt_PIP.txt")}
+        self._split: List[Tuple[str, int]] = []
+        for name, (variant_path, percent) in variants.items():
+            self._paths[name] = variant_path
+            self._split.append((name, percent))
+        self._loaded: Dict[str, Prompt] = {}
+        self._checked: Dict[str, float] = {}
+        self._lock = threading.Lock()
+
+    @property
+    def path(self) -> str:
+        return self._paths[DEFAULT_PROMPT]
+
+    def get(self, name: str = DEFAULT_PROMPT) -> Prompt:
+        """
+        Retorna un prompt, releyéndolo solo si su archivo cambió.
+
+        :param name: Nombre del prompt.
+        :return: Prompt con texto y versión.
+        :raises OSError: Si el archivo no se puede leer y no hay una versión cargada.
+        """
+        now = time.monotonic()
+        with self._lock:
+            loaded = self._loaded.get(name)
+            if loaded is not None and now - self._checked.get(name, 0.0) < self.check_interval:
+                return loaded
+            self._checked[name] = now
+            path = self._paths[name]
+            try:
+                mtime_ns = os.stat(path).st_mtime_ns
+                if loaded is not None and loaded.mtime_ns == mtime_ns:
+                    return loaded
+                with open(path, "r", encoding="utf-8") as f:
+                    text = f.read()
+            except OSError as e:
+                if loaded is None:
+                    raise
+                logger.warning(f"No se pudo releer el prompt {name} ({path}), se sigue usando {loaded.version}: {e}")
+                return loaded
+
+            prompt = Prompt(name, text, prompt_version(text), path, mtime_ns)
+            if loaded is None:
+                logger.info(f"Prompt {name} cargado: versión {prompt.version}")
+            elif prompt.version != loaded.version:
+                logger.info(f"Prompt {name} actualizado: {loaded.version} -> {prompt.version}")
+            self._loaded[name] = prompt
+            return prompt
+
+    def choose(self, key: Optional[str] = None) -> Prompt:
+        """
+        Elige el prompt para una llave (p. ej. el ID de sesión).
+
+        La misma llave cae siempre en la misma variante mientras no cambien
+        los porcentajes; sin llave o sin variantes se usa el prompt principal.
+
+        :param key: Llave de asignación.
+        :return: Prompt elegido.
+        """
+        if key is None or not self._split:
+            return self.get()
+        bucket = int(hashlib.sha256(key.encode("utf-8")).hexdigest()[:8], 16) % 100
+        cumulative = 0
+        for name, percent in self._split:
+            cumulative += percent
+            if bucket < cumulative:
+                return self.get(name)
+        return self.get()
+
+    def versions(self) -> Dict[str, str]:
+        """
+        Versiones cargadas por nombre de prompt.
+        """
+        with self._lock:
+            return {name: prompt.version for name, prompt in self._loaded.items()}
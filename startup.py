@@ -0,0 +1,53 @@
+import importlib
+import threading
+from types import ModuleType
+
+
+_env_loaded = False
+_env_lock = threading.Lock()
+
+
+def load_env() -> None:
+    """
+    Carga el archivo .env una sola vez por proceso.
+
+    Se llama desde PIPProcessor y desde los get_client() de cada servicio; las
+    llamadas siguientes no hacen nada.
+    """
+    global _env_loaded
+    if _env_loaded:
+        return
+    with _env_lock:
+        if not _env_loaded:
+            from dotenv import load_dotenv
+            load_dotenv()
+            _env_loaded = True
+
+
+class LazyModule:
+    """
+    Módulo que se importa en el primer acceso a uno de sus atributos.
+
+    Permite escribir `bigquery = LazyModule("google.cloud.bigquery")` y usar
+    `bigquery.Client` como siempre, sin pagar el import de los SDK pesados al
+    importar pip_processor (arranque en frío de Cloud Run / Functions).
+    """
+
+    def __init__(self, name: str):
+        self.__dict__["_name"] = name
+        self.__dict__["_module"] = None
+
+    def _load(self) -> ModuleType:
+        module = self.__dict__["_module"]
+        if module is None:
+            # import_module is thread-safe; the cache only avoids repeated lookups
+            module = importlib.import_module(self.__dict__["_name"])
+            self.__dict__["_module"] = module
+        return module
+
+    def __getattr__(self, attr: str):
+        return getattr(self._load(), attr)
+
+    def __repr__(self) -> str:
+        state = "cargado" if self.__dict__["_module"] is not None else "sin cargar"
+        return f"<LazyModule {self.__dict__['_name']} ({state})>"
@@ -0,0 +1,113 @@
+import os
+import asyncio
+import tempfile
+import threading
+import time
+import unittest
+from unittest.mock import patch
+
+from async_pip_processor import AsyncPIPProcessor
+from cloud_storage_service import GCSUploader
+from instrumentation import StageMetrics, Tracer
+from offline_fakes import FakeOpenAIServer, FaultInjector, FilesystemBucket, SQLitePatientStore
+from openai_client import AsyncOpenAIClient
+from pip_processor import PIPProcessor
+
+
+class _SlowStore(SQLitePatientStore):
+    """
+    Tabla local que registra cuántos MERGE corren a la vez.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.running = 0
+        self.peak = 0
+        self._count_lock = threading.Lock()
+
+    def insert_or_update_patient_data(self, paciente):
+        with self._count_lock:
+            self.running += 1
+            self.peak = max(self.peak, self.running)
+        time.sleep(0.05)
+        try:
+            super().insert_or_update_patient_data(paciente)
+        finally:
+            with self._count_lock:
+                self.running -= 1
+
+
+class TestAsyncPIPProcessor(unittest.IsolatedAsyncioTestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmpdir.cleanup)
+        patcher = patch.object(PIPProcessor, "read_prompt", return_value="prompt")
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.bucket = FilesystemBucket(os.path.join(self.tmpdir.name, "bucket"))
+
+    def _images(self, count):
+        paths = []
+        for i in range(count):
+            paths.append(os.path.join(self.tmpdir.name, f"formula_{i}.jpg"))
+            with open(paths[-1], "wb") as f:
+                f.write(b"\xff\xd8\xff\xe0" + str(i).encode() * 50)
+        return paths
+
+    def _processor(self, server, store, **kwargs):
+        self.metrics = StageMetrics()
+        processor = PIPProcessor(
+            uploader=GCSUploader("bucket-local", bucket=self.bucket),
+            patient_store=store,
+            tracer=Tracer([self.metrics]),
+        )
+        processor.cache = None
+        client = AsyncOpenAIClient(api_key="local", api_url=server.url, backoff_base=0.01, backoff_max=0.05)
+        return AsyncPIPProcessor(processor, client, **kwargs)
+
+    async def test_concurrent_images_with_bounded_persistence(self):
+        store = _SlowStore()
+        with FakeOpenAIServer(FaultInjector(latency_ms=20, rate_limit_rate=0.2, seed=5)) as server:
+            async with self._processor(server, store, persist_concurrency=2) as processor:
+                results = await asyncio.gather(
+                    *(processor.process_image(path, "sesion-async") for path in self._images(10))
+                )
+
+        self.assertTrue(all(isinstance(r, dict) for r in results))
+        self.assertEqual(store.count(), 10)
+        self.assertLessEqual(store.peak, 2)
+        self.assertGreater(self.metrics.snapshot()["openai"]["totals"]["prompt_tokens"], 0)
+        self.assertEqual(processor.active_sessions(), {})
+
+    async def test_cancel_session_stops_pending_images(self):
+        store = SQLitePatientStore()
+        with FakeOpenAIServer(FaultInjector(latency_ms=500)) as server:
+            async with self._processor(server, store) as processor:
+                abandoned = [asyncio.create_task(processor.process_image(p, "abandonada")) for p in self._images(3)]
+                kept = asyncio.create_task(processor.process_image(self._images(4)[3], "activa"))
+                await asyncio.sleep(0.1)
+
+                self.assertEqual(processor.cancel_session("abandonada"), 3)
+                outcomes = await asyncio.gather(*abandoned, return_exceptions=True)
+                resultado = await kept
+
+        self.assertTrue(all(isinstance(o, asyncio.CancelledError) for o in outcomes))
+        self.assertIsInstance(resultado, dict)
+        self.assertEqual(store.count(), 1)
+        self.assertEqual(self.metrics.snapshot()["imagen"]["outcomes"], {"cancelada": 3, "ok": 1})
+
+    async def test_rejected_image_is_not_uploaded(self):
+        store = SQLitePatientStore()
+        image = self._images(1)[0]
+        with FakeOpenAIServer(reject_marker="data:image") as server:
+            async with self._processor(server, store) as processor:
+                resultado = await processor.process_image(image, "sesion-rechazo")
+
+        self.assertIn("fórmula médica válida", resultado)
+        self.assertEqual(self.bucket.uploads, 0)
+        self.assertEqual(self.metrics.snapshot()["parseo"]["outcomes"], {"rechazada": 1})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,115 @@
+import os
+import json
+import tempfile
+import unittest
+from unittest.mock import patch
+
+import batch_backfill
+from batch_backfill import BackfillJob, BatchClient
+from cloud_storage_service import GCSUploader
+from offline_fakes import FakeOpenAIServer, FaultInjector, FilesystemBucket, SQLitePatientStore
+from pip_processor import PIPProcessor
+
+
+class TestBatchBackfill(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmpdir.cleanup)
+        patcher = patch.object(PIPProcessor, "read_prompt", return_value="Extrae los datos de la fórmula.")
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        self.server = FakeOpenAIServer(batch_polls=2).start()
+        self.addCleanup(self.server.stop)
+        self.client = BatchClient(api_key="local", base_url=self.server.base_url)
+
+        self.bucket = FilesystemBucket(os.path.join(self.tmpdir.name, "bucket"))
+        self.store = SQLitePatientStore()
+        self.processor = PIPProcessor(
+            uploader=GCSUploader("bucket-local", bucket=self.bucket),
+            patient_store=self.store,
+            speculative_upload=False,
+        )
+        self.processor.cache = None
+        self.work_dir = os.path.join(self.tmpdir.name, "trabajo")
+
+    def _images(self, count):
+        paths = []
+        for i in range(count):
+            path = os.path.join(self.tmpdir.name, f"formula_{i}.jpg")
+            with open(path, "wb") as f:
+                f.write(b"\xff\xd8\xff\xe0" + str(i).encode() * 100)
+            paths.append(path)
+        return paths
+
+    def test_prepare_splits_files_by_request_count(self):
+        job = batch_backfill.prepare(self._images(5), self.work_dir, "sesion-backfill", self.processor, max_requests=2)
+
+        self.assertEqual([len(batch["imagenes"]) for batch in job.batches], [2, 2, 1])
+        with open(os.path.join(self.work_dir, job.batches[0]["archivo"]), encoding="utf-8") as f:
+            line = json.loads(f.readline())
+        self.assertEqual(line["url"], "/v1/chat/completions")
+        self.assertEqual(line["body"]["messages"][0]["content"], "Extrae los datos de la fórmula.")
+        self.assertEqual(BackfillJob(self.work_dir).batches[2]["imagenes"], job.batches[2]["imagenes"])
+
+    def test_end_to_end_against_local_batch_api(self):
+        job = batch_backfill.prepare(self._images(6), self.work_dir, "sesion-backfill", self.processor, max_requests=4)
+        batch_backfill.submit(job, self.client)
+
+        states = batch_backfill.poll(job, self.client, interval=0)
+        summaries = batch_backfill.process(job, self.client, self.processor, persist_batch_size=3)
+
+        self.assertEqual(states, {"completed": 2})
+        self.assertEqual(self.server.requests, 0)
+        self.assertEqual([summary["exitosas"] for summary in summaries], [4, 2])
+        self.assertEqual(self.store.count(), 6)
+        self.assertEqual(self.bucket.uploads, 6)
+        self.assertLessEqual(self.store.jobs, 3)
+        # Processed batches are not downloaded or persisted again
+        self.assertEqual(batch_backfill.process(BackfillJob(self.work_dir), self.client, self.processor), [])
+
+    def test_failed_requests_are_reported_per_stage(self):
+        self.server.faults = FaultInjector(error_rate=0.5, seed=3)
+        job = batch_backfill.prepare(self._images(8), self.work_dir, "sesion-backfill", self.processor)
+        batch_backfill.submit(job, self.client)
+        batch_backfill.poll(job, self.client, interval=0)
+
+        (summary,) = batch_backfill.process(job, self.client, self.processor)
+
+        failed = job.batches[0]["conteos"]["failed"]
+        self.assertGreater(failed, 0)
+        self.assertEqual(summary["fallas_por_etapa"], {"extraccion": failed})
+        self.assertEqual(summary["exitosas"], 8 - failed)
+        self.assertEqual(self.store.count(), 8 - failed)
+        self.assertTrue(os.path.exists(os.path.join(self.work_dir, "lote_000.errores.jsonl")))
+
+    def test_failed_persist_chunks_are_retried_on_the_next_run(self):
+        job = batch_backfill.prepare(self._images(6), self.work_dir, "sesion-backfill", self.processor)
+        batch_backfill.submit(job, self.client)
+        batch_backfill.poll(job, self.client, interval=0)
+        upsert = self.store.upsert_patients
+        calls = []
+
+        def fail_second_chunk(records, *args, **kwargs):
+            calls.append(len(records))
+            if len(calls) == 2:
+                raise RuntimeError("BigQuery no disponible")
+            return upsert(records, *args, **kwargs)
+
+        with patch.object(self.store, "upsert_patients", side_effect=fail_second_chunk):
+            (first,) = batch_backfill.process(job, self.client, self.processor, persist_batch_size=2)
+
+        self.assertEqual((first["exitosas"], first["pendientes"]), (4, 2))
+        self.assertFalse(job.batches[0]["procesado"])
+        self.assertEqual(self.store.count(), 4)
+
+        (second,) = batch_backfill.process(BackfillJob(self.work_dir), self.client, self.processor)
+
+        self.assertEqual((second["total"], second["exitosas"], second["pendientes"]), (2, 2, 0))
+        self.assertEqual(self.store.count(), 6)
+        self.assertEqual(batch_backfill.process(BackfillJob(self.work_dir), self.client, self.processor), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,83 @@
+import os
+import unittest
+from unittest.mock import patch
+
+import bigquery_changelog
+import bigquery_service
+
+
+TEST_ENV = {"PROJECT_ID": "test-project", "DATASET_ID": "test-dataset", "TABLE_ID": "test-table"}
+FULL_TABLE_ID = "test-project.test-dataset.test-table"
+
+
+@patch.dict(os.environ, TEST_ENV)
+class TestChangelogWrites(unittest.TestCase):
+
+    RECORD = {
+        "paciente_clave": "COCC1",
+        "nombre_paciente": "Ana",
+        "telefono_contacto": ["300"],
+        "prescripciones": [{"id_session": "s1", "url_prescripcion": "gs://b/a.jpg", "medicamentos": []}],
+    }
+
+    def test_change_row_lists_sent_fields_and_is_deterministic(self):
+        row = bigquery_changelog.change_row(self.RECORD, "2025-01-01T00:00:00+00:00")
+
+        self.assertEqual(row["campos"], ["nombre_paciente", "telefono_contacto"])
+        self.assertNotIn("prescripciones", row)
+        self.assertEqual(row["cambio_id"], bigquery_changelog.change_row(dict(self.RECORD), "2025-01-01T00:00:00+00:00")["cambio_id"])
+        self.assertNotEqual(row["cambio_id"], bigquery_changelog.change_row(self.RECORD, "2025-01-01T00:00:01+00:00")["cambio_id"])
+        with self.assertRaisesRegex(ValueError, "edad"):
+            bigquery_changelog.change_row({"paciente_clave": "COCC1", "edad": 3}, "2025-01-01T00:00:00+00:00")
+
+    @patch("bigquery_service.client")
+    def test_store_only_streams_inserts(self, mock_client):
+        mock_client.insert_rows_json.return_value = []
+
+        store = bigquery_service.get_patient_store("changelog")
+        self.assertEqual(store.upsert_patients([self.RECORD, {**self.RECORD, "nombre_paciente": "Ana M"}]), 1)
+
+        mock_client.query.assert_not_called()
+        tables = [call.args[0] for call in mock_client.insert_rows_json.call_args_list]
+        self.assertEqual(tables, [f"{FULL_TABLE_ID}_cambios", f"{FULL_TABLE_ID}_prescripciones"])
+        changes = mock_client.insert_rows_json.call_args_list[0]
+        self.assertEqual([r["nombre_paciente"] for r in changes.args[1]], ["Ana", "Ana M"])
+        self.assertEqual(changes.kwargs["row_ids"], [r["cambio_id"] for r in changes.args[1]])
+
+
+@patch.dict(os.environ, TEST_ENV)
+class TestCompaction(unittest.TestCase):
+
+    def test_script_merges_and_advances_watermark_in_one_transaction(self):
+        script = bigquery_changelog.compaction_script()
+
+        self.assertLess(script.index("BEGIN TRANSACTION"), script.index(f"MERGE `{FULL_TABLE_ID}` AS target_table"))
+        self.assertLess(script.index(f"MERGE `{FULL_TABLE_ID}_compactacion`"), script.index("COMMIT TRANSACTION"))
+        self.assertIn("registrado_en > TIMESTAMP_SUB(desde, INTERVAL @solapamiento SECOND) AND registrado_en <= hasta", script)
+        self.assertIn("QUALIFY ROW_NUMBER() OVER (PARTITION BY cambio_id) = 1", script)
+        self.assertIn("nombre_paciente = IF(source_table.nombre_paciente IS NULL, target_table.nombre_paciente, source_table.nombre_paciente.v)", script)
+        self.assertIn("marca = GREATEST(w.marca, hasta)", script)
+
+    @patch("bigquery_service.client")
+    def test_compact_passes_window_parameters(self, mock_client):
+        bigquery_changelog.compact(lag_seconds=60, overlap_seconds=600)
+
+        params = mock_client.query.call_args.kwargs["job_config"].query_parameters
+        self.assertEqual({p.name: p.value for p in params}, {"proceso": "pacientes", "retraso": 60, "solapamiento": 600})
+
+    @patch("bigquery_changelog.compact")
+    @patch("bigquery_changelog.pending_changes")
+    def test_maybe_compact_thresholds(self, mock_pending, mock_compact):
+        mock_pending.return_value = {"pendientes": 10, "segundos_desde_compactacion": 30}
+        self.assertFalse(bigquery_changelog.maybe_compact(min_rows=100, max_interval_seconds=600))
+
+        mock_pending.return_value = {"pendientes": 10, "segundos_desde_compactacion": 900}
+        self.assertTrue(bigquery_changelog.maybe_compact(min_rows=100, max_interval_seconds=600))
+
+        mock_pending.return_value = {"pendientes": 0, "segundos_desde_compactacion": None}
+        self.assertFalse(bigquery_changelog.maybe_compact(min_rows=100, max_interval_seconds=600))
+        mock_compact.assert_called_once()
+
+
+if __name__ == '__main__':
+    unittest.main()
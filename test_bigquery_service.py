@@ -8,7 +8,11 @@ from google.cloud import bigquery
 # we might need to inspect their attributes.
 
 # Function to be tested
-from bigquery_service import insert_or_update_patient_data
+import bigquery_service
+from bigquery_service import MERGE_PRESCRIPTIONS_SQL, insert_or_update_patient_data, upsert_patients
+from offline_fakes import fake_datos
+from pip_processor import PIPProcessor
+from prompt_registry import prompt_version
 
 # Define dummy env vars for tests
 TEST_PROJECT_ID = "test-project"
@@ -16,8 +20,44 @@ TEST_DATASET_ID = "test-dataset"
 TEST_TABLE_ID = "test-table"
 FULL_TABLE_ID = f"{TEST_PROJECT_ID}.{TEST_DATASET_ID}.{TEST_TABLE_ID}"
 
+
+def struct_rows(job_config):
+    """Read back the @registros rows from the API representation."""
+    # Parsing nested empty STRUCT arrays through job_config.query_parameters
+    # is not supported by the client.
+    registros = job_config.to_api_repr()["query"]["queryParameters"][0]
+    assert registros["name"] == "registros"
+
+    def plain(value):
+        if "structValues" in value:
+            return {k: plain(v) for k, v in value["structValues"].items()}
+        if "arrayValues" in value:
+            return [plain(v) for v in value["arrayValues"]]
+        return value["value"]
+
+    return [plain(row) for row in registros["parameterValue"]["arrayValues"]]
+
+
+def receta(session_id, *medicamentos):
+    """Prescription with the fields build_patient_record writes."""
+    return {
+        "id_session": session_id,
+        "url_prescripcion": f"gs://bucket/{session_id}.jpg",
+        "categoria_riesgo": None,
+        "diagnostico": "HTA",
+        "IPS": "IPS1",
+        "medicamentos": [{"nombre": nombre, "dosis": dosis, "cantidad": "30"} for nombre, dosis in medicamentos],
+        "version_prompt": "abc123def456",
+    }
+
+
 class TestBigQueryService(unittest.TestCase):
 
+    def setUp(self):
+        # The client is cached per process; each test patches its own Client
+        bigquery_service.reset_client()
+        self.addCleanup(bigquery_service.reset_client)
+
     @patch.dict(os.environ, {
         "PROJECT_ID": TEST_PROJECT_ID,
         "DATASET_ID": TEST_DATASET_ID,
@@ -33,50 +73,39 @@ class TestBigQueryService(unittest.TestCase):
             "nombre": "John Doe",
             "edad": 30,
             "ultima_visita": "2023-10-26", # Example of another field
-            "prescripciones": [
-                {"medicamento": "MedA", "dosis": "10mg", "fecha": "2023-10-26"},
-                {"medicamento": "MedB", "dosis": "5mg", "fecha": "2023-10-26"},
-            ]
+            "prescripciones": [receta("s1", ("MedA", "10mg")), receta("s2", ("MedB", "5mg"))]
         }
 
         insert_or_update_patient_data(paciente_data)
 
         mock_client_instance.query.assert_called_once()
         call_args = mock_client_instance.query.call_args
-        
+
         # Check the query string (first positional argument)
         actual_query = call_args[0][0]
         self.assertIn(f"MERGE `{FULL_TABLE_ID}` AS target_table", actual_query)
-        self.assertIn("USING (SELECT @paciente_clave AS K_paciente_clave) AS source_table", actual_query)
-        self.assertIn("ON target_table.paciente_clave = source_table.K_paciente_clave", actual_query)
+        self.assertIn("USING (SELECT * FROM UNNEST(@registros)) AS source_table", actual_query)
+        self.assertIn("ON target_table.paciente_clave = source_table.paciente_clave", actual_query)
         self.assertIn("WHEN NOT MATCHED BY TARGET THEN", actual_query)
         self.assertIn("INSERT (paciente_clave, nombre, edad, ultima_visita, prescripciones)", actual_query) # Order matters for this simple check
-        self.assertIn("VALUES (@paciente_clave, @nombre, @edad, @ultima_visita, @prescripciones)", actual_query)
-        
+
         # Check the JobConfig and its query_parameters (passed as keyword argument)
         job_config = call_args[1]['job_config']
         self.assertIsInstance(job_config, bigquery.QueryJobConfig)
-        
-        params_dict = {p.name: (p.value, p.parameter_type) for p in job_config.query_parameters}
 
-        self.assertEqual(params_dict["paciente_clave"][0], "PN001")
-        self.assertEqual(params_dict["nombre"][0], "John Doe")
-        self.assertEqual(params_dict["edad"][0], 30)
-        self.assertEqual(params_dict["ultima_visita"][0], "2023-10-26")
-        
-        # Check prescripciones parameter
-        presc_param_value = params_dict["prescripciones"][0]
-        presc_param_type = params_dict["prescripciones"][1] # This is the StructType
-        
-        expected_presc_data = [
-            ("MedA", "10mg", "2023-10-26"),
-            ("MedB", "5mg", "2023-10-26"),
-        ]
-        self.assertEqual(presc_param_value, expected_presc_data)
-        
-        self.assertIsInstance(presc_param_type, bigquery.StructType)
-        field_names = [f.name for f in presc_param_type.fields]
-        self.assertEqual(field_names, ["medicamento", "dosis", "fecha"])
+        rows = struct_rows(job_config)
+        self.assertEqual(len(rows), 1)
+        self.assertEqual(rows[0]["paciente_clave"], "PN001")
+        self.assertEqual(rows[0]["nombre"], "John Doe")
+        self.assertEqual(rows[0]["edad"], "30")
+        self.assertEqual(rows[0]["ultima_visita"], "2023-10-26")
+        self.assertEqual(rows[0]["prescripciones"], paciente_data["prescripciones"])
+
+        # The prescripciones STRUCT carries every field of the shared definition
+        registros = job_config.to_api_repr()["query"]["queryParameters"][0]
+        row_type = {f["name"]: f["type"] for f in registros["parameterType"]["arrayType"]["structTypes"]}
+        presc_type = row_type["prescripciones"]["arrayType"]
+        self.assertEqual([f["name"] for f in presc_type["structTypes"]], list(bigquery_service.PRESCRIPTION_COLUMNS))
 
     @patch.dict(os.environ, {
         "PROJECT_ID": TEST_PROJECT_ID,
@@ -92,9 +121,7 @@ class TestBigQueryService(unittest.TestCase):
             "paciente_clave": "PX007",
             "nombre": "Jane Smith", # Assume name can change
             "edad": 45,             # Assume age can change
-            "prescripciones": [ # New prescriptions to add
-                {"medicamento": "MedC", "dosis": "100mg", "fecha": "2023-11-01"},
-            ]
+            "prescripciones": [receta("s3", ("MedC", "100mg"))] # New prescriptions to add
         }
 
         insert_or_update_patient_data(paciente_data)
@@ -105,25 +132,13 @@ class TestBigQueryService(unittest.TestCase):
         self.assertIn(f"MERGE `{FULL_TABLE_ID}` AS target_table", actual_query)
         self.assertIn("WHEN MATCHED THEN", actual_query)
         # Check for dynamic fields in SET, excluding paciente_clave
-        self.assertIn("SET nombre = @nombre, edad = @edad, prescripciones = ARRAY(SELECT DISTINCT x FROM UNNEST(ARRAY_CONCAT(target_table.prescripciones, @prescripciones)) x)", actual_query)
-        # A more robust check for SET clause:
-        # expected_set_clause = "SET nombre = @nombre, edad = @edad, prescripciones = ARRAY(SELECT DISTINCT x FROM UNNEST(ARRAY_CONCAT(target_table.prescripciones, @prescripciones)) x)"
-        # self.assertTrue(expected_set_clause in actual_query or 
-        #                 "SET edad = @edad, nombre = @nombre, prescripciones = ARRAY(SELECT DISTINCT x FROM UNNEST(ARRAY_CONCAT(target_table.prescripciones, @prescripciones)) x)" in actual_query)
+        self.assertIn(f"SET nombre = source_table.nombre, edad = source_table.edad, prescripciones = {MERGE_PRESCRIPTIONS_SQL}", actual_query)
 
-
-        job_config = call_args[1]['job_config']
-        params_dict = {p.name: (p.value, p.parameter_type) for p in job_config.query_parameters}
-
-        self.assertEqual(params_dict["paciente_clave"][0], "PX007")
-        self.assertEqual(params_dict["nombre"][0], "Jane Smith")
-        self.assertEqual(params_dict["edad"][0], 45)
-        
-        presc_param_value = params_dict["prescripciones"][0]
-        expected_presc_data = [
-            ("MedC", "100mg", "2023-11-01"),
-        ]
-        self.assertEqual(presc_param_value, expected_presc_data)
+        rows = struct_rows(call_args[1]['job_config'])
+        self.assertEqual(rows[0]["paciente_clave"], "PX007")
+        self.assertEqual(rows[0]["nombre"], "Jane Smith")
+        self.assertEqual(rows[0]["edad"], "45")
+        self.assertEqual(rows[0]["prescripciones"], paciente_data["prescripciones"])
 
     # Test for updating a patient who initially has no prescriptions (empty or null array)
     # This is covered by the general update logic if target_table.prescripciones is NULL (ARRAY_CONCAT handles NULLs gracefully)
@@ -142,9 +157,7 @@ class TestBigQueryService(unittest.TestCase):
             "paciente_clave": "PX008",
             "nombre": "Alice Wonderland",
             "edad": 30,
-            "prescripciones": [
-                {"medicamento": "MedX", "dosis": "10mg", "fecha": "2023-11-05"},
-            ]
+            "prescripciones": [receta("s4", ("MedX", "10mg"))]
         }
         insert_or_update_patient_data(paciente_data)
         mock_client_instance.query.assert_called_once()
@@ -152,14 +165,11 @@ class TestBigQueryService(unittest.TestCase):
         actual_query = call_args[0][0]
 
         self.assertIn("WHEN MATCHED THEN", actual_query)
-        self.assertIn("prescripciones = ARRAY(SELECT DISTINCT x FROM UNNEST(ARRAY_CONCAT(target_table.prescripciones, @prescripciones)) x)", actual_query)
+        self.assertIn(f"prescripciones = {MERGE_PRESCRIPTIONS_SQL}", actual_query)
 
-        job_config = call_args[1]['job_config']
-        params_dict = {p.name: (p.value, p.parameter_type) for p in job_config.query_parameters}
-        self.assertEqual(params_dict["paciente_clave"][0], "PX008")
-        presc_param_value = params_dict["prescripciones"][0]
-        expected_presc_data = [("MedX", "10mg", "2023-11-05")]
-        self.assertEqual(presc_param_value, expected_presc_data)
+        rows = struct_rows(call_args[1]['job_config'])
+        self.assertEqual(rows[0]["paciente_clave"], "PX008")
+        self.assertEqual(rows[0]["prescripciones"], paciente_data["prescripciones"])
 
 
     @patch.dict(os.environ, {
@@ -170,7 +180,7 @@ class TestBigQueryService(unittest.TestCase):
     @patch('bigquery_service.bigquery.Client')
     def test_update_existing_patient_with_duplicate_prescriptions(self, MockBigQueryClient):
         # This test focuses on the query construction; the actual de-duplication happens in BigQuery
-        # We verify that @prescripciones parameter contains all passed items, including potential duplicates.
+        # We verify that the prescripciones parameter contains all passed items, including potential duplicates.
         mock_client_instance = MockBigQueryClient.return_value
         mock_client_instance.query.return_value.result = MagicMock()
 
@@ -179,9 +189,9 @@ class TestBigQueryService(unittest.TestCase):
             "nombre": "Bob The Builder",
             "edad": 50,
             "prescripciones": [
-                {"medicamento": "MedY", "dosis": "20mg", "fecha": "2023-11-10"}, # New
-                {"medicamento": "MedZ", "dosis": "5mg", "fecha": "2023-11-10"},  # New
-                {"medicamento": "MedY", "dosis": "20mg", "fecha": "2023-11-10"}, # Duplicate of new
+                receta("s5", ("MedY", "20mg")), # New
+                receta("s5", ("MedZ", "5mg")),  # New
+                receta("s5", ("MedY", "20mg")), # Duplicate of new
             ]
         }
         insert_or_update_patient_data(paciente_data)
@@ -189,19 +199,12 @@ class TestBigQueryService(unittest.TestCase):
         call_args = mock_client_instance.query.call_args
         actual_query = call_args[0][0]
         self.assertIn("WHEN MATCHED THEN", actual_query)
-        self.assertIn("prescripciones = ARRAY(SELECT DISTINCT x FROM UNNEST(ARRAY_CONCAT(target_table.prescripciones, @prescripciones)) x)", actual_query)
+        self.assertIn(f"prescripciones = {MERGE_PRESCRIPTIONS_SQL}", actual_query)
 
-        job_config = call_args[1]['job_config']
-        params_dict = {p.name: (p.value, p.parameter_type) for p in job_config.query_parameters}
-        
-        presc_param_value = params_dict["prescripciones"][0]
-        expected_presc_data_in_param = [ # The parameter should contain what was passed
-            ("MedY", "20mg", "2023-11-10"),
-            ("MedZ", "5mg", "2023-11-10"),
-            ("MedY", "20mg", "2023-11-10"),
-        ]
-        self.assertEqual(presc_param_value, expected_presc_data_in_param)
-        # The SQL query `ARRAY(SELECT DISTINCT ...)` is responsible for the final de-duplication in BQ.
+        rows = struct_rows(call_args[1]['job_config'])
+        # The parameter should contain what was passed
+        self.assertEqual(rows[0]["prescripciones"], paciente_data["prescripciones"])
+        # The GROUP BY TO_JSON_STRING in the MERGE is responsible for the final de-duplication in BQ.
 
     @patch.dict(os.environ, { # Ensure env vars are set for this test too
         "PROJECT_ID": TEST_PROJECT_ID,
@@ -238,5 +241,244 @@ class TestBigQueryService(unittest.TestCase):
         with self.assertRaisesRegex(Exception, "Error during MERGE operation: Simulated BigQuery API Error"):
             insert_or_update_patient_data(paciente_data)
 
+
+class TestBigQueryBulkUpsert(unittest.TestCase):
+
+    @patch.dict(os.environ, {
+        "PROJECT_ID": TEST_PROJECT_ID,
+        "DATASET_ID": TEST_DATASET_ID,
+        "TABLE_ID": TEST_TABLE_ID,
+    })
+    @patch('bigquery_service.client')
+    def test_upsert_patients_single_merge(self, mock_client):
+        records = [
+            {"paciente_clave": "PN001", "nombre": "John", "prescripciones": [receta("s1", ("MedA", "10mg"))]},
+            {"paciente_clave": "PN002", "nombre": "Jane", "prescripciones": []},
+        ]
+
+        self.assertEqual(upsert_patients(records), 2)
+
+        mock_client.query.assert_called_once()
+        actual_query = mock_client.query.call_args[0][0]
+        self.assertIn(f"MERGE `{FULL_TABLE_ID}` AS target_table", actual_query)
+        self.assertIn("USING (SELECT * FROM UNNEST(@registros)) AS source_table", actual_query)
+        self.assertIn("ON target_table.paciente_clave = source_table.paciente_clave", actual_query)
+        self.assertIn(f"SET nombre = source_table.nombre, prescripciones = {MERGE_PRESCRIPTIONS_SQL}", actual_query)
+        self.assertIn("INSERT (paciente_clave, nombre, prescripciones)", actual_query)
+        self.assertIn("VALUES (source_table.paciente_clave, source_table.nombre, source_table.prescripciones)", actual_query)
+
+        rows = struct_rows(mock_client.query.call_args[1]['job_config'])
+        self.assertEqual([r["paciente_clave"] for r in rows], ["PN001", "PN002"])
+        self.assertEqual(rows[0]["prescripciones"], [receta("s1", ("MedA", "10mg"))])
+        self.assertEqual(rows[1]["prescripciones"], [])
+
+    @patch('bigquery_service.client')
+    def test_upsert_patients_coalesces_same_key(self, mock_client):
+        records = [
+            {"paciente_clave": "PX007", "nombre": "Jane", "prescripciones": [receta("s1", ("MedC", "100mg"))]},
+            {"paciente_clave": "PX007", "nombre": "Jane Smith", "prescripciones": [receta("s2", ("MedD", "5mg"))]},
+        ]
+
+        self.assertEqual(upsert_patients(records), 1)
+
+        mock_client.query.assert_called_once()
+        rows = struct_rows(mock_client.query.call_args[1]['job_config'])
+        self.assertEqual(len(rows), 1)
+        self.assertEqual(rows[0]["nombre"], "Jane Smith")
+        self.assertEqual([p["medicamentos"][0]["nombre"] for p in rows[0]["prescripciones"]], ["MedC", "MedD"])
+
+    @patch('bigquery_service.client')
+    def test_upsert_patients_sends_build_patient_record_prescriptions(self, mock_client):
+        datos = fake_datos("prescripcion-real")
+        record = PIPProcessor(uploader=MagicMock()).build_patient_record(
+            datos, "sesion-1", "gs://bucket/formula.jpg", prompt="Extrae los datos"
+        )
+
+        upsert_patients([record])
+
+        rows = struct_rows(mock_client.query.call_args[1]['job_config'])
+        prescripcion = rows[0]["prescripciones"][0]
+        self.assertEqual(set(prescripcion), set(record["prescripciones"][0]))
+        self.assertEqual(prescripcion["id_session"], "sesion-1")
+        self.assertEqual(prescripcion["url_prescripcion"], "gs://bucket/formula.jpg")
+        self.assertEqual(prescripcion["diagnostico"], datos["diagnostico"])
+        self.assertEqual(prescripcion["IPS"], datos["ips"])
+        self.assertEqual(prescripcion["medicamentos"], datos["medicamentos"])
+        self.assertEqual(prescripcion["version_prompt"], prompt_version("Extrae los datos"))
+
+    @patch.object(bigquery_service, "_nested_fields_checked", False)
+    @patch('bigquery_service.client')
+    def test_six_field_nested_column_is_completed_before_the_first_merge(self, mock_client):
+        six_fields = [f for f in bigquery_service.prescription_schema_fields() if f.name != "version_prompt"]
+        mock_client.get_table.return_value = bigquery.Table(FULL_TABLE_ID, schema=[
+            bigquery.SchemaField("paciente_clave", "STRING"),
+            bigquery.SchemaField("prescripciones", "RECORD", mode="REPEATED", fields=six_fields),
+        ])
+        mock_client.update_table.side_effect = lambda table, fields: table
+        record = {"paciente_clave": "PN001", "prescripciones": [receta("s1", ("MedA", "10mg"))]}
+
+        upsert_patients([record])
+        upsert_patients([record])
+
+        calls = [name for name, _, _ in mock_client.mock_calls if name in ("get_table", "update_table", "query")]
+        self.assertEqual(calls, ["get_table", "update_table", "query", "query"])
+        table = mock_client.update_table.call_args[0][0]
+        column = next(f for f in table.schema if f.name == "prescripciones")
+        # The column now has exactly the fields of the STRUCT the MERGE sends
+        registros = mock_client.query.call_args[1]['job_config'].to_api_repr()["query"]["queryParameters"][0]
+        row_type = {f["name"]: f["type"] for f in registros["parameterType"]["arrayType"]["structTypes"]}
+        sent = [f["name"] for f in row_type["prescripciones"]["arrayType"]["structTypes"]]
+        self.assertEqual([f.name for f in column.fields], sent)
+
+    @patch.object(bigquery_service, "_nested_fields_checked", False)
+    @patch('bigquery_service.client')
+    def test_patient_only_merge_does_not_touch_the_schema(self, mock_client):
+        upsert_patients([{"paciente_clave": "PN001", "nombre": "John"}])
+
+        mock_client.get_table.assert_not_called()
+
+    def test_prescriptions_are_deduplicated_without_distinct(self):
+        # DISTINCT fails on a STRUCT holding the medicamentos ARRAY; grouping by its JSON does not
+        self.assertNotIn("DISTINCT", MERGE_PRESCRIPTIONS_SQL)
+        self.assertIn("GROUP BY TO_JSON_STRING(x) ORDER BY MIN(o)", MERGE_PRESCRIPTIONS_SQL)
+
+    @patch('bigquery_service.client')
+    def test_upsert_patients_splits_batches(self, mock_client):
+        records = [{"paciente_clave": f"P{i}", "edad": i} for i in range(5)]
+
+        upsert_patients(records, batch_size=2)
+
+        self.assertEqual(mock_client.query.call_count, 3)
+
+    @patch('bigquery_service.client')
+    def test_upsert_patients_missing_clave(self, mock_client):
+        with self.assertRaisesRegex(ValueError, "paciente_clave is missing"):
+            upsert_patients([{"nombre": "Missing Clave"}])
+        mock_client.query.assert_not_called()
+
+    @patch('bigquery_service.client')
+    def test_upsert_patients_api_error(self, mock_client):
+        mock_client.query.return_value.result.side_effect = Exception("Simulated BigQuery API Error")
+
+        with self.assertRaisesRegex(Exception, "Error during MERGE operation: Simulated BigQuery API Error"):
+            upsert_patients([{"paciente_clave": "ERR001", "nombre": "Error Prone"}])
+
+
+@patch.dict(os.environ, {
+    "PROJECT_ID": TEST_PROJECT_ID,
+    "DATASET_ID": TEST_DATASET_ID,
+    "TABLE_ID": TEST_TABLE_ID,
+})
+class TestBigQueryNormalizedPrescriptions(unittest.TestCase):
+
+    RECETA = {"id_session": "s1", "url_prescripcion": "gs://b/a.jpg", "categoria_riesgo": None,
+              "diagnostico": "HTA", "IPS": "IPS1", "medicamentos": [{"nombre": "MedA", "dosis": "10mg", "cantidad": "1"}]}
+
+    def test_prescription_id_is_deterministic(self):
+        reordenada = dict(reversed(list(self.RECETA.items())))
+
+        self.assertEqual(bigquery_service.prescription_id("P1", self.RECETA),
+                         bigquery_service.prescription_id("P1", reordenada))
+        self.assertNotEqual(bigquery_service.prescription_id("P1", self.RECETA),
+                            bigquery_service.prescription_id("P2", self.RECETA))
+        self.assertNotEqual(bigquery_service.prescription_id("P1", self.RECETA),
+                            bigquery_service.prescription_id("P1", {**self.RECETA, "id_session": "s2"}))
+
+    @patch('bigquery_service.client')
+    def test_upsert_normalized_keeps_patient_row_small(self, mock_client):
+        mock_client.insert_rows_json.return_value = []
+        records = [{"paciente_clave": "P1", "nombre": "John", "prescripciones": [self.RECETA]}]
+
+        self.assertEqual(bigquery_service.upsert_patients_normalized(records), 1)
+
+        query = mock_client.query.call_args[0][0]
+        self.assertNotIn("prescripciones", query)
+        self.assertIn("INSERT (paciente_clave, nombre)", query)
+        table, rows = mock_client.insert_rows_json.call_args[0]
+        self.assertEqual(table, f"{FULL_TABLE_ID}_prescripciones")
+        self.assertEqual(rows[0]["paciente_clave"], "P1")
+        self.assertEqual(rows[0]["medicamentos"], self.RECETA["medicamentos"])
+        self.assertEqual(mock_client.insert_rows_json.call_args[1]["row_ids"],
+                         [bigquery_service.prescription_id("P1", bigquery_service.project_prescription(self.RECETA))])
+
+    @patch('bigquery_service.client')
+    def test_append_projects_rows_before_insert(self, mock_client):
+        mock_client.insert_rows_json.return_value = []
+        receta = {**self.RECETA, "campo_extra": "x",
+                  "medicamentos": [{"nombre": "Ibuprofeno", "dosis": "400mg", "cantidad": "10", "via": "oral"}]}
+
+        bigquery_service.append_prescriptions([{"paciente_clave": "P1", "prescripciones": [receta]}])
+
+        row = mock_client.insert_rows_json.call_args[0][1][0]
+        projected = bigquery_service.project_prescription(receta)
+        self.assertNotIn("campo_extra", row)
+        self.assertEqual(row["medicamentos"], projected["medicamentos"])
+        self.assertEqual(row["prescription_id"], bigquery_service.prescription_id("P1", projected))
+        self.assertEqual(mock_client.insert_rows_json.call_args[1]["row_ids"], [row["prescription_id"]])
+
+    @patch('bigquery_service.client')
+    def test_append_errors_are_raised(self, mock_client):
+        mock_client.insert_rows_json.return_value = [{"index": 0, "errors": [{"reason": "invalid"}]}]
+
+        with self.assertRaisesRegex(Exception, "Error inserting prescriptions"):
+            bigquery_service.append_prescriptions([{"paciente_clave": "P1", "prescripciones": [self.RECETA]}])
+
+    @patch('bigquery_service.client')
+    def test_table_is_partitioned_and_clustered(self, mock_client):
+        bigquery_service.ensure_prescriptions_table()
+
+        table = mock_client.create_table.call_args[0][0]
+        self.assertEqual(table.time_partitioning.field, "ingestado_en")
+        self.assertEqual(table.clustering_fields, ["paciente_clave"])
+        self.assertTrue(mock_client.create_table.call_args[1]["exists_ok"])
+
+    def test_view_rebuilds_nested_shape(self):
+        query = bigquery_service.patients_view_query()
+
+        self.assertIn("PARTITION BY prescription_id", query)
+        self.assertIn(f"FROM `{FULL_TABLE_ID}` AS p", query)
+        self.assertIn("ARRAY_CONCAT(", query)
+        self.assertIn(") AS prescripciones", query)
+
+    def test_view_builds_both_sides_with_the_shared_struct(self):
+        struct_type = bigquery_service.prescription_sql_type()
+        query = bigquery_service.patients_view_query()
+
+        self.assertEqual(struct_type, (
+            "STRUCT<id_session STRING, url_prescripcion STRING, categoria_riesgo STRING, diagnostico STRING, "
+            "IPS STRING, medicamentos ARRAY<STRUCT<nombre STRING, dosis STRING, cantidad STRING>>, "
+            "version_prompt STRING>"
+        ))
+        columns = ", ".join(bigquery_service.PRESCRIPTION_COLUMNS)
+        self.assertIn(f"ARRAY_AGG({struct_type}({columns}) ORDER BY ingestado_en)", query)
+        nested = ", ".join(f"x.{column}" for column in bigquery_service.PRESCRIPTION_COLUMNS)
+        self.assertIn(f"ARRAY(SELECT {struct_type}({nested}) FROM UNNEST(p.prescripciones) AS x", query)
+        # The normalized table has the same fields as the STRUCT
+        table_fields = [f.name for f in bigquery_service.prescription_schema_fields()]
+        self.assertEqual(table_fields, list(bigquery_service.PRESCRIPTION_COLUMNS))
+
+    @patch('bigquery_service.client')
+    def test_nested_column_gets_missing_prescription_fields(self, mock_client):
+        legacy = [bigquery.SchemaField(column, "STRING") for column in ("id_session", "url_prescripcion")]
+        mock_client.get_table.return_value = bigquery.Table(FULL_TABLE_ID, schema=[
+            bigquery.SchemaField("paciente_clave", "STRING"),
+            bigquery.SchemaField("prescripciones", "RECORD", mode="REPEATED", fields=legacy),
+        ])
+
+        bigquery_service.create_patients_view()
+
+        table = mock_client.update_table.call_args[0][0]
+        prescripciones = table.schema[1]
+        self.assertEqual([f.name for f in prescripciones.fields], list(bigquery_service.PRESCRIPTION_COLUMNS))
+        self.assertEqual(prescripciones.mode, "REPEATED")
+        self.assertIn("CREATE OR REPLACE VIEW", mock_client.query.call_args[0][0])
+
+    def test_write_mode_switch(self):
+        self.assertIs(bigquery_service.get_patient_store("anidado"), bigquery_service)
+        self.assertIsInstance(bigquery_service.get_patient_store("normalizado"), bigquery_service.NormalizedPatientStore)
+        with self.assertRaises(ValueError):
+            bigquery_service.get_patient_store("otro")
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,148 @@
+import os
+import hashlib
+import tempfile
+import unittest
+from unittest.mock import patch
+
+from google.api_core.exceptions import NotFound, PreconditionFailed
+
+from cloud_storage_service import GCSUploader
+from offline_fakes import FilesystemBucket
+
+
+class TestGCSUploader(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmpdir.cleanup)
+        self.image_path = os.path.join(self.tmpdir.name, "Formula Monica.jpeg")
+        with open(self.image_path, "wb") as f:
+            f.write(b"\xff\xd8\xff" + b"formula" * 100)
+        with open(self.image_path, "rb") as f:
+            self.digest = hashlib.sha256(f.read()).hexdigest()
+
+        patcher = patch("cloud_storage_service.storage.Client")
+        self.MockClient = patcher.start()
+        self.addCleanup(patcher.stop)
+        self.bucket = self.MockClient.return_value.bucket.return_value
+        self.blob = self.bucket.blob.return_value
+        self.uploader = GCSUploader("bucket-test", credentials_path="")
+
+    def test_content_addressed_upload(self):
+        self.blob.exists.return_value = False
+
+        result = self.uploader.upload(self.image_path)
+
+        self.assertTrue(result.created)
+        self.assertEqual(result.blob_name, f"prescripciones/{self.digest}.jpg")
+        self.assertEqual(result.uri, f"gs://bucket-test/prescripciones/{self.digest}.jpg")
+        self.blob.upload_from_filename.assert_called_once_with(
+            self.image_path, content_type="image/jpeg", if_generation_match=0
+        )
+
+    def test_skips_existing_blob(self):
+        self.blob.exists.return_value = True
+
+        result = self.uploader.upload(self.image_path)
+
+        self.assertFalse(result.created)
+        self.blob.upload_from_filename.assert_not_called()
+        # Nothing can discard the blob, so the reuse costs no patch
+        self.blob.patch.assert_not_called()
+
+    def test_reused_blob_is_marked_and_reuploaded_if_deleted_meanwhile(self):
+        self.blob.exists.side_effect = [False, True, True]
+        self.blob.metadata = {"origen": "chat"}
+        self.blob.patch.side_effect = [None, NotFound("borrado")]
+        self.uploader.upload(self.image_path, speculative=True)
+
+        self.assertFalse(self.uploader.upload(self.image_path).created)
+        self.assertEqual(self.blob.metadata, {"origen": "chat", "reutilizado": "1"})
+        self.assertTrue(self.uploader.upload(self.image_path).created)
+        self.assertEqual(self.blob.upload_from_filename.call_count, 2)
+
+    def test_settled_upload_is_no_longer_marked(self):
+        self.blob.exists.side_effect = [False, True]
+        result = self.uploader.upload(self.image_path, speculative=True)
+
+        self.uploader.settle(result)
+
+        self.assertFalse(self.uploader.upload(self.image_path).created)
+        self.blob.patch.assert_not_called()
+
+    def test_concurrent_duplicate_is_not_created(self):
+        self.blob.exists.return_value = False
+        self.blob.upload_from_filename.side_effect = PreconditionFailed("exists")
+
+        self.assertFalse(self.uploader.upload(self.image_path).created)
+
+    def test_client_is_reused(self):
+        self.blob.exists.return_value = True
+
+        self.uploader.upload(self.image_path)
+        self.uploader.upload(self.image_path, data=b"otra imagen", content_type="image/png")
+
+        self.MockClient.assert_called_once()
+        self.assertTrue(self.bucket.blob.call_args.args[0].endswith(".png"))
+
+    def test_large_files_use_chunked_upload(self):
+        self.blob.exists.return_value = False
+        uploader = GCSUploader("bucket-test", credentials_path="", chunk_size=300 * 1024, resumable_threshold=100)
+
+        uploader.upload(self.image_path)
+
+        self.assertEqual(self.bucket.blob.call_args.kwargs["chunk_size"], 256 * 1024)
+
+    def test_upload_many_keeps_order_and_errors(self):
+        self.blob.exists.return_value = False
+        missing = os.path.join(self.tmpdir.name, "no-existe.jpg")
+
+        results = self.uploader.upload_many([self.image_path, missing, self.image_path], max_workers=3)
+
+        self.assertTrue(results[0].created)
+        self.assertIsInstance(results[1], FileNotFoundError)
+        self.assertEqual(results[2].uri, results[0].uri)
+
+    def test_discard_moves_created_blob_to_quarantine(self):
+        self.blob.exists.return_value = False
+        result = self.uploader.upload(self.image_path)
+
+        moved = self.uploader.discard(result, "cuarentena")
+
+        self.assertEqual(moved, f"gs://bucket-test/cuarentena/{self.digest}.jpg")
+        self.bucket.copy_blob.assert_called_once_with(self.blob, self.bucket, f"cuarentena/{self.digest}.jpg")
+        self.blob.delete.assert_called_once()
+
+    def test_discard_keeps_deduplicated_blob(self):
+        self.blob.exists.return_value = True
+        result = self.uploader.upload(self.image_path)
+
+        self.assertIsNone(self.uploader.discard(result, "cuarentena"))
+        self.blob.delete.assert_not_called()
+
+    def test_discard_keeps_blob_reused_after_creation(self):
+        bucket = FilesystemBucket(os.path.join(self.tmpdir.name, "bucket"))
+        uploader = GCSUploader("bucket-local", bucket=bucket)
+        rejected = uploader.upload(self.image_path, speculative=True)
+        # A concurrent send of the same image shares the blob
+        kept = uploader.upload(self.image_path)
+
+        self.assertIsNone(uploader.discard(rejected, "cuarentena"))
+
+        self.assertEqual((rejected.created, kept.created, kept.uri), (True, False, rejected.uri))
+        self.assertTrue(os.path.exists(os.path.join(bucket.root, rejected.blob_name)))
+        self.assertFalse(os.path.exists(os.path.join(bucket.root, "cuarentena", os.path.basename(rejected.blob_name))))
+
+    def test_discard_removes_unshared_blob(self):
+        bucket = FilesystemBucket(os.path.join(self.tmpdir.name, "bucket"))
+        uploader = GCSUploader("bucket-local", bucket=bucket)
+        result = uploader.upload(self.image_path, speculative=True)
+
+        moved = uploader.discard(result, "cuarentena")
+
+        self.assertEqual(moved, f"gs://bucket-local/cuarentena/{self.digest}.jpg")
+        self.assertFalse(os.path.exists(os.path.join(bucket.root, result.blob_name)))
+
+
+if __name__ == '__main__':
+    unittest.main()
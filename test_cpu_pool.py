@@ -0,0 +1,102 @@
+import os
+import json
+import tempfile
+import threading
+import unittest
+from unittest.mock import patch
+
+from cloud_storage_service import GCSUploader
+from cpu_pool import ByteBudget, CPUPool, _attach
+from offline_fakes import FakeOpenAIServer, FilesystemBucket, SQLitePatientStore
+from openai_client import OpenAIClient, reset_client, set_client
+from openai_service import build_request
+from pip_processor import PIPProcessor
+
+
+class TestByteBudget(unittest.TestCase):
+
+    def test_acquire_waits_for_release(self):
+        budget = ByteBudget(100)
+        budget.acquire(80)
+        acquired = threading.Event()
+        waiter = threading.Thread(target=lambda: (budget.acquire(50), acquired.set()))
+        waiter.start()
+
+        self.assertFalse(acquired.wait(0.1))
+        budget.release(80)
+        self.assertTrue(acquired.wait(1))
+        waiter.join()
+        self.assertEqual((budget.in_use, budget.peak), (50, 80))
+
+    def test_oversized_reservation_runs_alone(self):
+        budget = ByteBudget(100)
+        budget.acquire(500)
+        budget.resize(500, 300)
+        self.assertEqual(budget.in_use, 300)
+
+
+class TestCPUPool(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.pool = CPUPool(workers=2, max_bytes=20 * 1024)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.pool.close()
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmpdir.cleanup)
+
+    def _images(self, count, size=3000):
+        paths = []
+        for i in range(count):
+            path = os.path.join(self.tmpdir.name, f"formula_{i}.jpg")
+            with open(path, "wb") as f:
+                f.write(b"\xff\xd8\xff\xe0" + str(i).encode() * size)
+            paths.append(path)
+        return paths
+
+    def test_body_matches_build_request(self):
+        path = self._images(1)[0]
+        with open(path, "rb") as f:
+            expected = json.dumps(build_request("prompt ñ", f.read())).encode("utf-8")
+
+        encoded = self.pool.encode(path, "prompt ñ")
+        name = encoded._block.name
+        with encoded:
+            self.assertEqual(bytes(encoded.body), expected)
+            self.assertIsNone(encoded.image())
+
+        self.assertEqual(self.pool.budget.in_use, 0)
+        with self.assertRaises(FileNotFoundError):
+            _attach(name)
+
+    def test_process_batch_through_the_pool(self):
+        server = FakeOpenAIServer().start()
+        self.addCleanup(server.stop)
+        set_client(OpenAIClient(api_key="local", api_url=server.url))
+        self.addCleanup(reset_client)
+        store = SQLitePatientStore()
+        processor = PIPProcessor(
+            uploader=GCSUploader("bucket-local", bucket=FilesystemBucket(os.path.join(self.tmpdir.name, "bucket"))),
+            patient_store=store,
+            cpu_pool=self.pool,
+        )
+        processor.cache = None
+
+        with patch.object(PIPProcessor, "read_prompt", return_value="prompt"):
+            batch = processor.process_batch(self._images(8, size=6000), "sesion-cpu", extract_workers=4)
+
+        self.assertEqual(batch["resumen"]["exitosas"], 8)
+        self.assertEqual(store.count(), 8)
+        self.assertEqual(server.requests, 8)
+        cpu = batch["resumen"]["cpu"]
+        self.assertEqual(cpu["bytes_en_vuelo"], 0)
+        # Each request reserves ~12 KB, so the budget lets fewer than the 4 threads encode at once
+        self.assertLessEqual(cpu["pico_bytes"], 20 * 1024)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,73 @@
+import os
+import tempfile
+import unittest
+from unittest.mock import patch
+
+from extraction_cache import ExtractionCache, cache_key, file_sha256
+
+
+class TestExtractionCache(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmpdir.cleanup)
+        self.db_path = os.path.join(self.tmpdir.name, "cache.sqlite3")
+
+    def test_key_depends_on_image_prompt_and_params(self):
+        params = {"model": "gpt-4.1-mini", "max_tokens": 1500, "temperature": 0}
+        base = cache_key("abc", "prompt", params)
+
+        self.assertEqual(base, cache_key("abc", "prompt", dict(reversed(list(params.items())))))
+        self.assertNotEqual(base, cache_key("abd", "prompt", params))
+        self.assertNotEqual(base, cache_key("abc", "prompt v2", params))
+        self.assertNotEqual(base, cache_key("abc", "prompt", {**params, "model": "gpt-4.1"}))
+
+    def test_file_sha256(self):
+        image_path = os.path.join(self.tmpdir.name, "formula.jpg")
+        with open(image_path, "wb") as f:
+            f.write(b"\xff\xd8\xff" + b"x" * 5000)
+
+        self.assertEqual(file_sha256(image_path), file_sha256(image_path, chunk_size=7))
+
+    def test_hit_miss_counters_and_persistence(self):
+        cache = ExtractionCache(self.db_path)
+        self.assertIsNone(cache.get("k1"))
+        cache.put("k1", {"numero_documento": "123", "paciente": "José"})
+        self.assertEqual(cache.get("k1"), {"numero_documento": "123", "paciente": "José"})
+        cache.close()
+
+        reopened = ExtractionCache(self.db_path)
+        self.assertEqual(reopened.get("k1")["paciente"], "José")
+        stats = reopened.stats()
+        self.assertEqual((stats["hits"], stats["misses"], stats["entries"]), (1, 0, 1))
+        reopened.close()
+
+    def test_ttl_expiration(self):
+        cache = ExtractionCache(self.db_path, ttl_seconds=10)
+        with patch("extraction_cache.time.time", return_value=1000.0):
+            cache.put("k1", {"a": 1})
+        with patch("extraction_cache.time.time", return_value=1011.0):
+            self.assertIsNone(cache.get("k1"))
+        self.assertEqual(cache.stats()["entries"], 0)
+        cache.close()
+
+    def test_lru_eviction_by_entries(self):
+        cache = ExtractionCache(self.db_path, max_entries=10)
+        now = 1_000_000.0
+        for i in range(10):
+            with patch("extraction_cache.time.time", return_value=now + i):
+                cache.put(f"k{i}", {"i": i})
+        with patch("extraction_cache.time.time", return_value=now + 100):
+            cache.get("k0")
+            cache.put("k10", {"i": 10})
+            # Over the limit: trimmed to 90% by dropping the least recently used
+            self.assertEqual(cache.stats()["entries"], 9)
+            self.assertIsNotNone(cache.get("k0"))
+            self.assertIsNone(cache.get("k1"))
+            self.assertIsNone(cache.get("k2"))
+            self.assertIsNotNone(cache.get("k10"))
+        cache.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
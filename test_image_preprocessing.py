@@ -0,0 +1,72 @@
+import io
+import unittest
+
+from image_preprocessing import ImagePreprocessor, detect_mime_type
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+
+class TestDetectMimeType(unittest.TestCase):
+
+    def test_known_signatures(self):
+        self.assertEqual(detect_mime_type(b"\xff\xd8\xff\xe0" + b"\0" * 12), "image/jpeg")
+        self.assertEqual(detect_mime_type(b"\x89PNG\r\n\x1a\n" + b"\0" * 8), "image/png")
+        self.assertEqual(detect_mime_type(b"RIFF\x00\x00\x00\x00WEBPVP8 "), "image/webp")
+        self.assertEqual(detect_mime_type(b"\x00\x00\x00\x18ftypheic\x00\x00\x00\x00"), "image/heic")
+        self.assertEqual(detect_mime_type(b"GIF89a" + b"\0" * 10), "image/gif")
+
+    def test_unknown_signature(self):
+        self.assertEqual(detect_mime_type(b"not an image"), "application/octet-stream")
+
+
+@unittest.skipIf(Image is None, "Pillow no está instalado")
+class TestImagePreprocessor(unittest.TestCase):
+
+    def _png(self, size):
+        output = io.BytesIO()
+        Image.new("RGBA", size, (255, 255, 255, 255)).save(output, format="PNG")
+        return output.getvalue()
+
+    def test_downscales_and_reencodes_as_jpeg(self):
+        original = self._png((4000, 3000))
+        result = ImagePreprocessor(max_long_edge=1000, quality=80).process(original)
+
+        self.assertEqual(result.mime_type, "image/jpeg")
+        self.assertEqual(result.bytes_before, len(original))
+        self.assertEqual(result.bytes_after, len(result.data))
+        self.assertEqual(max(Image.open(io.BytesIO(result.data)).size), 1000)
+
+    def test_grayscale(self):
+        result = ImagePreprocessor(max_long_edge=500, grayscale=True).process(self._png((800, 600)))
+
+        self.assertEqual(Image.open(io.BytesIO(result.data)).mode, "L")
+
+    def test_small_png_is_returned_unchanged(self):
+        original = self._png((64, 64))
+
+        result = ImagePreprocessor(max_long_edge=1000).process(original)
+
+        self.assertEqual((result.data, result.mime_type), (original, "image/png"))
+
+    def test_exif_orientation_is_applied(self):
+        exif = Image.Exif()
+        exif[0x0112] = 6  # Rotated 90° clockwise
+        original = io.BytesIO()
+        Image.new("RGB", (40, 20), (255, 255, 255)).save(original, format="JPEG", exif=exif)
+
+        result = ImagePreprocessor(max_long_edge=1000).process(original.getvalue())
+
+        self.assertEqual(Image.open(io.BytesIO(result.data)).size, (20, 40))
+
+    def test_undecodable_bytes_pass_through(self):
+        result = ImagePreprocessor().process(b"\xff\xd8\xffcorrupto")
+
+        self.assertEqual(result.data, b"\xff\xd8\xffcorrupto")
+        self.assertEqual(result.mime_type, "image/jpeg")
+
+
+if __name__ == '__main__':
+    unittest.main()
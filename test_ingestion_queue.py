@@ -0,0 +1,154 @@
+import os
+import json
+import time
+import tempfile
+import unittest
+from unittest.mock import MagicMock, patch
+
+from cloud_storage_service import UploadResult
+from ingestion_queue import IngestionQueue, IngestionWorkerPool, QueueFull
+from pip_processor import PIPProcessor
+from prompt_registry import prompt_version
+
+
+def _respuesta_modelo(numero_documento):
+    return json.dumps({
+        "datos": {"tipo_documento": "CC", "numero_documento": numero_documento, "paciente": "Paciente"}
+    })
+
+
+class TestIngestionQueue(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmpdir.cleanup)
+        self.queue = IngestionQueue(os.path.join(self.tmpdir.name, "cola.sqlite3"), max_depth=2, retry_base=0)
+        self.addCleanup(self.queue.close)
+
+    def _image(self, name, content):
+        path = os.path.join(self.tmpdir.name, name)
+        with open(path, "wb") as f:
+            f.write(content)
+        return path
+
+    def test_enqueue_is_idempotent_and_bounded(self):
+        first = self.queue.enqueue(self._image("a.jpg", b"a"), "s1")
+
+        self.assertEqual(self.queue.enqueue(self._image("a-copia.jpg", b"a"), "s1"), first)
+        self.assertNotEqual(self.queue.enqueue(self._image("a.jpg", b"a"), "s2"), first)
+        with self.assertRaises(QueueFull):
+            self.queue.enqueue(self._image("b.jpg", b"b"), "s1")
+        self.assertEqual(self.queue.depth(), 2)
+
+    def test_expired_lease_is_reclaimed_and_old_owner_is_fenced(self):
+        self.queue.visibility_timeout = 0.01
+        key = self.queue.enqueue(self._image("a.jpg", b"a"), "s1")
+
+        stale = self.queue.claim()
+        with patch("ingestion_queue.time.time", return_value=time.time() + 1):
+            fresh = self.queue.claim()
+
+        self.assertEqual((fresh.key, fresh.attempts), (key, 2))
+        self.assertFalse(self.queue.checkpoint(stale, "extraido", data={"x": 1}))
+        self.assertTrue(self.queue.checkpoint(fresh, "extraido", data={"x": 2}))
+        self.assertEqual(self.queue.get(key)["datos"], {"x": 2})
+
+    def test_dead_letter_after_max_attempts_and_requeue(self):
+        self.queue.max_attempts = 2
+        key = self.queue.enqueue(self._image("a.jpg", b"a"), "s1")
+
+        self.queue.fail(self.queue.claim(), "503", retryable=True)
+        self.queue.fail(self.queue.claim(), "503", retryable=True)
+
+        self.assertIsNone(self.queue.claim())
+        self.assertEqual(self.queue.get(key)["estado"], "fallido")
+        self.assertEqual(self.queue.dead_letters()[0]["error"], "503")
+        self.assertTrue(self.queue.requeue(key))
+        self.assertEqual(self.queue.claim().key, key)
+
+
+class TestIngestionWorkerPool(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmpdir.cleanup)
+        patcher = patch.object(PIPProcessor, "read_prompt", return_value="prompt")
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.queue = IngestionQueue(os.path.join(self.tmpdir.name, "cola.sqlite3"), retry_base=0)
+        self.addCleanup(self.queue.close)
+        self.uploader = MagicMock()
+        self.uploader.upload.side_effect = lambda path, **kwargs: UploadResult(f"gs://b/{os.path.basename(path)}", "x", True, 1)
+        self.store = MagicMock()
+        self.processor = PIPProcessor(uploader=self.uploader, patient_store=self.store)
+        self.processor.cache = None
+        self.pool = IngestionWorkerPool(self.queue, self.processor, workers=1, poll_interval=0.01)
+
+    def _image(self, name):
+        path = os.path.join(self.tmpdir.name, name)
+        with open(path, "wb") as f:
+            f.write(name.encode())
+        return path
+
+    @patch("pip_processor.extract_data_from_prescription")
+    def test_retry_resumes_after_last_checkpoint(self, mock_extract):
+        mock_extract.return_value = _respuesta_modelo("123")
+        self.uploader.upload.side_effect = [RuntimeError("503"), UploadResult("gs://b/a.jpg", "a", True, 1)]
+        key = self.queue.enqueue(self._image("a.jpg"), "s1")
+
+        self.pool.process_job(self.queue.claim())
+        self.assertEqual(self.queue.get(key)["etapa"], "extraido")
+        self.pool.process_job(self.queue.claim())
+
+        job = self.queue.get(key)
+        self.assertEqual((job["estado"], job["intentos"], job["url"]), ("completado", 2, "gs://b/a.jpg"))
+        mock_extract.assert_called_once()
+        self.store.insert_or_update_patient_data.assert_called_once()
+
+    @patch("pip_processor.extract_data_from_prescription")
+    def test_resumed_job_keeps_prompt_version_and_cache_key(self, mock_extract):
+        mock_extract.return_value = _respuesta_modelo("123")
+        self.uploader.upload.side_effect = [RuntimeError("503"), UploadResult("gs://b/a.jpg", "a", True, 1)]
+        self.processor.cache = MagicMock()
+        self.processor.cache.get.return_value = None
+        image = self._image("a.jpg")
+        key = self.queue.enqueue(image, "s1")
+        cache_key, _ = self.processor.cache_lookup(image, "prompt")
+
+        self.pool.process_job(self.queue.claim())
+        # The prompt is hot-reloaded before the retry
+        with patch.object(PIPProcessor, "read_prompt", return_value="prompt v2"):
+            self.pool.process_job(self.queue.claim())
+
+        self.assertEqual(self.queue.get(key)["estado"], "completado")
+        (record,), _ = self.store.insert_or_update_patient_data.call_args
+        self.assertEqual(record["prescripciones"][0]["version_prompt"], prompt_version("prompt"))
+        self.processor.cache.put.assert_called_once_with(cache_key, json.loads(_respuesta_modelo("123"))["datos"])
+
+    @patch("pip_processor.extract_data_from_prescription")
+    def test_rejected_image_goes_straight_to_dead_letter(self, mock_extract):
+        mock_extract.return_value = "Por favor, envía una foto de una fórmula médica válida y legible para poder procesarla correctamente."
+        key = self.queue.enqueue(self._image("selfie.jpg"), "s1")
+
+        self.pool.process_job(self.queue.claim())
+
+        self.assertEqual(self.queue.get(key)["estado"], "fallido")
+        self.assertEqual(self.queue.get(key)["intentos"], 1)
+        self.uploader.upload.assert_not_called()
+
+    @patch("pip_processor.extract_data_from_prescription")
+    def test_workers_drain_the_queue(self, mock_extract):
+        mock_extract.side_effect = lambda path, prompt: _respuesta_modelo(os.path.basename(path)[0])
+        keys = [self.queue.enqueue(self._image(f"{i}.jpg"), "s1") for i in range(6)]
+
+        self.pool.workers = 3
+        self.pool.start()
+        self.assertTrue(self.pool.drain(timeout=10))
+        self.pool.stop()
+
+        self.assertEqual(self.queue.stats()["completado"], 6)
+        self.assertEqual(sorted(self.queue.get(k)["datos"]["numero_documento"] for k in keys), [str(i) for i in range(6)])
+
+
+if __name__ == '__main__':
+    unittest.main()
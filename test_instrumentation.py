@@ -0,0 +1,116 @@
+import os
+import json
+import tempfile
+import unittest
+from unittest.mock import patch
+
+from instrumentation import JsonLinesExporter, PrometheusTextfileExporter, StageMetrics, Tracer, annotate
+from offline_fakes import FakeOpenAIServer, FaultInjector, FilesystemBucket, SQLitePatientStore
+from cloud_storage_service import GCSUploader
+from openai_client import OpenAIClient, reset_client, set_client
+from pip_processor import PIPProcessor
+
+
+class TestTracer(unittest.TestCase):
+
+    def test_nested_spans_outcome_and_annotations(self):
+        spans = []
+        tracer = Tracer([spans.append])
+
+        with tracer.span("extraccion"):
+            with tracer.span("openai"):
+                annotate(prompt_tokens=10, completion_tokens=5)
+        with self.assertRaises(ValueError):
+            with tracer.span("parseo"):
+                raise ValueError("json")
+        annotate(retries=3)  # no active span: ignored
+
+        self.assertEqual([s.stage for s in spans], ["openai", "extraccion", "parseo"])
+        self.assertEqual(spans[0].parent, "extraccion")
+        self.assertEqual(spans[0].attributes, {"prompt_tokens": 10, "completion_tokens": 5})
+        self.assertEqual([s.outcome for s in spans], ["ok", "ok", "error"])
+
+    def test_failing_hook_does_not_break_the_stage(self):
+        def hook(span):
+            raise RuntimeError("disco lleno")
+
+        with Tracer([hook]).span("subida") as span:
+            pass
+        self.assertEqual(span.outcome, "ok")
+
+
+class TestExporters(unittest.TestCase):
+
+    def test_histogram_and_prometheus_text(self):
+        metrics = StageMetrics(buckets=(0.1, 1.0))
+        tracer = Tracer([metrics])
+        with patch("instrumentation.time.perf_counter", side_effect=[0.0, 0.05, 0.0, 0.5]):
+            with tracer.span("subida", bytes=100):
+                pass
+            with tracer.span("subida", bytes=50):
+                pass
+
+        stage = metrics.snapshot()["subida"]
+        self.assertEqual(stage["buckets"], [1, 2])
+        self.assertEqual(stage["count"], 2)
+        self.assertEqual(stage["totals"]["bytes"], 150)
+        text = metrics.prometheus_text()
+        self.assertIn('pip_stage_duration_seconds_bucket{stage="subida",le="0.1"} 1', text)
+        self.assertIn('pip_stage_duration_seconds_bucket{stage="subida",le="+Inf"} 2', text)
+        self.assertIn('pip_stage_bytes_total{stage="subida"} 150', text)
+
+    def test_file_exporters(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            jsonl = JsonLinesExporter(os.path.join(tmpdir, "trazas.jsonl"))
+            prom = PrometheusTextfileExporter(os.path.join(tmpdir, "pip.prom"))
+            tracer = Tracer([jsonl, prom])
+
+            with tracer.span("persistencia", registros=3):
+                pass
+            tracer.flush()
+            jsonl.close()
+
+            with open(jsonl.path, encoding="utf-8") as f:
+                line = json.loads(f.readline())
+            self.assertEqual((line["stage"], line["registros"], line["outcome"]), ("persistencia", 3, "ok"))
+            with open(prom.path, encoding="utf-8") as f:
+                self.assertIn('pip_stage_total{stage="persistencia",outcome="ok"} 1', f.read())
+
+
+class TestPipelineInstrumentation(unittest.TestCase):
+
+    def test_batch_reports_tokens_retries_and_bytes(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            image_paths = []
+            for i in range(4):
+                image_paths.append(os.path.join(tmpdir, f"formula_{i}.jpg"))
+                with open(image_paths[-1], "wb") as f:
+                    f.write(b"\xff\xd8\xff\xe0" + bytes([i]) * 64)
+
+            with FakeOpenAIServer(FaultInjector(rate_limit_rate=0.5, seed=3)) as server, \
+                    patch.object(PIPProcessor, "read_prompt", return_value="prompt"):
+                set_client(OpenAIClient(api_key="local", api_url=server.url, backoff_base=0.01, backoff_max=0.05))
+                self.addCleanup(reset_client)
+                metrics = StageMetrics()
+                processor = PIPProcessor(
+                    uploader=GCSUploader("bucket-local", bucket=FilesystemBucket(os.path.join(tmpdir, "bucket"))),
+                    patient_store=SQLitePatientStore(),
+                    tracer=Tracer([metrics]),
+                )
+                processor.cache = None
+
+                batch = processor.process_batch(image_paths, "sesion-metricas")
+
+            self.assertEqual(batch["resumen"]["exitosas"], 4)
+            stages = metrics.snapshot()
+            self.assertEqual(stages["openai"]["count"], 4)
+            self.assertGreater(stages["openai"]["totals"]["prompt_tokens"], 0)
+            self.assertGreater(stages["openai"]["totals"]["completion_tokens"], 0)
+            self.assertEqual(stages["openai"]["totals"]["retries"], server.requests - 4)
+            self.assertEqual(stages["subida"]["totals"]["bytes"], 4 * 68)
+            self.assertEqual(stages["parseo"]["outcomes"], {"ok": 4})
+            self.assertEqual(sum(stages["persistencia"]["outcomes"].values()), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,119 @@
+import os
+import tempfile
+import unittest
+from unittest.mock import patch
+
+from bigquery_service import PRESCRIPTION_COLUMNS, project_prescription
+from offline_fakes import FakeOpenAIServer, FaultInjector, FilesystemBucket, SQLitePatientStore
+from cloud_storage_service import GCSUploader
+from openai_client import OpenAIClient, reset_client, set_client
+from pip_processor import PIPProcessor
+
+
+class TestSQLitePatientStore(unittest.TestCase):
+
+    def test_merge_overwrites_scalars_and_appends_distinct_prescriptions(self):
+        store = SQLitePatientStore()
+        receta_a = {"id_session": "s1", "url_prescripcion": "gs://b/a.jpg", "medicamentos": []}
+        receta_b = {"id_session": "s2", "url_prescripcion": "gs://b/b.jpg", "medicamentos": []}
+
+        store.upsert_patients([{"paciente_clave": "COCC1", "eps": "EPS1", "prescripciones": [receta_a]}])
+        store.insert_or_update_patient_data({"paciente_clave": "COCC1", "eps": "EPS2", "prescripciones": [receta_a, receta_b]})
+
+        paciente = store.get("COCC1")
+        self.assertEqual(paciente["eps"], "EPS2")
+        self.assertEqual(paciente["prescripciones"], [project_prescription(receta_a), project_prescription(receta_b)])
+        self.assertEqual(store.count(), 1)
+        self.assertEqual(store.jobs, 2)
+
+    def test_prescriptions_get_the_merge_projection(self):
+        store = SQLitePatientStore()
+        receta = {"medicamento": "MedA", "dosis": "10mg", "medicamentos": [{"nombre": "MedA", "via": "oral"}]}
+
+        store.upsert_patients([{"paciente_clave": "COCC1", "prescripciones": [receta]}])
+
+        (guardada,) = store.get("COCC1")["prescripciones"]
+        # Fields outside the STRUCT are dropped, exactly as BigQuery would store them
+        self.assertEqual(list(guardada), list(PRESCRIPTION_COLUMNS))
+        self.assertIsNone(guardada["id_session"])
+        self.assertEqual(guardada["medicamentos"], [{"nombre": "MedA", "dosis": None, "cantidad": None}])
+
+    def test_failed_job_rolls_back(self):
+        store = SQLitePatientStore()
+
+        with self.assertRaises(ValueError):
+            store.upsert_patients([{"paciente_clave": "COCC1"}, {"eps": "sin clave"}])
+
+        self.assertEqual(store.count(), 0)
+
+
+class TestOfflinePipeline(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmpdir.cleanup)
+        patcher = patch.object(PIPProcessor, "read_prompt", return_value="prompt")
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        # Roughly a third of the requests get a 429 and succeed on retry
+        self.server = FakeOpenAIServer(FaultInjector(rate_limit_rate=0.3, seed=1)).start()
+        self.addCleanup(self.server.stop)
+        set_client(OpenAIClient(api_key="local", api_url=self.server.url, backoff_base=0.01, backoff_max=0.05))
+        self.addCleanup(reset_client)
+
+        self.bucket = FilesystemBucket(os.path.join(self.tmpdir.name, "bucket"))
+        self.store = SQLitePatientStore()
+        self.processor = PIPProcessor(
+            uploader=GCSUploader("bucket-local", bucket=self.bucket),
+            patient_store=self.store,
+            speculative_upload=False,
+        )
+        self.processor.cache = None
+
+    def _images(self, count):
+        paths = []
+        for i in range(count):
+            path = os.path.join(self.tmpdir.name, f"formula_{i}.jpg")
+            with open(path, "wb") as f:
+                f.write(b"\xff\xd8\xff\xe0" + str(i).encode() * 100)
+            paths.append(path)
+        return paths
+
+    def test_process_batch_against_local_fakes(self):
+        batch = self.processor.process_batch(self._images(12), "sesion-local", persist_batch_size=5)
+
+        self.assertEqual(batch["resumen"]["exitosas"], 12)
+        self.assertEqual(self.store.count(), 12)
+        self.assertEqual(self.bucket.uploads, 12)
+        self.assertLessEqual(self.store.jobs, 4)
+        paciente = self.store.get("COCC" + batch["resultados"][0]["numero_documento"])
+        self.assertTrue(paciente["prescripciones"][0]["url_prescripcion"].startswith("gs://bucket-local/prescripciones/"))
+
+    def test_same_image_twice_is_uploaded_once(self):
+        image = self._images(1)[0]
+
+        batch = self.processor.process_batch([image, image], "sesion-local")
+
+        self.assertEqual(batch["resumen"]["exitosas"], 2)
+        self.assertEqual(self.bucket.uploads, 1)
+        self.assertEqual(self.store.count(), 1)
+
+    @patch.dict(os.environ, {"OPENAI_JSON_SCHEMA": "1"})
+    def test_streaming_starts_upload_early_and_skips_rejected_images(self):
+        self.processor.streaming = True
+        self.server.reject_marker = "data:image/png"
+        rejected = os.path.join(self.tmpdir.name, "selfie.png")
+        with open(rejected, "wb") as f:
+            f.write(b"\x89PNG\r\n\x1a\n" + b"0" * 100)
+
+        data = self.processor.process_image(self._images(1)[0], "sesion-local")
+        message = self.processor.process_image(rejected, "sesion-local")
+
+        self.assertEqual(self.store.get(f"COCC{data['numero_documento']}")["nombre_paciente"], data["paciente"])
+        self.assertIn("fórmula médica válida", message)
+        self.assertEqual(self.bucket.uploads, 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,97 @@
+import unittest
+from unittest.mock import MagicMock, patch
+
+import requests
+
+from openai_client import AsyncOpenAIClient, OpenAIClient, TokenBucket, retry_after_seconds
+
+
+def _response(status_code, headers=None):
+    response = MagicMock()
+    response.status_code = status_code
+    response.headers = headers or {}
+    return response
+
+
+class TestTokenBucket(unittest.TestCase):
+
+    @patch("openai_client.time.sleep")
+    @patch("openai_client.time.monotonic")
+    def test_waits_when_empty(self, mock_monotonic, mock_sleep):
+        clock = [100.0]
+        mock_monotonic.side_effect = lambda: clock[0]
+        mock_sleep.side_effect = lambda seconds: clock.__setitem__(0, clock[0] + seconds)
+
+        bucket = TokenBucket(rate_per_minute=60, capacity=2)
+        self.assertEqual(bucket.acquire(), 0.0)
+        self.assertEqual(bucket.acquire(), 0.0)
+        self.assertAlmostEqual(bucket.acquire(), 1.0)
+
+
+    def test_sync_and_async_clients_share_the_process_limiters(self):
+        sync_client = OpenAIClient(api_key="sk-limites", api_url="http://localhost/limites", requests_per_minute=60)
+        async_client = AsyncOpenAIClient(api_key="sk-limites", api_url="http://localhost/limites", requests_per_minute=60)
+        other = OpenAIClient(api_key="sk-otra", api_url="http://localhost/limites", requests_per_minute=60)
+
+        self.assertIs(sync_client.request_limiter, async_client.request_limiter)
+        self.assertIs(sync_client.token_limiter, async_client.token_limiter)
+        self.assertIsNot(sync_client.request_limiter, other.request_limiter)
+        sync_client.request_limiter.try_acquire(60)
+        self.assertGreater(async_client.request_limiter.try_acquire(), 0)
+
+
+class TestRetryAfter(unittest.TestCase):
+
+    def test_seconds_and_milliseconds(self):
+        self.assertEqual(retry_after_seconds(_response(429, {"Retry-After": "3"})), 3.0)
+        self.assertEqual(retry_after_seconds(_response(429, {"retry-after-ms": "250"})), 0.25)
+        self.assertIsNone(retry_after_seconds(_response(429)))
+
+
+class TestOpenAIClient(unittest.TestCase):
+
+    def setUp(self):
+        self.client = OpenAIClient(api_key="sk-test", api_url="http://localhost/v1/chat/completions",
+                                   requests_per_minute=6000, tokens_per_minute=10 ** 9, max_retries=3)
+        self.client.session = MagicMock()
+
+    @patch("openai_client.time.sleep")
+    def test_retries_429_honouring_retry_after(self, mock_sleep):
+        ok = _response(200)
+        self.client.session.post.side_effect = [_response(429, {"Retry-After": "2"}), _response(503), ok]
+
+        self.assertIs(self.client.post_json({"model": "m"}), ok)
+
+        self.assertEqual(self.client.session.post.call_count, 3)
+        self.assertEqual(mock_sleep.call_args_list[0].args[0], 2.0)
+        stats = self.client.stats()
+        self.assertEqual((stats["retries"], stats["rate_limited"], stats["server_errors"]), (2, 1, 1))
+        _, kwargs = self.client.session.post.call_args
+        self.assertEqual(kwargs["timeout"], self.client.timeout)
+
+    @patch("openai_client.time.sleep")
+    def test_returns_last_response_after_max_retries(self, mock_sleep):
+        self.client.session.post.return_value = _response(429)
+
+        self.assertEqual(self.client.post_json({}).status_code, 429)
+        self.assertEqual(self.client.session.post.call_count, 4)
+
+    @patch("openai_client.time.sleep")
+    def test_does_not_retry_client_errors(self, mock_sleep):
+        self.client.session.post.return_value = _response(400)
+
+        self.assertEqual(self.client.post_json({}).status_code, 400)
+        self.client.session.post.assert_called_once()
+        mock_sleep.assert_not_called()
+
+    @patch("openai_client.time.sleep")
+    def test_raises_after_connection_errors(self, mock_sleep):
+        self.client.session.post.side_effect = requests.ConnectionError("reset")
+
+        with self.assertRaises(requests.ConnectionError):
+            self.client.post_json({})
+        self.assertEqual(self.client.stats()["connection_errors"], 4)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,105 @@
+import os
+import json
+import tempfile
+import unittest
+from unittest.mock import patch
+
+import requests
+
+from offline_fakes import FakeOpenAIServer
+from openai_client import OpenAIClient, estimate_tokens, reset_client, set_client
+from openai_service import (
+    REJECTION_MESSAGE,
+    ExtractionStream,
+    build_request,
+    extract_data_from_prescriptions,
+    parse_model_json,
+    stream_data_from_prescription,
+)
+
+
+class TestParseModelJson(unittest.TestCase):
+
+    def test_tolerates_fences_surrounding_text_and_trailing_commas(self):
+        self.assertEqual(parse_model_json('```json\n{"datos": {"a": 1}}\n```'), {"datos": {"a": 1}})
+        self.assertEqual(parse_model_json('Aquí está: {"datos": {"b": [1, 2,],},} listo'), {"datos": {"b": [1, 2]}})
+        for invalid in ("no es json", "[1, 2]", '{"datos": '):
+            with self.assertRaises(ValueError):
+                parse_model_json(invalid)
+
+
+class TestExtractionStream(unittest.TestCase):
+
+    def test_rejection_is_detected_as_soon_as_it_appears(self):
+        stream = ExtractionStream()
+        self.assertIsNone(stream.feed("Por favor, envía una foto de una fórmula "))
+        self.assertEqual(stream.feed("médica válida y"), REJECTION_MESSAGE)
+        self.assertEqual(ExtractionStream().feed('{"rechazada": true, "da'), REJECTION_MESSAGE)
+
+    def test_identity_is_validated_incrementally(self):
+        identified = []
+        stream = ExtractionStream(lambda: identified.append(True))
+
+        for delta in ('{"rechazada": false, "datos": {"tipo_documento": "CC"', ', "numero_documento": "12', '3", "pac', 'iente": "A"}}'):
+            self.assertIsNone(stream.feed(delta))
+        self.assertEqual(identified, [True])
+
+        early = ExtractionStream().feed('{"datos": {"tipo_documento": "CC", "numero_documento": null,')
+        self.assertEqual(json.loads(early), {"datos": {"tipo_documento": "CC", "numero_documento": None}})
+
+
+@patch.dict(os.environ, {"OPENAI_JSON_SCHEMA": "1"})
+class TestStreamingExtraction(unittest.TestCase):
+
+    def setUp(self):
+        self.server = FakeOpenAIServer(reject_marker="data:image/png").start()
+        self.addCleanup(self.server.stop)
+        set_client(OpenAIClient(api_key="local", api_url=self.server.url))
+        self.addCleanup(reset_client)
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmpdir.cleanup)
+
+    def _image(self, content):
+        path = os.path.join(self.tmpdir.name, "imagen")
+        with open(path, "wb") as f:
+            f.write(content)
+        return path
+
+    def test_request_is_schema_constrained(self):
+        data = build_request("prompt", b"\xff\xd8\xff\xe0")
+
+        self.assertEqual(data["response_format"]["type"], "json_schema")
+        self.assertTrue(data["response_format"]["json_schema"]["strict"])
+
+    def test_streamed_response_is_reassembled(self):
+        identified = []
+        response = stream_data_from_prescription(self._image(b"\xff\xd8\xff\xe0jpeg"), "prompt",
+                                                 on_identified=lambda: identified.append(True))
+
+        parsed = json.loads(response)
+        self.assertFalse(parsed["rechazada"])
+        self.assertEqual(parsed["datos"]["tipo_documento"], "CC")
+        self.assertEqual(identified, [True])
+
+    def test_rejected_image_stops_the_stream(self):
+        response = stream_data_from_prescription(self._image(b"\x89PNG\r\n\x1a\n"), "prompt")
+
+        self.assertEqual(response, REJECTION_MESSAGE)
+
+
+
+class TestTokenEstimate(unittest.TestCase):
+
+    @patch("openai_service.get_client")
+    def test_multi_image_request_is_charged_per_image(self, mock_get_client):
+        mock_get_client.return_value.post_json.side_effect = requests.RequestException("sin red")
+        images = [b"\xff\xd8\xff\xe0a", b"\xff\xd8\xff\xe0b", b"\xff\xd8\xff\xe0c"]
+
+        extract_data_from_prescriptions([], "prompt", image_bytes=images)
+
+        data, tokens = mock_get_client.return_value.post_json.call_args[0]
+        self.assertEqual(tokens, estimate_tokens("prompt", data["max_tokens"], 3))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,123 @@
+import os
+import tempfile
+import unittest
+from unittest.mock import MagicMock, patch
+
+from patient_cache import PatientCache
+
+
+def _paciente(nombre="Ana", prescripciones=None):
+    return {
+        "paciente_clave": "COCC1",
+        "nombre_paciente": nombre,
+        "telefono_contacto": ["300"],
+        "prescripciones": prescripciones if prescripciones is not None else [
+            {"id_session": "s1", "url_prescripcion": "gs://b/a.jpg", "medicamentos": [{"nombre": "A", "dosis": "1", "cantidad": "2"}]},
+        ],
+    }
+
+
+class TestPatientCache(unittest.TestCase):
+
+    def setUp(self):
+        self.store = MagicMock()
+        self.cache = PatientCache(self.store, max_entries=10, path="")
+
+    def test_unchanged_record_skips_the_write(self):
+        self.cache.insert_or_update_patient_data(_paciente())
+        self.cache.insert_or_update_patient_data(_paciente())
+
+        self.store.insert_or_update_patient_data.assert_called_once_with(_paciente())
+        stats = self.cache.stats()
+        self.assertEqual((stats["registros"], stats["omitidos"], stats["tasa_omision"]), (2, 1, 0.5))
+
+    def test_changed_record_sends_only_changed_fields_and_new_prescriptions(self):
+        nueva = {"id_session": "s2", "url_prescripcion": "gs://b/b.jpg", "medicamentos": []}
+        self.cache.insert_or_update_patient_data(_paciente())
+
+        self.cache.upsert_patients([_paciente("Ana M", _paciente()["prescripciones"] + [nueva])])
+
+        self.store.upsert_patients.assert_called_once_with(
+            [{"paciente_clave": "COCC1", "nombre_paciente": "Ana M", "prescripciones": [nueva]}], None
+        )
+
+    def test_prescription_is_known_only_by_its_full_id(self):
+        otra_sesion = {**_paciente()["prescripciones"][0], "id_session": "s2", "url_prescripcion": "gs://b/c.jpg"}
+        self.cache.insert_or_update_patient_data(_paciente())
+
+        self.cache.insert_or_update_patient_data(_paciente(prescripciones=[otra_sesion]))
+
+        self.assertEqual(self.store.insert_or_update_patient_data.call_args.args[0],
+                         {"paciente_clave": "COCC1", "prescripciones": [otra_sesion]})
+        self.assertEqual(self.cache.stats()["omitidos"], 0)
+
+    def test_duplicates_within_a_batch_are_diffed_against_each_other(self):
+        self.assertEqual(self.cache.upsert_patients([_paciente(), _paciente(), _paciente("Ana M")]), 1)
+
+        sent = self.store.upsert_patients.call_args.args[0]
+        self.assertEqual(sent, [_paciente(), {**_paciente("Ana M"), "prescripciones": []}])
+
+    def test_partial_records_keep_one_column_set_per_batch(self):
+        self.cache.warm([{**_paciente(), "paciente_clave": f"COCC{i}"} for i in range(3)])
+        changed_name = {**_paciente("Ana M"), "paciente_clave": "COCC0"}
+        changed_phone = {**_paciente(), "paciente_clave": "COCC1", "telefono_contacto": ["301"]}
+        new = {**_paciente(), "paciente_clave": "COCC9"}
+
+        self.cache.upsert_patients([changed_name, changed_phone, new])
+
+        sent = self.store.upsert_patients.call_args.args[0]
+        self.assertEqual({tuple(record) for record in sent}, {tuple(_paciente())})
+        self.assertEqual(sent[0], {**changed_name, "prescripciones": []})
+        self.assertEqual(sent[1], {**changed_phone, "prescripciones": []})
+        self.assertEqual(sent[2], new)
+
+    def test_failed_write_does_not_update_the_cache(self):
+        self.store.insert_or_update_patient_data.side_effect = [RuntimeError("500"), None]
+
+        with self.assertRaises(RuntimeError):
+            self.cache.insert_or_update_patient_data(_paciente())
+        self.cache.insert_or_update_patient_data(_paciente())
+
+        self.assertEqual(self.store.insert_or_update_patient_data.call_count, 2)
+        self.assertEqual(self.store.insert_or_update_patient_data.call_args.args[0], _paciente())
+
+    def test_lru_bound_and_ttl(self):
+        self.cache.max_entries = 2
+        self.cache.warm([{**_paciente(), "paciente_clave": f"COCC{i}"} for i in range(3)])
+        self.assertEqual(self.cache.stats()["entradas"], 2)
+
+        self.cache.insert_or_update_patient_data({**_paciente(), "paciente_clave": "COCC0"})
+        self.store.insert_or_update_patient_data.assert_called_once()
+
+        with patch("patient_cache.time.time", return_value=10 ** 12):
+            self.cache.insert_or_update_patient_data({**_paciente(), "paciente_clave": "COCC2"})
+        self.assertEqual(self.store.insert_or_update_patient_data.call_count, 2)
+
+    def test_persists_to_disk(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, "pacientes.json")
+            cache = PatientCache(self.store, path=path, save_every=1)
+            cache.insert_or_update_patient_data(_paciente())
+
+            reopened = PatientCache(self.store, path=path)
+            reopened.insert_or_update_patient_data(_paciente())
+
+        self.store.insert_or_update_patient_data.assert_called_once()
+        self.assertEqual(reopened.stats()["omitidos"], 1)
+
+    @patch.dict(os.environ, {"PROJECT_ID": "p", "DATASET_ID": "d", "TABLE_ID": "t", "BQ_WRITE_MODE": "anidado"})
+    @patch("bigquery_service.client")
+    def test_warm_from_bigquery(self, mock_client):
+        row = MagicMock()
+        row.items.return_value = _paciente().items()
+        mock_client.query.return_value.result.return_value = [row]
+
+        self.assertEqual(self.cache.warm_from_bigquery(limit=5), 1)
+        self.assertIn("FROM `p.d.t`", mock_client.query.call_args.args[0])
+
+        self.cache.insert_or_update_patient_data(_paciente())
+        self.store.insert_or_update_patient_data.assert_not_called()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,285 @@
+import os
+import json
+import tempfile
+import threading
+import unittest
+from unittest.mock import MagicMock, patch
+
+from cloud_storage_service import UploadResult
+from extraction_cache import ExtractionCache
+from openai_service import REJECTION_MESSAGE, split_multi_response
+from pip_processor import PIPProcessor
+
+
+def _respuesta_modelo(numero_documento):
+    return json.dumps({
+        "datos": {
+            "tipo_documento": "CC",
+            "numero_documento": numero_documento,
+            "paciente": f"Paciente {numero_documento}",
+            "medicamentos": [{"nombre": "MedA", "dosis": "10mg", "cantidad": "1"}],
+        }
+    })
+
+
+def _subida(path, **kwargs):
+    return UploadResult(f"gs://bucket-test/{path}", f"prescripciones/{path}", True, 10)
+
+
+class TestPIPProcessorBatch(unittest.TestCase):
+
+    def setUp(self):
+        patcher = patch.object(PIPProcessor, "read_prompt", return_value="prompt")
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.uploader = MagicMock()
+        self.uploader.upload.side_effect = _subida
+        self.processor = PIPProcessor(uploader=self.uploader)
+        self.processor.bucket_name = "bucket-test"
+
+    @patch("bigquery_service.upsert_patients")
+    @patch("pip_processor.extract_data_from_prescription")
+    def test_process_batch_keeps_input_order(self, mock_extract, mock_upsert):
+        mock_extract.side_effect = lambda path, prompt: _respuesta_modelo(path.split("_")[1])
+
+        paths = [f"img_{i}" for i in range(20)]
+        batch = self.processor.process_batch(
+            paths, "sesion-1", extract_workers=3, upload_workers=2, persist_workers=2, persist_batch_size=8
+        )
+
+        self.assertEqual([r["numero_documento"] for r in batch["resultados"]], [str(i) for i in range(20)])
+        self.assertEqual(batch["resumen"]["exitosas"], 20)
+        self.assertEqual(batch["resumen"]["fallidas"], 0)
+        # 20 records in batches of at most 8, never one MERGE per patient
+        self.assertLessEqual(mock_upsert.call_count, 10)
+        self.assertTrue(all(len(call.args[0]) <= 8 for call in mock_upsert.call_args_list))
+        claves = sorted(r["paciente_clave"] for call in mock_upsert.call_args_list for r in call.args[0])
+        self.assertEqual(claves, sorted(f"COCC{i}" for i in range(20)))
+
+    @patch("bigquery_service.upsert_patients")
+    @patch("pip_processor.extract_data_from_prescription")
+    def test_process_batch_persist_failure_marks_whole_batch(self, mock_extract, mock_upsert):
+        mock_extract.side_effect = lambda path, prompt: _respuesta_modelo(path)
+        mock_upsert.side_effect = Exception("quota exceeded")
+
+        batch = self.processor.process_batch(["1", "2", "3"], "sesion-4", persist_batch_size=10)
+
+        self.assertEqual(batch["resultados"], ["Error al registrar los datos en el sistema."] * 3)
+        self.assertEqual(batch["resumen"]["fallas_por_etapa"], {"persistencia": 3})
+
+    @patch("bigquery_service.upsert_patients")
+    @patch("pip_processor.extract_data_from_prescription")
+    def test_process_batch_reports_failures_per_stage(self, mock_extract, mock_upsert):
+        def extract(path, prompt):
+            if path == "selfie":
+                return "Por favor, envía una foto de una fórmula médica válida y legible para poder procesarla correctamente."
+            return _respuesta_modelo(path)
+
+        def upload(path, **kwargs):
+            if path == "2":
+                raise RuntimeError("timeout")
+            return _subida(path)
+
+        mock_extract.side_effect = extract
+        self.uploader.upload.side_effect = upload
+
+        batch = self.processor.process_batch(["1", "selfie", "2", "3"], "sesion-2")
+
+        resultados = batch["resultados"]
+        self.assertEqual(resultados[0]["numero_documento"], "1")
+        self.assertIn("fórmula médica válida", resultados[1])
+        self.assertEqual(resultados[2], "Error al subir la fórmula al sistema.")
+        self.assertEqual(resultados[3]["numero_documento"], "3")
+        self.assertEqual(batch["resumen"]["fallidas"], 2)
+        self.assertEqual(batch["resumen"]["fallas_por_etapa"], {"extraccion": 1, "subida": 1})
+        guardados = [r["numero_documento"] for call in mock_upsert.call_args_list for r in call.args[0]]
+        self.assertEqual(sorted(guardados), ["1", "3"])
+
+    @patch("bigquery_service.insert_or_update_patient_data")
+    @patch("pip_processor.extract_data_from_prescription")
+    def test_process_image_returns_error_message(self, mock_extract, mock_insert):
+        mock_extract.return_value = "no es json"
+
+        resultado = self.processor.process_image("img.jpg", "sesion-3")
+
+        self.assertEqual(resultado, "Hubo un error procesando la fórmula médica.")
+        self.uploader.upload.assert_not_called()
+        mock_insert.assert_not_called()
+
+    @patch("bigquery_service.insert_or_update_patient_data")
+    @patch("pip_processor.extract_data_from_prescription")
+    def test_process_image_cache_hit_skips_all_stages(self, mock_extract, mock_insert):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            image_path = os.path.join(tmpdir, "formula.jpg")
+            with open(image_path, "wb") as f:
+                f.write(b"imagen")
+            self.processor.cache = ExtractionCache(os.path.join(tmpdir, "cache.sqlite3"))
+            mock_extract.return_value = _respuesta_modelo("123")
+
+            primero = self.processor.process_image(image_path, "sesion-5")
+            segundo = self.processor.process_image(image_path, "sesion-6")
+
+            self.assertEqual(primero, segundo)
+            mock_extract.assert_called_once()
+            self.uploader.upload.assert_called_once()
+            mock_insert.assert_called_once()
+            self.assertEqual(self.processor.cache.stats()["hits"], 1)
+            self.processor.cache.close()
+
+
+class TestPIPProcessorSpeculativeUpload(unittest.TestCase):
+
+    def setUp(self):
+        patcher = patch.object(PIPProcessor, "read_prompt", return_value="prompt")
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.uploader = MagicMock()
+        self.processor = PIPProcessor(uploader=self.uploader, speculative_upload=True)
+        self.processor.quarantine_prefix = "cuarentena"
+
+    @patch("bigquery_service.insert_or_update_patient_data")
+    @patch("pip_processor.extract_data_from_prescription")
+    def test_upload_runs_while_extracting(self, mock_extract, mock_insert):
+        upload_started = threading.Event()
+
+        def upload(path, **kwargs):
+            upload_started.set()
+            return _subida(path)
+
+        def extract(path, prompt):
+            # Only returns once the upload is already running in parallel
+            self.assertTrue(upload_started.wait(5))
+            return _respuesta_modelo("123")
+
+        self.uploader.upload.side_effect = upload
+        mock_extract.side_effect = extract
+
+        resultado = self.processor.process_image("img.jpg", "sesion-7")
+
+        self.assertEqual(resultado["numero_documento"], "123")
+        prescripcion = mock_insert.call_args.args[0]["prescripciones"][0]
+        self.assertEqual(prescripcion["url_prescripcion"], "gs://bucket-test/img.jpg")
+        self.uploader.discard.assert_not_called()
+        self.assertTrue(self.uploader.upload.call_args.kwargs["speculative"])
+        self.processor._speculative_pool.shutdown(wait=True)
+        self.assertEqual(self.uploader.settle.call_args.args[0].uri, "gs://bucket-test/img.jpg")
+
+    @patch("bigquery_service.insert_or_update_patient_data")
+    @patch("pip_processor.extract_data_from_prescription")
+    def test_rejected_image_is_quarantined(self, mock_extract, mock_insert):
+        discarded = threading.Event()
+        self.uploader.upload.side_effect = _subida
+        self.uploader.discard.side_effect = lambda result, prefix: discarded.set()
+        mock_extract.return_value = "Por favor, envía una foto de una fórmula médica válida y legible para poder procesarla correctamente."
+
+        resultado = self.processor.process_image("selfie.jpg", "sesion-8")
+
+        self.assertIn("fórmula médica válida", resultado)
+        self.assertTrue(discarded.wait(5))
+        result, prefix = self.uploader.discard.call_args.args
+        self.assertEqual(result.blob_name, "prescripciones/selfie.jpg")
+        self.assertEqual(prefix, "cuarentena")
+        mock_insert.assert_not_called()
+
+    @patch("bigquery_service.insert_or_update_patient_data")
+    @patch("pip_processor.extract_data_from_prescription")
+    def test_retryable_extraction_error_keeps_the_upload(self, mock_extract, mock_insert):
+        self.uploader.upload.side_effect = _subida
+        mock_extract.return_value = "Error en la API de OpenAI: 503"
+
+        resultado = self.processor.process_image("img.jpg", "sesion-10")
+
+        self.assertEqual(resultado, "Hubo un error procesando la fórmula médica.")
+        self.processor._speculative_pool.shutdown(wait=True)
+        self.uploader.upload.assert_called_once()
+        self.uploader.discard.assert_not_called()
+        self.uploader.settle.assert_called_once()
+
+    @patch("bigquery_service.insert_or_update_patient_data")
+    @patch("pip_processor.extract_data_from_prescription")
+    def test_upload_error_after_valid_extraction(self, mock_extract, mock_insert):
+        self.uploader.upload.side_effect = RuntimeError("503")
+        mock_extract.return_value = _respuesta_modelo("123")
+
+        resultado = self.processor.process_image("img.jpg", "sesion-9")
+
+        self.assertEqual(resultado, "Error al subir la fórmula al sistema.")
+        mock_insert.assert_not_called()
+
+
+def _respuesta_multi(numeros):
+    return json.dumps({"imagenes": [
+        {"imagen": i, "rechazada": True} if numero is None else {"imagen": i, **json.loads(_respuesta_modelo(numero))}
+        for i, numero in enumerate(numeros, start=1)
+    ]})
+
+
+class TestPIPProcessorMultiImage(unittest.TestCase):
+
+    def setUp(self):
+        patcher = patch.object(PIPProcessor, "read_prompt", return_value="prompt")
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.uploader = MagicMock()
+        self.uploader.upload.side_effect = _subida
+        self.store = MagicMock()
+        self.processor = PIPProcessor(uploader=self.uploader, patient_store=self.store, images_per_request=3)
+        self.processor.cache = None
+
+    def test_split_multi_response(self):
+        parts = split_multi_response(_respuesta_multi(["1", None]), 2)
+
+        self.assertEqual(json.loads(parts[0])["datos"]["numero_documento"], "1")
+        self.assertEqual(parts[1], REJECTION_MESSAGE)
+        for malformed in ("no es json", _respuesta_multi(["1"]), json.dumps({"imagenes": [{"imagen": 1}, {"imagen": 1}]})):
+            with self.assertRaises(ValueError):
+                split_multi_response(malformed, 2)
+
+    @patch("pip_processor.extract_data_from_prescription")
+    @patch("pip_processor.extract_data_from_prescriptions")
+    def test_process_batch_packs_images_per_request(self, mock_multi, mock_single):
+        mock_multi.side_effect = lambda paths, prompt: _respuesta_multi([None if p == "selfie" else p for p in paths])
+        mock_single.side_effect = lambda path, prompt: _respuesta_modelo(path)
+
+        paths = ["1", "selfie", "2", "3", "4", "5", "6"]
+        batch = self.processor.process_batch(paths, "sesion-1", extract_workers=2)
+
+        self.assertEqual(sorted(c.args[0] for c in mock_multi.call_args_list), [paths[0:3], paths[3:6]])
+        mock_single.assert_called_once_with("6", "prompt")
+        self.assertIn("fórmula médica válida", batch["resultados"][1])
+        self.assertEqual([r["numero_documento"] for i, r in enumerate(batch["resultados"]) if i != 1], ["1", "2", "3", "4", "5", "6"])
+        self.assertEqual(batch["resumen"]["fallas_por_etapa"], {"extraccion": 1})
+
+    @patch("pip_processor.extract_data_from_prescription")
+    @patch("pip_processor.extract_data_from_prescriptions")
+    def test_malformed_batch_response_falls_back_to_single_calls(self, mock_multi, mock_single):
+        mock_multi.return_value = _respuesta_multi(["1"])
+        mock_single.side_effect = lambda path, prompt: _respuesta_modelo(path)
+
+        outcomes = self.processor.extract_data_multi(["1", "2"], "prompt")
+
+        self.assertEqual([o["numero_documento"] for o in outcomes], ["1", "2"])
+        self.assertEqual(mock_single.call_count, 2)
+
+    @patch("pip_processor.extract_data_from_prescriptions")
+    def test_process_session_merges_pages_into_one_prescription(self, mock_multi):
+        pagina_2 = json.loads(_respuesta_modelo("1"))
+        pagina_2["datos"].update(paciente=None, medicamentos=[
+            {"nombre": "MedA", "dosis": "10mg", "cantidad": "1"}, {"nombre": "MedB", "dosis": "5mg", "cantidad": "2"},
+        ])
+        mock_multi.return_value = json.dumps({"imagenes": [
+            {"imagen": 1, **json.loads(_respuesta_modelo("1"))}, {"imagen": 2, **pagina_2},
+        ]})
+
+        results = self.processor.process_session(["p1", "p2"], "sesion-1")
+
+        self.assertEqual([r["numero_documento"] for r in results], ["1", "1"])
+        (record,) = self.store.upsert_patients.call_args.args[0]
+        self.assertEqual(record["nombre_paciente"], "Paciente 1")
+        (prescripcion,) = record["prescripciones"]
+        self.assertEqual(prescripcion["url_prescripcion"], "gs://bucket-test/p1,gs://bucket-test/p2")
+        self.assertEqual([m["nombre"] for m in prescripcion["medicamentos"]], ["MedA", "MedB"])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,115 @@
+import os
+import tempfile
+import unittest
+from unittest.mock import patch
+
+from cloud_storage_service import GCSUploader
+from instrumentation import StageMetrics, Tracer
+from offline_fakes import FakeOpenAIServer, FilesystemBucket, SQLitePatientStore
+from openai_client import OpenAIClient, reset_client, set_client
+from openai_service import build_multi_request, build_request
+from pip_processor import PIPProcessor
+from prompt_registry import PromptRegistry, parse_variants, prompt_version
+
+
+class TestPromptRegistry(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmpdir.cleanup)
+        self.path = self._write("prompt.txt", "Extrae los datos v1")
+
+    def _write(self, name, text, mtime_ns=None):
+        path = os.path.join(self.tmpdir.name, name)
+        with open(path, "w", encoding="utf-8") as f:
+            f.write(text)
+        if mtime_ns is not None:
+            os.utime(path, ns=(mtime_ns, mtime_ns))
+        return path
+
+    def test_reads_once_and_reloads_when_the_file_changes(self):
+        registry = PromptRegistry(self.path, variants={}, check_interval=0)
+        first = registry.get()
+
+        with patch("builtins.open", side_effect=AssertionError("no debería releer")):
+            self.assertIs(registry.get(), first)
+        self._write("prompt.txt", "Extrae los datos v2", mtime_ns=first.mtime_ns + 10 ** 9)
+        second = registry.get()
+
+        self.assertEqual(first.version, prompt_version("Extrae los datos v1"))
+        self.assertEqual((second.text, second.version), ("Extrae los datos v2", prompt_version("Extrae los datos v2")))
+        os.remove(self.path)
+        self.assertIs(registry.get(), second)
+
+    def test_check_interval_skips_stat(self):
+        registry = PromptRegistry(self.path, variants={}, check_interval=60)
+        first = registry.get()
+        self._write("prompt.txt", "Extrae los datos v2", mtime_ns=first.mtime_ns + 10 ** 9)
+
+        self.assertIs(registry.get(), first)
+
+    def test_variants_are_assigned_by_key(self):
+        variant = self._write("prompt_b.txt", "Extrae los datos B")
+        registry = PromptRegistry(self.path, variants=parse_variants(f"b={variant}:20"), check_interval=60)
+
+        chosen = [registry.choose(f"sesion-{i}").name for i in range(1000)]
+
+        self.assertEqual(registry.choose("sesion-7").name, chosen[7])
+        self.assertTrue(150 < chosen.count("b") < 250)
+        self.assertEqual(registry.choose(None).name, "pip")
+        self.assertEqual(set(registry.versions()), {"pip", "b"})
+        with self.assertRaises(ValueError):
+            parse_variants("b=prompt_b.txt")
+
+
+class TestPromptCaching(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmpdir.cleanup)
+        # Long enough (> 1024 tokens) for the provider's prefix cache
+        self.prompt_path = os.path.join(self.tmpdir.name, "prompt_PIP.txt")
+        with open(self.prompt_path, "w", encoding="utf-8") as f:
+            f.write("Extrae los datos de la fórmula médica. " * 120)
+
+    def test_static_prefix_is_shared_by_single_and_multi_requests(self):
+        prompt = "Extrae los datos."
+        single = build_request(prompt, b"\xff\xd8\xff\xe01")
+        multi = build_multi_request(prompt, [(b"\xff\xd8\xff\xe02", None), (b"\xff\xd8\xff\xe03", None)])
+
+        self.assertTrue(multi["messages"][0]["content"].startswith(single["messages"][0]["content"]))
+        with patch.dict(os.environ, {"OPENAI_PROMPT_CACHE_KEY": "1"}):
+            self.assertEqual(build_request(prompt, b"\xff\xd8\xff\xe04")["prompt_cache_key"], f"pip-{prompt_version(prompt)}")
+
+    def test_records_carry_the_prompt_version_and_cached_tokens_are_reported(self):
+        server = FakeOpenAIServer().start()
+        self.addCleanup(server.stop)
+        set_client(OpenAIClient(api_key="local", api_url=server.url))
+        self.addCleanup(reset_client)
+        store = SQLitePatientStore()
+        metrics = StageMetrics()
+        processor = PIPProcessor(
+            uploader=GCSUploader("bucket-local", bucket=FilesystemBucket(os.path.join(self.tmpdir.name, "bucket"))),
+            patient_store=store,
+            tracer=Tracer([metrics]),
+            prompts=PromptRegistry(self.prompt_path, variants={}),
+        )
+        processor.cache = None
+        images = []
+        for i in range(3):
+            images.append(os.path.join(self.tmpdir.name, f"formula_{i}.jpg"))
+            with open(images[-1], "wb") as f:
+                f.write(b"\xff\xd8\xff\xe0" + bytes([i]) * 64)
+
+        results = [processor.process_image(image, "sesion-prompt") for image in images]
+
+        paciente = store.get(f"COCC{results[0]['numero_documento']}")
+        self.assertEqual(paciente["prescripciones"][0]["version_prompt"], processor.prompts.get().version)
+        totals = metrics.snapshot()["openai"]["totals"]
+        # The first call fills the cache; the other two reuse the system prompt
+        self.assertGreater(totals["cached_tokens"], 0)
+        self.assertIn('pip_openai_cached_token_ratio{stage="openai"}', metrics.prometheus_text())
+
+
+if __name__ == '__main__':
+    unittest.main()
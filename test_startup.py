@@ -0,0 +1,29 @@
+import sys
+import unittest
+
+from check_import_time import heavy_imports, measure_import
+from startup import LazyModule
+
+
+class TestLazyModule(unittest.TestCase):
+
+    def test_imports_on_first_attribute_access(self):
+        sys.modules.pop("colorsys", None)
+        lazy = LazyModule("colorsys")
+
+        self.assertNotIn("colorsys", sys.modules)
+        self.assertEqual(lazy.rgb_to_hsv(0, 0, 0), (0.0, 0.0, 0.0))
+        self.assertIn("colorsys", sys.modules)
+
+
+class TestColdStart(unittest.TestCase):
+
+    def test_pip_processor_import_does_not_load_sdks(self):
+        total, rows = measure_import("pip_processor")
+
+        self.assertEqual(heavy_imports(rows), {})
+        self.assertGreater(total, 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,163 @@
+import io
+import os
+import tempfile
+import unittest
+from unittest.mock import MagicMock, patch
+
+import evaluate_triage
+from instrumentation import Tracer
+from offline_fakes import FakeOpenAIServer
+from openai_client import OpenAIClient, reset_client, set_client
+from pip_processor import PIPProcessor
+from triage import HeuristicTriage, ModelTriage, TriageCascade
+
+try:
+    from PIL import Image, ImageDraw, ImageFilter
+except ImportError:
+    Image = None
+
+
+def _jpeg(image):
+    output = io.BytesIO()
+    image.save(output, format="JPEG", quality=90)
+    return output.getvalue()
+
+
+def _formula(blur=0):
+    image = Image.new("RGB", (900, 1200), "white")
+    draw = ImageDraw.Draw(image)
+    for y in range(60, 1140, 36):
+        for x in range(40, 820, 90):
+            draw.text((x, y), "Acetam 500", fill="black")
+    return _jpeg(image.filter(ImageFilter.GaussianBlur(blur)) if blur else image)
+
+
+def _selfie():
+    image = Image.new("RGB", (900, 1200))
+    draw = ImageDraw.Draw(image)
+    for y in range(1200):
+        draw.line((0, y, 900, y), fill=(120 + y // 30, 80 + y // 40, 60))
+    draw.ellipse((250, 250, 650, 800), fill=(200, 150, 120))
+    return _jpeg(image)
+
+
+class _FixedTier:
+
+    def __init__(self, name, score, accept=0.5, reject=0.5):
+        self.name, self.accept, self.reject = name, accept, reject
+        self.score = MagicMock(return_value=score)
+
+
+class TestTriageCascade(unittest.TestCase):
+
+    def test_undecided_tier_defers_to_the_next(self):
+        cheap = _FixedTier("heuristica", 0.5, accept=0.75, reject=0.25)
+        model = _FixedTier("modelo", 0.1)
+        cascade = TriageCascade([cheap, model], tracer=Tracer())
+
+        result = cascade.classify(b"imagen")
+
+        self.assertEqual((result.pasa, result.nivel, result.puntaje), (False, "modelo", 0.1))
+        stats = cascade.stats()
+        self.assertEqual(stats["heuristica"]["indecisas"], 1)
+        self.assertEqual(stats["modelo"]["rechazadas"], 1)
+
+    def test_passes_when_no_tier_decides(self):
+        cascade = TriageCascade([_FixedTier("modelo", None)], tracer=Tracer())
+
+        self.assertTrue(cascade.classify(b"imagen").pasa)
+        self.assertEqual(cascade.stats()["modelo"]["sin_puntaje"], 1)
+
+    @patch.dict(os.environ, {"PIP_TRIAGE": "heuristica,ocr"})
+    def test_unknown_tier_names_are_rejected(self):
+        with self.assertRaises(ValueError):
+            TriageCascade(tracer=Tracer())
+
+
+@unittest.skipIf(Image is None, "Pillow no está instalado")
+class TestHeuristicTriage(unittest.TestCase):
+
+    def test_scores_separate_formulas_from_other_photos(self):
+        triage = HeuristicTriage(accept=0.75, reject=0.25)
+
+        self.assertGreaterEqual(triage.score(_formula()), triage.accept)
+        self.assertLess(triage.score(_selfie()), triage.reject)
+        self.assertTrue(triage.reject <= triage.score(_formula(blur=12)) < triage.accept)
+        self.assertIsNone(triage.score(b"no es una imagen"))
+
+    def test_evaluation_script_over_labeled_folder(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            for label, images in (("formula", [_formula(), _formula(blur=12)]), ("otro", [_selfie()])):
+                os.makedirs(os.path.join(tmpdir, label))
+                for i, data in enumerate(images):
+                    with open(os.path.join(tmpdir, label, f"{i}.jpg"), "wb") as f:
+                        f.write(data)
+
+            images = evaluate_triage.load_labeled_images(tmpdir)
+            report = evaluate_triage.evaluate(images, [HeuristicTriage(accept=0.75, reject=0.25)])
+            barrido = evaluate_triage.sweep(images, HeuristicTriage(), steps=4)
+
+        self.assertEqual(report["resumen"]["falsos_rechazos"], 0)
+        self.assertEqual(report["resumen"]["rechazos_correctos"], 1)
+        self.assertEqual(report["niveles"]["heuristica"]["evaluadas"], 3)
+        self.assertEqual(len(barrido), 15)
+
+
+class TestModelTriage(unittest.TestCase):
+
+    def setUp(self):
+        self.server = FakeOpenAIServer(reject_marker="data:image/png").start()
+        self.addCleanup(self.server.stop)
+        set_client(OpenAIClient(api_key="local", api_url=self.server.url))
+        self.addCleanup(reset_client)
+
+    def test_low_detail_call_and_token_accounting(self):
+        triage = ModelTriage(threshold=0.5, model="modelo-barato")
+        cascade = TriageCascade([triage], tracer=Tracer())
+
+        self.assertEqual(triage.build_request(b"\xff\xd8\xff\xe0jpeg")["messages"][1]["content"][0]["image_url"]["detail"], "low")
+        self.assertTrue(cascade.classify(b"\xff\xd8\xff\xe0jpeg").pasa)
+        self.assertFalse(cascade.classify(b"\x89PNG\r\n\x1a\n").pasa)
+        stats = cascade.stats()["modelo"]
+        self.assertEqual((stats["aprobadas"], stats["rechazadas"]), (1, 1))
+        self.assertGreater(stats["prompt_tokens"], 0)
+        self.assertGreater(stats["costo_usd"], 0)
+
+
+class TestProcessorTriage(unittest.TestCase):
+
+    def setUp(self):
+        patcher = patch.object(PIPProcessor, "read_prompt", return_value="prompt")
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmpdir.cleanup)
+        self.cascade = TriageCascade([_FixedTier("heuristica", None)], tracer=Tracer())
+        self.processor = PIPProcessor(uploader=MagicMock(), patient_store=MagicMock(), triage=self.cascade)
+        self.processor.cache = None
+
+    def _image(self, name):
+        path = os.path.join(self.tmpdir.name, name)
+        with open(path, "wb") as f:
+            f.write(name.encode())
+        return path
+
+    @patch("pip_processor.extract_data_from_prescriptions")
+    @patch("pip_processor.extract_data_from_prescription")
+    def test_rejected_images_never_reach_extraction(self, mock_single, mock_multi):
+        self.cascade.tiers[0].score.side_effect = lambda data: 0.0 if data == b"selfie" else 1.0
+        mock_single.return_value = '{"datos": {"tipo_documento": "CC", "numero_documento": "1"}}'
+
+        message = self.processor.process_image(self._image("selfie"), "s1")
+        outcomes = self.processor.extract_data_multi([self._image("selfie"), self._image("formula")], "prompt")
+
+        self.assertIn("fórmula médica válida", message)
+        self.assertIn("fórmula médica válida", outcomes[0].message)
+        self.assertEqual(outcomes[1]["numero_documento"], "1")
+        mock_single.assert_called_once()
+        mock_multi.assert_not_called()
+        self.processor.uploader.upload.assert_not_called()
+
+
+if __name__ == '__main__':
+    unittest.main()
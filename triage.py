@@ -0,0 +1,268 @@
+import io
+import os
+import base64
+import logging
+import threading
+from typing import Dict, List, NamedTuple, Optional
+
+from image_preprocessing import ImagePreprocessor, _load_pil, detect_mime_type
+from instrumentation import Span, Tracer, annotate, get_tracer
+from openai_client import estimate_tokens, get_client, requests
+from openai_service import model_params, parse_model_json, read_response
+from startup import load_env
+
+
+logger = logging.getLogger(__name__)
+
+TRIAGE_PROMPT = (
+    "Eres un filtro de imágenes para un sistema que lee fórmulas médicas. Indica qué tan probable es que la "
+    "imagen sea una fórmula o prescripción médica legible (con medicamentos y datos del paciente). Selfies, "
+    "documentos de identidad, objetos, capturas de pantalla sin fórmula o fotos demasiado borrosas tienen "
+    "probabilidad baja. Responde solo con un objeto JSON: {\"probabilidad\": número entre 0 y 1}."
+)
+
+# Per million tokens, used only for the cost estimate in stats()
+DEFAULT_PRICE_INPUT = 0.40
+DEFAULT_PRICE_OUTPUT = 1.60
+
+
+def _clamp(value: float) -> float:
+    return max(0.0, min(1.0, value))
+
+
+class TriageResult(NamedTuple):
+    """
+    Decisión del triaje para una imagen.
+    """
+    pasa: bool
+    nivel: Optional[str]
+    puntaje: Optional[float]
+    motivo: str
+
+
+class HeuristicTriage:
+    """
+    Clasificador local, sin llamadas externas.
+
+    Sobre una versión reducida en escala de grises mide cuánto de la imagen es
+    papel claro y la densidad de bordes marcados. Una foto de una fórmula tiene
+    fondo claro y mucho texto nítido; una selfie tiene poco fondo claro y una
+    foto borrosa pierde los bordes del texto. Si Pillow no está instalado no
+    decide.
+    """
+
+    name = "heuristica"
+
+    def __init__(self, accept: Optional[float] = None, reject: Optional[float] = None, size: int = 256):
+        """
+        :param accept: Puntaje desde el que la imagen pasa (PIP_TRIAGE_ACCEPT, default 0.75).
+        :param reject: Puntaje bajo el que se rechaza (PIP_TRIAGE_REJECT, default 0.25).
+            Entre ambos decide el siguiente nivel.
+        :param size: Lado largo de la versión reducida que se analiza.
+        """
+        self.accept = accept if accept is not None else float(os.getenv("PIP_TRIAGE_ACCEPT", "0.75"))
+        self.reject = reject if reject is not None else float(os.getenv("PIP_TRIAGE_REJECT", "0.25"))
+        self.size = size
+
+    def features(self, data: bytes) -> Optional[Dict[str, float]]:
+        """
+        Calcula las características de la imagen.
+
+        :param data: Bytes de la imagen.
+        :return: {"papel", "bordes"} (fracciones de píxeles) o None si no se puede decodificar.
+        """
+        pil = _load_pil()
+        if pil is None:
+            return None
+        Image, _ = pil
+        from PIL import ImageFilter
+
+        try:
+            image = Image.open(io.BytesIO(data))
+            image.draft("L", (self.size, self.size))
+            image = image.convert("L")
+        except Exception as e:
+            logger.warning(f"No se pudo decodificar la imagen para el triaje: {e}")
+            return None
+        image.thumbnail((self.size, self.size))
+
+        pixels = image.width * image.height
+        histogram = image.histogram()
+        edge_histogram = image.filter(ImageFilter.FIND_EDGES).histogram()
+        return {
+            "papel": sum(histogram[170:]) / pixels,
+            "bordes": sum(edge_histogram[40:]) / pixels,
+        }
+
+    def score(self, data: bytes) -> Optional[float]:
+        """
+        Puntaje entre 0 y 1 de que la imagen sea una fórmula legible.
+
+        :param data: Bytes de la imagen.
+        :return: Puntaje, o None si no se pudo calcular.
+        """
+        features = self.features(data)
+        if features is None:
+            return None
+        return round(0.5 * _clamp((features["papel"] - 0.2) / 0.5) + 0.5 * _clamp(features["bordes"] / 0.08), 4)
+
+
+class ModelTriage:
+    """
+    Llamada barata al modelo: imagen reducida con detail=low y un prompt corto
+    que solo pide la probabilidad de que sea una fórmula legible.
+    """
+
+    name = "modelo"
+
+    def __init__(self, threshold: Optional[float] = None, model: Optional[str] = None, max_edge: int = 512):
+        """
+        :param threshold: Probabilidad desde la que la imagen pasa
+            (PIP_TRIAGE_MODEL_THRESHOLD, default 0.5).
+        :param model: Modelo del triaje (OPENAI_TRIAGE_MODEL; default el de extracción).
+        :param max_edge: Lado largo de la imagen enviada.
+        """
+        load_env()
+        self.accept = threshold if threshold is not None else float(os.getenv("PIP_TRIAGE_MODEL_THRESHOLD", "0.5"))
+        self.reject = self.accept
+        self.model = model or os.getenv("OPENAI_TRIAGE_MODEL") or model_params()["model"]
+        self.preprocessor = ImagePreprocessor(max_long_edge=max_edge, quality=60)
+
+    def build_request(self, data: bytes) -> Dict:
+        """
+        Arma la solicitud de triaje.
+
+        :param data: Bytes de la imagen original.
+        :return: Cuerpo JSON de la solicitud.
+        """
+        image = self.preprocessor.process(data)
+        mime_type = image.mime_type or detect_mime_type(image.data)
+        encoded = base64.b64encode(image.data).decode("utf-8")
+        annotate(bytes=len(encoded))
+        return {
+            "model": self.model,
+            "messages": [
+                {"role": "system", "content": TRIAGE_PROMPT},
+                {"role": "user", "content": [
+                    {"type": "image_url", "image_url": {"url": f"data:{mime_type};base64,{encoded}", "detail": "low"}}
+                ]},
+            ],
+            "max_tokens": 20,
+            "temperature": 0,
+            "response_format": {"type": "json_object"},
+        }
+
+    def score(self, data: bytes) -> Optional[float]:
+        """
+        Probabilidad que asigna el modelo; los tokens quedan en la medición activa.
+
+        :param data: Bytes de la imagen.
+        :return: Probabilidad, o None si la llamada o la respuesta fallan.
+        """
+        request = self.build_request(data)
+        try:
+            response = get_client().post_json(request, estimate_tokens(TRIAGE_PROMPT, request["max_tokens"]))
+            body = response.json() if response.status_code == 200 else None
+        except (requests.RequestException, ValueError) as e:
+            logger.warning(f"Falló el triaje con el modelo: {e}")
+            return None
+
+        content = read_response(response.status_code, body, self.model)
+        try:
+            return _clamp(float(parse_model_json(content)["probabilidad"]))
+        except (ValueError, KeyError, TypeError) as e:
+            logger.warning(f"Respuesta de triaje inválida ({content[:80]!r}): {e}")
+            return None
+
+
+class TriageCascade:
+    """
+    Niveles de triaje en orden de costo.
+
+    Cada nivel puntúa la imagen: desde su umbral `accept` pasa, bajo `reject`
+    se rechaza y entre ambos decide el siguiente nivel. Si ningún nivel decide
+    (o todos fallan) la imagen pasa: un falso rechazo pierde una fórmula, un
+    falso positivo solo cuesta una extracción.
+    """
+
+    def __init__(self, tiers: Optional[List] = None, tracer: Optional[Tracer] = None):
+        """
+        :param tiers: Niveles (HeuristicTriage, ModelTriage u otro con name,
+            accept, reject y score); por defecto los de PIP_TRIAGE, p. ej.
+            "heuristica,modelo".
+        :param tracer: Mide cada nivel como etapa "triaje_<nivel>".
+        """
+        if tiers is None:
+            available = {"heuristica": HeuristicTriage, "modelo": ModelTriage}
+            names = [name.strip() for name in os.getenv("PIP_TRIAGE", "heuristica,modelo").split(",") if name.strip()]
+            unknown = [name for name in names if name not in available]
+            if unknown:
+                raise ValueError(f"Niveles de triaje desconocidos: {unknown}")
+            tiers = [available[name]() for name in names]
+        self.tiers = tiers
+        self.tracer = tracer or get_tracer()
+        self.price_input = float(os.getenv("OPENAI_PRICE_INPUT_PER_M", str(DEFAULT_PRICE_INPUT)))
+        self.price_output = float(os.getenv("OPENAI_PRICE_OUTPUT_PER_M", str(DEFAULT_PRICE_OUTPUT)))
+        self._lock = threading.Lock()
+        self._stats = {
+            tier.name: {
+                "evaluadas": 0, "aprobadas": 0, "rechazadas": 0, "indecisas": 0, "sin_puntaje": 0,
+                "segundos": 0.0, "prompt_tokens": 0, "completion_tokens": 0,
+            }
+            for tier in self.tiers
+        }
+
+    def _record(self, tier_name: str, outcome: str, span: Span) -> None:
+        with self._lock:
+            stats = self._stats[tier_name]
+            stats["evaluadas"] += 1
+            stats[outcome] += 1
+            stats["segundos"] += span.duration
+            stats["prompt_tokens"] += span.attributes.get("prompt_tokens", 0)
+            stats["completion_tokens"] += span.attributes.get("completion_tokens", 0)
+
+    def classify(self, data: bytes) -> TriageResult:
+        """
+        Pasa la imagen por los niveles hasta que uno decida.
+
+        :param data: Bytes de la imagen.
+        :return: Decisión, con el nivel que decidió y su puntaje.
+        """
+        for tier in self.tiers:
+            with self.tracer.span(f"triaje_{tier.name}") as span:
+                score = tier.score(data)
+                if score is None:
+                    outcome = "sin_puntaje"
+                elif score >= tier.accept:
+                    outcome = "aprobadas"
+                elif score < tier.reject:
+                    outcome = "rechazadas"
+                else:
+                    outcome = "indecisas"
+                span.set(puntaje=score)
+                if outcome == "rechazadas":
+                    span.outcome = "rechazada"
+            self._record(tier.name, outcome, span)
+
+            if outcome == "aprobadas":
+                return TriageResult(True, tier.name, score, "aprobada")
+            if outcome == "rechazadas":
+                return TriageResult(False, tier.name, score, "rechazada")
+        return TriageResult(True, None, None, "indecisa")
+
+    def stats(self) -> Dict:
+        """
+        Retorna los contadores por nivel.
+
+        :return: Por nivel: evaluadas, aprobadas, rechazadas, indecisas, sin
+            puntaje, segundos (total y promedio), tokens y costo estimado en USD.
+        """
+        with self._lock:
+            result = {name: dict(stats) for name, stats in self._stats.items()}
+        for stats in result.values():
+            stats["segundos"] = round(stats["segundos"], 3)
+            stats["segundos_promedio"] = round(stats["segundos"] / stats["evaluadas"], 4) if stats["evaluadas"] else 0.0
+            stats["costo_usd"] = round(
+                (stats["prompt_tokens"] * self.price_input + stats["completion_tokens"] * self.price_output) / 10 ** 6, 6
+            )
+        return result